@@ -0,0 +1,40 @@
+"""package startup time (the frozen build starts once per dropped file)"""
+
+import subprocess
+import sys
+
+import pytest
+
+modules = ["fluorofix.configure", "fluorofix.probe", "fluorofix.batch"]
+
+
+@pytest.mark.benchmark(group="startup")
+@pytest.mark.parametrize("module", modules)
+def bench_import(benchmark, module):
+    # fresh interpreter each round: imports are cached within a process
+    args = [sys.executable, "-c", f"import {module}"]
+    benchmark.pedantic(subprocess.run, (args,), {"check": True}, rounds=10)
+
+
+@pytest.mark.benchmark(group="startup")
+def bench_import_cli(benchmark):
+    # the command-line entry point must not load the heavy dependencies
+    code = (
+        "import sys, fluorofix.cli;"
+        "heavy = {'numpy', 'ffmpegio'} & set(sys.modules);"
+        "assert not heavy, f'imported {heavy}'"
+    )
+    args = [sys.executable, "-c", code]
+    benchmark.pedantic(subprocess.run, (args,), {"check": True}, rounds=10)
+
+
+@pytest.mark.benchmark(group="startup")
+def bench_read_options(benchmark, tmp_path, monkeypatch):
+    monkeypatch.setenv("FLUOROFIX_CACHE_DIR", str(tmp_path))
+    code = (
+        "from fluorofix import configure;"
+        "configure.validateOptions(configure.defaultOption())"
+    )
+    args = [sys.executable, "-c", code]
+    subprocess.run(args, check=True)  # memoize the validation
+    benchmark.pedantic(subprocess.run, (args,), {"check": True}, rounds=10)
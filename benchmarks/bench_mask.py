@@ -0,0 +1,41 @@
+"""mask construction"""
+
+from fractions import Fraction
+import pytest
+
+from fluorofix import batch, transcode
+from conftest import geometry, sizes
+
+
+def mask_shapes(name):
+    spec = geometry[name]
+    return batch.profile_masks(spec, Fraction(*spec.get("sar", [1, 1])))
+
+
+@pytest.mark.benchmark(group="mask")
+@pytest.mark.parametrize("name", list(sizes))
+def bench_create_mask(benchmark, name):
+    # lavfi geq expression of the legacy filtergraph
+    w, h = sizes[name]
+    benchmark(transcode.create_mask, w, h, mask_shapes(name))
+
+
+@pytest.mark.benchmark(group="mask")
+@pytest.mark.parametrize("name", list(sizes))
+def bench_create_mask_image(benchmark, tmp_path, name):
+    # cold cache: render and write the PNG every round
+    w, h = sizes[name]
+    shapes = mask_shapes(name)
+
+    def setup():
+        transcode._mask_image.cache_clear()
+        for f in tmp_path.iterdir():
+            f.unlink()
+
+    benchmark.pedantic(
+        transcode.create_mask_image,
+        (w, h, shapes),
+        {"folder": str(tmp_path)},
+        setup=setup,
+        rounds=20,
+    )
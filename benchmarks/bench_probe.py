@@ -0,0 +1,30 @@
+"""probing and directory analysis"""
+
+from os import path, symlink
+import pytest
+
+from fluorofix import probe
+
+nfiles = 300
+
+
+@pytest.mark.benchmark(group="probe")
+def bench_check_file(benchmark, video, ctx):
+    _, src, *_ = video
+    res = benchmark(probe.check_file, ctx, src)
+    assert res["prof"] is not None
+
+
+@pytest.mark.benchmark(group="analyze")
+def bench_analyze_files(benchmark, tmp_path, video, ctx):
+    # a folder of `nfiles` links to the video and as many non-video files
+    _, src, *_ = video
+    for i in range(nfiles):
+        symlink(src, tmp_path / f"{i:04d}_{path.basename(src)}")
+        (tmp_path / f"notes{i:04d}.txt").write_text("not a video")
+
+    files, _ = benchmark.pedantic(
+        probe.analyze_files, (ctx, [str(tmp_path)]), rounds=3, iterations=1
+    )
+    assert len(files) == nfiles
+    benchmark.extra_info["files/s"] = 2 * nfiles / benchmark.stats.stats.min
@@ -0,0 +1,34 @@
+"""end-to-end transcoding throughput"""
+
+import pytest
+
+from fluorofix import batch
+
+presets = ["ultrafast", "veryfast", "medium", "slow"]
+
+
+def run_transcode(benchmark, ctx, src, prof, dst, nframes):
+    benchmark.pedantic(
+        batch.transcode_file, (ctx, src, prof, dst), rounds=3, iterations=1
+    )
+    benchmark.extra_info["nframes"] = nframes
+    benchmark.extra_info["fps"] = nframes / benchmark.stats.stats.min
+
+
+@pytest.mark.benchmark(group="transcode")
+def bench_transcode(benchmark, tmp_path, video, ctx):
+    name, src, _, _, nframes = video
+    run_transcode(benchmark, ctx, src, name, str(tmp_path / "out.mp4"), nframes)
+
+
+@pytest.mark.benchmark(group="encode preset")
+@pytest.mark.parametrize("preset", presets)
+def bench_encode_preset(benchmark, tmp_path, video_720p, preset):
+    name, src, _, h, nframes = video_720p
+    ctx = {
+        "Profiles": {name: [{"height": h}, {"circ": [200, 20, 880]}]},
+        "KeepAudio": False,
+        "OutputOptions": {"preset": preset, "crf": 18, "pix_fmt": "yuv420p"},
+        "Overwrite": True,
+    }
+    run_transcode(benchmark, ctx, src, name, str(tmp_path / "out.mp4"), nframes)
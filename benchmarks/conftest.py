@@ -0,0 +1,84 @@
+from os import environ, makedirs, path
+import pytest
+from ffmpegio import ffmpegprocess
+
+from fluorofix import cache
+
+assets = path.join(path.dirname(__file__), "..", "test", "assets")
+bench_assets = path.join(path.dirname(__file__), ".assets")
+
+duration = float(environ.get("FLUOROFIX_BENCH_DURATION", 60))
+
+sizes = {"480p": (720, 480), "720p": (1280, 720), "1080p": (1920, 1080)}
+
+# de-identification geometry of the synthetic profiles
+geometry = {
+    "480p": {"circ": [45, 8, 530]},
+    "720p": {"circ": [200, 20, 880]},
+    "1080p": {"sar": [8, 9], "circ": [396, 92, 1144]},
+}
+
+
+def make_video(w, h):
+    """loop a test/assets colorchart clip to the benchmark duration (cached)"""
+
+    src = path.join(assets, f"colorchart_{w}x{h}.mp4")
+    dst = path.join(bench_assets, f"colorchart_{w}x{h}_{duration:g}s.mp4")
+    if not path.exists(dst):
+        makedirs(bench_assets, exist_ok=True)
+        args = {
+            "inputs": [(src, {"stream_loop": -1})],
+            "outputs": [
+                (
+                    dst,
+                    {
+                        "t": duration,
+                        "c:v": "libx264",
+                        "preset": "ultrafast",
+                        "g": 60,
+                        "pix_fmt": "yuv420p",
+                    },
+                )
+            ],
+        }
+        if ffmpegprocess.run(args, capture_log=True, overwrite=True).returncode:
+            raise RuntimeError(f"failed to create {dst}")
+    return dst
+
+
+@pytest.fixture(scope="session", params=list(sizes))
+def video(request):
+    """(name, path, width, height, number of frames) of a synthetic video"""
+    w, h = sizes[request.param]
+    return request.param, make_video(w, h), w, h, round(duration * 30)
+
+
+@pytest.fixture
+def ctx(video):
+    """fluorofix context with a profile matching the video"""
+    name, _, w, h, _ = video
+    return {
+        "Profiles": {name: [{"width": w, "height": h}, geometry[name]]},
+        "SquarePixel": True,
+        "Scaling": "up",
+        "CropVideo": True,
+        "ApplyMask": True,
+        "KeepAudio": False,
+        "OutputSuffix": "_fixed",
+        "OutputExt": ".mp4",
+        "OutputOptions": {"preset": "veryfast", "crf": 18, "pix_fmt": "yuv420p"},
+        "Overwrite": True,
+    }
+
+
+@pytest.fixture(autouse=True)
+def no_probe_cache():
+    # measure the actual probing
+    cache.disable_probe_cache()
+
+
+@pytest.fixture(scope="session")
+def video_720p():
+    """720p synthetic video (see video)"""
+    w, h = sizes["720p"]
+    return "720p", make_video(w, h), w, h, round(duration * 30)
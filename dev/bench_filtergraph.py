@@ -0,0 +1,93 @@
+"""compare filtering fps of the legacy and the planned mask filtergraphs
+
+usage: python dev/bench_filtergraph.py [nloops]
+
+Each test/assets colorchart video is looped `nloops` times and filtered to the
+null muxer (no encoding), so the reported fps reflects decoding + filtering.
+"""
+
+import sys
+from os import path
+from time import perf_counter
+from ffmpegio import ffmpegprocess
+from fluorofix import transcode as tc
+
+assets = path.join(path.dirname(__file__), "..", "test", "assets")
+
+cases = {
+    # name: (width, height, sar, square, mask_shapes)
+    "480p circ": (720, 480, 1, None, [dict(x0=45, y0=8, w=530, h=530)]),
+    "720p rect": (
+        1280,
+        720,
+        1,
+        None,
+        [dict(x0=160, y0=40, w=960, h=640, is_rect=True)],
+    ),
+    "720p rect+label": (
+        1280,
+        720,
+        1,
+        None,
+        [
+            dict(x0=160, y0=40, w=960, h=640, is_rect=True),
+            dict(x0=1000, y0=600, w=120, h=40, is_rect=True, fill_in=True),
+        ],
+    ),
+    "1080p circ, sar 8:9 upscale": (
+        1920,
+        1080,
+        tc.Fraction(8, 9),
+        "upscale",
+        [dict(x0=396, y0=82, w=1144, h=1017)],
+    ),
+}
+
+
+def legacy_args(src, width, height, sar, square, mask_shapes):
+    crop = tc.masks_to_crop(width, height, mask_shapes)
+    shapes = tc.adjust_masks(width, height, mask_shapes, sar, square, crop)
+    mask = tc.create_mask(width, height, shapes, "black")
+    fg = tc.form_vf(width, height, sar, "0:v", "1:v", square, crop)
+    return [(src, {}), (mask, {"f": "lavfi"})], fg
+
+
+def planned_args(src, width, height, sar, square, mask_shapes):
+    crop = tc.masks_to_crop(width, height, mask_shapes)
+    mask, fg = tc.form_filtergraph(
+        width, height, mask_shapes, sar, square, crop, pix_fmt="yuv420p"
+    )
+    if mask is None:
+        return [(src, {})], f"[0:v]{fg}[vout]"
+    return [(src, {}), (mask, {})], fg
+
+
+def run(inputs, fg, nloops, repeat=3):
+    # best of `repeat` runs
+    inputs[0][1]["stream_loop"] = nloops - 1
+    args = {
+        "inputs": inputs,
+        "outputs": [("-", {"map": "[vout]", "f": "null"})],
+        "global_options": {"filter_complex": fg},
+    }
+    elapsed = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        if ffmpegprocess.run(args, capture_log=True).returncode:
+            raise RuntimeError(f"FFmpeg failed: {fg}")
+        elapsed.append(perf_counter() - t0)
+    return min(elapsed)
+
+
+if __name__ == "__main__":
+    nloops = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    nframes = 30 * nloops  # colorchart assets: 30 frames each
+
+    print(f"{'case':<30}{'legacy fps':>12}{'planned fps':>13}{'speedup':>9}")
+    for name, (w, h, sar, square, shapes) in cases.items():
+        src = path.join(assets, f"colorchart_{w}x{h}.mp4")
+        t_old = run(*legacy_args(src, w, h, sar, square, shapes), nloops)
+        t_new = run(*planned_args(src, w, h, sar, square, shapes), nloops)
+        print(
+            f"{name:<30}{nframes/t_old:>12.1f}{nframes/t_new:>13.1f}{t_old/t_new:>8.2f}x"
+        )
@@ -0,0 +1,366 @@
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+from os import cpu_count, path, remove
+from subprocess import CompletedProcess
+from time import time
+import weakref
+
+from . import cache, configure, metrics, probe
+from .dedupe import find_duplicates
+from .transcode import (
+    form_transcode_args,
+    frame_map_file,
+    is_stream,
+    write_frame_map,
+)
+
+# seconds to wait for FFmpeg to exit after SIGTERM before killing it
+TERMINATE_TIMEOUT = 5.0
+
+_limit = None
+_semaphores = weakref.WeakKeyDictionary()  # event loop -> semaphore
+
+
+def set_concurrency_limit(limit):
+    """limit the number of concurrent FFmpeg/FFprobe subprocesses
+
+    The limit applies to all the async functions of this module which are not
+    given their own semaphore, separately in each event loop.
+
+    :param limit: maximum number of subprocesses, None for no limit
+    :type limit: int or None
+    """
+    global _limit
+    _limit = limit
+    _semaphores.clear()
+
+
+def _default_semaphore():
+    if _limit is None:
+        return None
+    loop = asyncio.get_running_loop()
+    sem = _semaphores.get(loop, None)
+    if sem is None:
+        sem = _semaphores[loop] = asyncio.Semaphore(_limit)
+    return sem
+
+
+@asynccontextmanager
+async def _limited(semaphore):
+    if semaphore is None:
+        semaphore = _default_semaphore()
+    if semaphore is None:
+        yield
+    else:
+        async with semaphore:
+            yield
+
+
+class _Command(Exception):
+    # carries the command line composed by ffmpegio out of its runner
+    pass
+
+
+def _capture(cmd, *args, **kwargs):
+    raise _Command(cmd)
+
+
+def ffmpeg_command(args, overwrite=None):
+    """compose the FFmpeg command line like ffmpegio.ffmpegprocess.run()
+
+    :param args: FFmpeg arguments
+    :type args: dict
+    :param overwrite: True to overwrite the output, defaults to None
+    :type overwrite: bool, optional
+    :return: command line
+    :rtype: list of str
+    """
+    from ffmpegio import ffmpegprocess
+
+    return list(
+        ffmpegprocess.exec(
+            args, overwrite=overwrite, capture_log=True, sp_run=lambda cmd, **_: cmd
+        )
+    )
+
+
+async def _terminate(proc):
+    # stop FFmpeg cleanly: SIGTERM lets it finalize the output, then kill
+    if proc.returncode is not None:
+        return
+    try:
+        proc.terminate()
+        await asyncio.wait_for(proc.wait(), TERMINATE_TIMEOUT)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+
+
+async def probe_video(url, semaphore=None):
+    """asynchronous cache.video_streams_basic()
+
+    :param url: video file
+    :type url: str
+    :param semaphore: concurrency limit, defaults to None (module default)
+    :type semaphore: asyncio.Semaphore, optional
+    :return: list of video stream information
+    :rtype: list of dicts
+    """
+    from ffmpegio import probe as ffprobe
+
+    db = cache.get_probe_cache()
+    if db is not None and path.isfile(url):
+        try:
+            info = db.get(url)
+            if info is not None:
+                return info
+        except Exception as e:
+            logging.warning(f"probe cache failed: {e}")
+
+    # let ffmpegio compose the FFprobe command, run it here, and let ffmpegio
+    # parse its output
+    try:
+        ffprobe.video_streams_basic(url, sp_kwargs={"sp_run": _capture})
+        raise RuntimeError("failed to compose the ffprobe command")
+    except _Command as e:
+        cmd = e.args[0]
+
+    async with _limited(semaphore):
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await proc.communicate()
+        finally:
+            await _terminate(proc)
+
+    ret = CompletedProcess(cmd, proc.returncode, stdout, stderr)
+    info = ffprobe.video_streams_basic(
+        url, sp_kwargs={"sp_run": lambda *args, **kwargs: ret}
+    )
+
+    if db is not None and path.isfile(url):
+        try:
+            db.put(url, info)
+        except Exception as e:
+            logging.warning(f"probe cache failed: {e}")
+    return info
+
+
+async def check_file_async(ctx, filepath, semaphore=None):
+    """asynchronous probe.check_file()
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param filepath: file to check
+    :type filepath: str
+    :param semaphore: concurrency limit, defaults to None (module default)
+    :type semaphore: asyncio.Semaphore, optional
+    :return: {"prof", "dst"}, both None if not a video with a profile
+    :rtype: dict
+    """
+    try:
+        info = (await probe_video(filepath, semaphore))[0]
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        return {"prof": None, "dst": None}
+    return probe.match_video(ctx, filepath, info)
+
+
+async def analyze_files_async(
+    ctx, paths, max_concurrency=None, dedupe=False, semaphore=None
+):
+    """asynchronous probe.analyze_files()
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param paths: files and directories to scan
+    :type paths: seq of str
+    :param max_concurrency: maximum number of concurrent probes, defaults to
+                            None (number of CPU cores, unless semaphore is given)
+    :type max_concurrency: int, optional
+    :param dedupe: True to mark identical videos (see probe.analyze_files()),
+                   defaults to False
+    :type dedupe: bool, optional
+    :param semaphore: concurrency limit shared with other tasks, defaults to None
+    :type semaphore: asyncio.Semaphore, optional
+    :return: matched videos {file: {"prof", "dst"}} and the option JSON files
+             {file: options}
+    :rtype: tuple of 2 dicts
+    """
+
+    def scan():
+        vid_files, json_files = [], []
+        for x in probe.iter_files(paths):
+            (vid_files, json_files)[x.endswith(".json")].append(x)
+        return vid_files, {f: configure.readOptionJSON(f) for f in json_files}
+
+    # walking the folders blocks: keep it off the event loop
+    vid_files, opts = await asyncio.to_thread(scan)
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max_concurrency or cpu_count() or 1)
+    results = await asyncio.gather(
+        *(check_file_async(ctx, f, semaphore) for f in vid_files)
+    )
+    files = {f: res for f, res in zip(vid_files, results) if res["prof"] is not None}
+
+    if dedupe:
+        dups = await asyncio.to_thread(find_duplicates, list(files))
+        for dup, orig in dups.items():
+            files[dup]["dup_of"] = orig
+
+    return files, opts
+
+
+def _progress_value(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+async def iter_transcode(
+    src, dst, src_info=None, overwrite=False, sidecar=None, semaphore=None, **kwargs
+):
+    """transcode a video asynchronously, yielding the FFmpeg progress
+
+    This is an async generator: iterate it to run the job. Each item is a
+    progress update of FFmpeg (e.g., "frame", "fps", "out_time_us", "speed",
+    and "progress" which is "end" in the last update). If the iteration is
+    cancelled or stopped early, FFmpeg is terminated and the partial output
+    file is removed.
+
+    :param src: input video file
+    :type src: str
+    :param dst: output video file
+    :type dst: str
+    :param src_info: video stream info of src, defaults to None (to probe)
+    :type src_info: dict, optional
+    :param overwrite: True to overwrite dst, defaults to False
+    :type overwrite: bool, optional
+    :param sidecar: see transcode(), defaults to None
+    :type sidecar: str or bool, optional
+    :param semaphore: concurrency limit, defaults to None (module default)
+    :type semaphore: asyncio.Semaphore, optional
+    :param **kwargs: other transcode() arguments (except progress)
+    :raises RuntimeError: if FFmpeg fails
+    :yield: progress update
+    :rtype: dict
+    """
+
+    if is_stream(src) or is_stream(dst):
+        raise ValueError("only files can be transcoded asynchronously")
+
+    if src_info is None:
+        try:
+            src_info = (await probe_video(src, semaphore))[0]
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            raise ValueError("not a video file")
+
+    if not overwrite and path.exists(dst):
+        raise RuntimeError(f"{dst} already exists")
+
+    args = form_transcode_args(src, dst, src_info, **kwargs)
+    args["global_options"]["progress"] = "pipe:1"
+    args["global_options"]["stats_period"] = 0.5
+
+    recorder = metrics.ProgressRecorder() if metrics.enabled() else None
+    if recorder is not None:
+        args["global_options"]["benchmark"] = None
+    cmd = ffmpeg_command(args, overwrite=True)
+
+    t0 = time()
+    log = []
+    error = None
+    started = False
+    async with _limited(semaphore):
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        started = True
+
+        async def read_log():
+            # drain stderr so FFmpeg never blocks on a full pipe
+            async for line in proc.stderr:
+                log.append(line.decode(errors="replace"))
+
+        log_task = asyncio.create_task(read_log())
+        try:
+            status = {}
+            async for line in proc.stdout:
+                key, sep, value = line.decode(errors="replace").strip().partition("=")
+                if not sep:
+                    continue
+                status[key] = _progress_value(value)
+                if key == "progress":
+                    if recorder is not None:
+                        recorder(status, value == "end")
+                    yield status
+                    status = {}
+            await proc.wait()
+            await log_task
+            if proc.returncode:
+                error = f"FFmpeg exited with {proc.returncode}"
+        except BaseException as e:
+            error = str(e) or type(e).__name__
+            raise
+        finally:
+            await _terminate(proc)
+            log_task.cancel()
+            if error and started and path.exists(dst):
+                remove(dst)
+            if recorder is not None:
+                metrics.emit(
+                    recorder.record("transcode", src, dst, t0, error, "".join(log))
+                )
+
+    if error:
+        raise RuntimeError("FFmpeg execution failed...")
+
+    decimate = kwargs.get("decimate", None)
+    if decimate and sidecar is not False:
+        await asyncio.to_thread(
+            write_frame_map,
+            dst,
+            sidecar or frame_map_file(dst),
+            src_info["frame_rate"],
+            kwargs.get("tstart", None),
+        )
+
+
+async def transcode_async(src, dst, progress=None, **kwargs):
+    """asynchronous transcode() of video files
+
+    Cancelling the task terminates FFmpeg and removes the partial output.
+
+    :param src: input video file
+    :type src: str
+    :param dst: output video file
+    :type dst: str
+    :param progress: function called with each progress update: progress(status,
+                     done), defaults to None
+    :type progress: Callable, optional
+    :param **kwargs: other iter_transcode() arguments
+    :raises RuntimeError: if FFmpeg fails
+    :return: output video file
+    :rtype: str
+    """
+    async for status in iter_transcode(src, dst, **kwargs):
+        if progress is not None:
+            progress(status, status.get("progress") == "end")
+    return dst
@@ -0,0 +1,655 @@
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from copy import deepcopy
+from fractions import Fraction
+import json
+import logging
+from os import cpu_count, link, makedirs, path, remove, replace
+from shutil import copy2
+from threading import Lock
+from time import perf_counter
+
+from . import cache, configure, metrics
+from .journal import Journal, config_hash
+from .plan import PLAN_INFO, TranscodePlan
+from .transcode import (
+    frame_map_file,
+    get_output_size,
+    masks_to_crop,
+    transcode_segments,
+)
+
+
+def profile_masks(spec, sar=1):
+    """convert the de-identification geometry of a profile to mask shapes
+
+    The ``circ`` entry of a profile, ``[x0, y0, diameter]``, and the ``rect``
+    entry, ``[x0, y0, w, h]``, of a rectangular field of view are defined on
+    the square-pixel frame (i.e., stretched in y if sar < 1 or in x if
+    sar > 1). This function maps them back onto the stored (non-square) frame.
+
+    :param spec: profile specification (2nd element of a profile entry)
+    :type spec: dict
+    :param sar: sample aspect ratio of the video, defaults to 1
+    :type sar: int or Fraction, optional
+    :return: mask shape specifications (keyword arguments for create_mask_alpha)
+    :rtype: list of dicts
+    """
+
+    if "circ" in spec:
+        x0, y0, dia = spec["circ"]
+        w = h = dia
+        is_rect = False
+    elif "rect" in spec:
+        x0, y0, w, h = spec["rect"]
+        is_rect = True
+    else:
+        return []
+
+    if sar < 1:
+        y0 *= sar
+        h *= sar
+    elif sar > 1:
+        x0 /= sar
+        w /= sar
+
+    shape = dict(x0=round(x0), y0=round(y0), w=round(w), h=round(h))
+    if is_rect:
+        shape["is_rect"] = True
+    return [shape]
+
+
+def job_options(ctx, prof, info):
+    """form transcode keyword arguments for a video
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param prof: name of the profile matched to the video
+    :type prof: str
+    :param info: video stream info of the video (ffmpegio.probe.video_streams_basic)
+    :type info: dict
+    :return: keyword arguments of transcode()
+    :rtype: dict
+    """
+
+    spec = configure.convert_inkscape(
+        deepcopy(ctx["Profiles"][prof][1]), info["height"]
+    )
+
+    sar = Fraction(*spec["sar"]) if "sar" in spec else info.get("sample_aspect_ratio")
+    sar = Fraction(sar or 1)
+
+    mask_shapes = profile_masks(spec, sar)
+
+    square = (
+        ("upscale" if ctx.get("Scaling", "up") == "up" else "downscale")
+        if ctx.get("SquarePixel", False)
+        else None
+    )
+
+    crop = (
+        masks_to_crop(info["width"], info["height"], mask_shapes)
+        if ctx.get("CropVideo", True) and len(mask_shapes)
+        else False
+    )
+
+    enc_config = {**ctx.get("OutputOptions", {})}
+    if not ctx.get("KeepAudio", True):
+        enc_config["an"] = None
+
+    return {
+        "mask_shapes": mask_shapes if ctx.get("ApplyMask", True) else None,
+        "sar": sar,
+        "square": square,
+        "crop": crop,
+        "enc_config": enc_config,
+        "overwrite": ctx.get("Overwrite", False),
+        "decimate": ctx.get("Decimate", False) or None,
+    }
+
+
+_plans = {}
+_plans_lock = Lock()
+_MAX_PLANS = 64
+
+
+def plan_key(ctx, prof, info):
+    """key of the transcode plan of a video
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param prof: name of the profile matched to the video
+    :type prof: str
+    :param info: video stream info of the video
+    :type info: dict
+    :return: JSON string of the profile geometry, the transcode options, and
+             the stream properties the plan depends on
+    :rtype: str
+    """
+    return json.dumps(
+        [
+            ctx["Profiles"][prof][1],
+            [ctx.get(k, None) for k in configure.OUTPUT_OPTIONS],
+            [str(info.get(k, None)) for k in PLAN_INFO],
+        ],
+        sort_keys=True,
+        default=str,
+    )
+
+
+def get_plan(ctx, prof, info):
+    """get the transcode plan of a video, compiling it once per geometry
+
+    Videos of the same profile with the same frame geometry and format share
+    a plan as long as the transcode options of the context are unchanged.
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param prof: name of the profile matched to the video
+    :type prof: str
+    :param info: video stream info of the video
+    :type info: dict
+    :return: compiled plan
+    :rtype: TranscodePlan
+    """
+
+    key = plan_key(ctx, prof, info)
+    with _plans_lock:
+        plan = _plans.get(key, None)
+    if plan is not None:
+        return plan
+
+    kwargs = job_options(ctx, prof, info)
+    kwargs.pop("overwrite")
+    plan = TranscodePlan(info, kwargs)
+    with _plans_lock:
+        if len(_plans) >= _MAX_PLANS:
+            _plans.pop(next(iter(_plans)))
+        plan = _plans.setdefault(key, plan)
+    return plan
+
+
+def partial_name(dst, tag=None):
+    """temporary file name of an output file while it is being written
+
+    :param dst: output video file
+    :type dst: str
+    :param tag: tag to tell apart the partial files of concurrent writers,
+                defaults to None
+    :type tag: str, optional
+    :return: dst with ".part" (or ".part-<tag>") inserted before its extension
+    :rtype: str
+    """
+    root, ext = path.splitext(dst)
+    return f"{root}.part{ext}" if tag is None else f"{root}.part-{tag}{ext}"
+
+
+def transcode_file(
+    ctx,
+    src,
+    prof,
+    dst,
+    src_info=None,
+    threads=None,
+    progress=None,
+    segments=None,
+    tmpfile=None,
+):
+    """transcode a video according to its profile in fluorofix context
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param src: input video file
+    :type src: str
+    :param prof: name of the profile matched to the video
+    :type prof: str
+    :param dst: output video file
+    :type dst: str
+    :param src_info: video stream info of src, defaults to None (to probe)
+    :type src_info: dict, optional
+    :param threads: number of threads FFmpeg may use, defaults to None (FFmpeg default)
+    :type threads: int, optional
+    :param progress: progress callback function (returns True to cancel),
+                     defaults to None
+    :type progress: Callable, optional
+    :param segments: number of segments to transcode in parallel (see
+                     transcode_segments()), defaults to None (single pass)
+    :type segments: int, optional
+    :param tmpfile: file to write before it is renamed to dst, defaults to None
+                    (partial_name(dst))
+    :type tmpfile: str, optional
+    :return: output video file
+    :rtype: str
+    """
+
+    if src_info is None:
+        try:
+            src_info = cache.video_streams_basic(src)[0]
+        except:
+            raise ValueError("not a video file")
+
+    plan = get_plan(ctx, prof, src_info)
+
+    dstdir = path.dirname(dst)
+    if dstdir:
+        makedirs(dstdir, exist_ok=True)
+
+    if not ctx.get("Overwrite", False) and path.exists(dst):
+        raise RuntimeError(f"{dst} already exists")
+
+    # write to a temporary file so a partial output never takes the name of dst
+    tmpfile = tmpfile or partial_name(dst)
+    sidecar = frame_map_file(dst) if plan.decimate else None
+    try:
+        if segments and segments > 1:
+            kwargs = deepcopy(plan.kwargs)
+            if threads:
+                kwargs["enc_config"]["threads"] = threads
+            transcode_segments(
+                src,
+                tmpfile,
+                segments,
+                src_info=src_info,
+                progress=progress,
+                overwrite=True,
+                sidecar=sidecar,
+                **kwargs,
+            )
+        else:
+            plan.run(
+                src,
+                tmpfile,
+                progress=progress,
+                overwrite=True,
+                threads=threads,
+                sidecar=sidecar,
+                frame_rate=src_info.get("frame_rate", None),
+            )
+        replace(tmpfile, dst)
+    except:
+        if path.exists(tmpfile):
+            remove(tmpfile)
+        raise
+
+    return dst
+
+
+def run_job(ctx, src, data, threads=None, progress=None, tmpfile=None):
+    """run a batch job and report its outcome (never raises)
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param src: input video file
+    :type src: str
+    :param data: analyze_files() entry of src: {"prof", "dst"}
+    :type data: dict
+    :param threads: number of threads FFmpeg may use, defaults to None
+    :type threads: int, optional
+    :param progress: progress callback function (returns True to cancel),
+                     defaults to None
+    :type progress: Callable, optional
+    :param tmpfile: file to write before it is renamed to the output file,
+                    defaults to None (partial_name())
+    :type tmpfile: str, optional
+    :return: job result: {"dst", "error", "elapsed", "skipped"}, error is None
+             if succeeded
+    :rtype: dict
+    """
+
+    t0 = perf_counter()
+    try:
+        dst = transcode_file(
+            ctx,
+            src,
+            data["prof"],
+            data["dst"],
+            threads=threads,
+            progress=progress,
+            tmpfile=tmpfile,
+        )
+        error = None
+    except Exception as e:
+        dst = data["dst"]
+        error = str(e) or type(e).__name__
+    return {
+        "dst": dst,
+        "error": error,
+        "elapsed": perf_counter() - t0,
+        "skipped": False,
+    }
+
+
+def link_duplicate(ctx, data, orig_result):
+    """produce the output of a duplicate video from the output of its original
+
+    The ``Duplicates`` option of the context selects how: "hardlink" (default,
+    falls back to copying across file systems), "copy", or "record" (no new
+    file; the result's "dst" points to the original's output).
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param data: analyze_files() entry of the duplicate: {"prof", "dst", "dup_of"}
+    :type data: dict
+    :param orig_result: job result of the original video
+    :type orig_result: dict
+    :return: job result: {"dst", "error", "elapsed", "skipped", "dup_of"}
+    :rtype: dict
+    """
+
+    t0 = perf_counter()
+    mode = ctx.get("Duplicates", "hardlink")
+    dst = data["dst"]
+    error = orig_result["error"] and f"{data['dup_of']} failed"
+    try:
+        if error:
+            pass
+        elif mode == "record":
+            dst = orig_result["dst"]
+        else:
+            if path.exists(dst):
+                if not ctx.get("Overwrite", False):
+                    raise RuntimeError(f"{dst} already exists")
+                remove(dst)
+            dstdir = path.dirname(dst)
+            if dstdir:
+                makedirs(dstdir, exist_ok=True)
+            try:
+                if mode != "hardlink":
+                    raise OSError
+                link(orig_result["dst"], dst)
+            except OSError:
+                copy2(orig_result["dst"], dst)
+    except Exception as e:
+        error = str(e) or type(e).__name__
+
+    return {
+        "dst": dst,
+        "error": error,
+        "elapsed": perf_counter() - t0,
+        "skipped": False,
+        "dup_of": data["dup_of"],
+    }
+
+
+def file_size(file):
+    """size of a file
+
+    :param file: file path
+    :type file: str
+    :return: size in bytes, 0 if not accessible
+    :rtype: int
+    """
+    try:
+        return path.getsize(file)
+    except OSError:
+        return 0
+
+
+# rough libx264 throughput (output pixels per CPU-second) of its presets
+ENCODE_RATES = {
+    "ultrafast": 120e6,
+    "superfast": 90e6,
+    "veryfast": 50e6,
+    "faster": 35e6,
+    "fast": 28e6,
+    "medium": 22e6,
+    "slow": 12e6,
+    "slower": 5e6,
+    "veryslow": 2.5e6,
+}
+
+
+def estimate_cost(width, height, frame_rate, duration, enc_config=None):
+    """roughly estimate the CPU time to encode a video
+
+    :param width: output frame width
+    :type width: int
+    :param height: output frame height
+    :type height: int
+    :param frame_rate: frame rate
+    :type frame_rate: Fraction or float
+    :param duration: duration in seconds
+    :type duration: float
+    :param enc_config: output options, defaults to None
+    :type enc_config: dict, optional
+    :return: estimated CPU-seconds or None if the duration is unknown
+    :rtype: float or None
+    """
+    if not duration:
+        return None
+    preset = (enc_config or {}).get("preset", "medium")
+    rate = ENCODE_RATES.get(preset, ENCODE_RATES["medium"])
+    return width * height * float(frame_rate or 30) * duration / rate
+
+
+def shared_outputs(ctx, files):
+    """find the output files which multiple jobs would write
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param files: video files to transcode, the first output of analyze_files()
+    :type files: dict
+    :return: absolute output paths mapped to their input files
+    :rtype: dict
+    """
+    dsts = {}
+    for src, data in files.items():
+        if not (data.get("dup_of", None) and ctx.get("Duplicates") == "record"):
+            dsts.setdefault(path.abspath(data["dst"]), []).append(src)
+    return {dst: srcs for dst, srcs in dsts.items() if len(srcs) > 1}
+
+
+def plan_batch(ctx, files):
+    """plan a batch run without transcoding (dry run)
+
+    Each job is planned from the (cached) probe of its source: the output frame
+    size, the crop, the estimated encoding cost, and any output collision:
+    "exists" if the output file exists and would not be overwritten, "shared"
+    if other jobs write the same output file, or None.
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param files: video files to transcode, the first output of analyze_files()
+    :type files: dict
+    :return: job plans keyed by the input file: {"prof", "dst", "input_size",
+             "output_size", "crop", "duration", "cost", "collision", "dup_of",
+             "error"}
+    :rtype: dict
+    """
+
+    shared = shared_outputs(ctx, files)
+
+    plans = {}
+    for src, data in files.items():
+        plan = {
+            "prof": data["prof"],
+            "dst": data["dst"],
+            "input_size": None,
+            "output_size": None,
+            "crop": None,
+            "duration": None,
+            "cost": None,
+            "collision": None,
+            "dup_of": data.get("dup_of", None),
+            "error": None,
+        }
+        plans[src] = plan
+
+        if path.abspath(data["dst"]) in shared:
+            plan["collision"] = "shared"
+        elif path.exists(data["dst"]) and not ctx.get("Overwrite", False):
+            plan["collision"] = "exists"
+
+        try:
+            info = cache.video_streams_basic(src)[0]
+            kwargs = job_options(ctx, data["prof"], info)
+        except Exception as e:
+            plan["error"] = str(e) or type(e).__name__
+            continue
+
+        width, height = info["width"], info["height"]
+        crop = kwargs["crop"] or None
+        outw, outh = get_output_size(
+            width, height, kwargs["sar"], kwargs["square"], crop
+        )
+        plan["input_size"] = (width, height)
+        plan["output_size"] = (outw, outh)
+        plan["crop"] = crop
+        plan["duration"] = info.get("duration", None)
+        if not plan["dup_of"]:
+            plan["cost"] = estimate_cost(
+                outw,
+                outh,
+                info.get("frame_rate", None),
+                plan["duration"],
+                kwargs["enc_config"],
+            )
+
+    return plans
+
+
+def run_batch(
+    ctx,
+    files,
+    max_workers=None,
+    threads=None,
+    use_processes=False,
+    largest_first=True,
+    callback=None,
+    journal=None,
+):
+    """transcode analyzed video files concurrently
+
+    A failed job does not abort the batch; its error message is reported in
+    the returned results instead. With a journal, the jobs which have been
+    completed with the current source file and configuration are skipped.
+    The videos marked as duplicates ("dup_of" item set by analyze_files()) are
+    not encoded but linked to their original's output after the other jobs
+    (see link_duplicate()).
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param files: video files to transcode, the first output of analyze_files()
+                  or an iterable of (file, data) pairs such as scan_files() (run
+                  in the order they arrive)
+    :type files: dict or iterable of tuples
+    :param max_workers: maximum number of concurrent jobs, defaults to None (a
+                        half of the CPU cores)
+    :type max_workers: int, optional
+    :param threads: number of threads each FFmpeg job may use, defaults to None
+                    (divide the CPU cores evenly among the jobs)
+    :type threads: int, optional
+    :param use_processes: True to run jobs on a process pool, defaults to False
+                          (thread pool)
+    :type use_processes: bool, optional
+    :param largest_first: True to start larger files first, defaults to True
+    :type largest_first: bool, optional
+    :param callback: function called as each job completes: callback(src, result),
+                     defaults to None
+    :type callback: Callable, optional
+    :param journal: job journal or its file path to resume the batch from,
+                    defaults to None (no journal)
+    :type journal: Journal or str, optional
+    :return: job results keyed by the input file: {"dst", "error", "elapsed",
+             "skipped"}
+    :rtype: dict
+    """
+
+    ncpus = cpu_count() or 1
+    if not max_workers:
+        max_workers = max(1, ncpus // 2)
+    if threads is None:
+        threads = max(1, ncpus // max_workers)
+
+    if isinstance(files, dict):
+        srcs = list(files)
+        if largest_first:
+            srcs.sort(key=file_size, reverse=True)
+        jobs = ((src, files[src]) for src in srcs)
+    else:
+        # stream of (src, data) pairs, e.g., from scan_files(), run as they come
+        jobs = iter(files)
+
+    Executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+
+    results = {}
+    duplicates = []
+
+    # batch-level progress records
+    if metrics.enabled():
+        if isinstance(files, dict):
+            ndups = sum(bool(data.get("dup_of", None)) for data in files.values())
+            callback = metrics.BatchProgress(len(files), callback, ndups)
+        else:
+            callback = metrics.BatchProgress(None, callback)
+
+    if isinstance(journal, str):
+        journal = Journal(journal)
+
+    def report(src, res):
+        if res["error"] is not None:
+            logging.warning(f"{src}: {res['error']}")
+        results[src] = res
+        if callback is not None:
+            callback(src, res)
+
+    def collect(done):
+        for future in done:
+            src, data = futures.pop(future)
+            try:
+                res = future.result()
+            except Exception as e:
+                # worker process died
+                res = {
+                    "dst": data["dst"],
+                    "error": str(e),
+                    "elapsed": None,
+                    "skipped": False,
+                }
+            if journal is not None:
+                journal.finish(src, res["error"])
+            report(src, res)
+
+    with Executor(max_workers=max_workers) as executor:
+        futures = {}
+        for src, data in jobs:
+            if journal is not None:
+                config = config_hash(ctx, data["prof"])
+                if journal.is_done(src, data["dst"], config):
+                    report(
+                        src,
+                        {
+                            "dst": data["dst"],
+                            "error": None,
+                            "elapsed": 0.0,
+                            "skipped": True,
+                        },
+                    )
+                    continue
+                journal.start(src, data["dst"], config)
+            if data.get("dup_of", None):
+                duplicates.append((src, data))
+                continue
+            if len(futures) >= 2 * max_workers:
+                collect(wait(futures, return_when=FIRST_COMPLETED)[0])
+            futures[executor.submit(run_job, ctx, src, data, threads)] = (src, data)
+        collect(as_completed(list(futures)))
+
+    # duplicate videos reuse the outputs of their originals
+    for src, data in duplicates:
+        orig = results.get(data["dup_of"], None)
+        res = (
+            run_job(ctx, src, data, threads)
+            if orig is None
+            else link_duplicate(ctx, data, orig)
+        )
+        if journal is not None:
+            journal.finish(src, res["error"])
+        report(src, res)
+
+    return results
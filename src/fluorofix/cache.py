@@ -0,0 +1,294 @@
+from fractions import Fraction
+import json
+import logging
+from os import environ, getpid, makedirs, path, stat
+import sqlite3
+from threading import Lock
+from time import time
+
+from . import metrics
+
+
+def cache_dir():
+    """get the folder to store fluorofix cache files
+
+    :return: FLUOROFIX_CACHE_DIR environmental variable if set, otherwise the
+             "fluorofix" folder in the user's cache folder
+    :rtype: str
+    """
+    d = environ.get("FLUOROFIX_CACHE_DIR", None)
+    if not d:
+        base = environ.get("LOCALAPPDATA", None) or environ.get("XDG_CACHE_HOME", None)
+        d = path.join(base or path.join(path.expanduser("~"), ".cache"), "fluorofix")
+    return d
+
+
+def encode_fraction(obj):
+    """JSON encoder hook (json.dumps default) of Fraction values
+
+    :param obj: object which json cannot serialize
+    :type obj: any
+    :raises TypeError: if not a Fraction
+    :return: {"__fraction__": [numerator, denominator]}
+    :rtype: dict
+    """
+    if isinstance(obj, Fraction):
+        return {"__fraction__": [obj.numerator, obj.denominator]}
+    raise TypeError(f"{type(obj)} is not JSON serializable")
+
+
+def decode_fraction(d):
+    """JSON decoder hook (json.loads object_hook) of encode_fraction() output
+
+    :param d: decoded JSON object
+    :type d: dict
+    :return: Fraction if d encodes one, otherwise d
+    :rtype: Fraction or dict
+    """
+    try:
+        return Fraction(*d["__fraction__"])
+    except KeyError:
+        return d
+
+
+class ProbeCache:
+    """on-disk cache of FFprobe video stream info
+
+    Each entry is keyed by the absolute path of the file, and it is valid only
+    while the file retains the size and modification time it had when probed.
+    The least recently used entries are evicted once the number of entries
+    exceeds `max_entries`. The access times of cache hits are recorded in
+    memory and written in batches (every `ATIME_BATCH` hits, before eviction,
+    and on close()).
+
+    :param filename: SQLite database file, defaults to None ("probe.sqlite" in cache_dir())
+    :type filename: str, optional
+    :param max_entries: maximum number of cached files, defaults to 100000
+    :type max_entries: int, optional
+    """
+
+    ATIME_BATCH = 1000
+
+    def __init__(self, filename=None, max_entries=100000):
+        if filename is None:
+            filename = path.join(cache_dir(), "probe.sqlite")
+        self.filename = filename
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._db = None
+        self._pid = None
+        self._nput = 0
+        self._atimes = {}
+
+    def __getstate__(self):
+        return {"filename": self.filename, "max_entries": self.max_entries}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connect(self):
+        # (re)connect if first use or in a forked process
+        if self._db is None or self._pid != getpid():
+            if self.filename != ":memory:":
+                makedirs(path.dirname(path.abspath(self.filename)), exist_ok=True)
+            self._db = sqlite3.connect(
+                self.filename, timeout=30, check_same_thread=False
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS probe (path TEXT PRIMARY KEY, "
+                "size INTEGER, mtime INTEGER, info TEXT, atime REAL)"
+            )
+            self._db.commit()
+            self._pid = getpid()
+        return self._db
+
+    def _flush_atimes(self, db):
+        if self._atimes:
+            db.executemany(
+                "UPDATE probe SET atime=? WHERE path=?",
+                [(t, p) for p, t in self._atimes.items()],
+            )
+            db.commit()
+            self._atimes = {}
+
+    def close(self):
+        """write the pending access times and close the database connection"""
+        with self._lock:
+            if self._db is not None and self._pid == getpid():
+                self._flush_atimes(self._db)
+                self._db.close()
+            self._db = None
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM probe").fetchone()[0]
+
+    def get(self, filepath):
+        """get cached video stream info
+
+        :param filepath: path of the video file
+        :type filepath: str
+        :return: cached info or None if not cached or if the file has changed
+        :rtype: list of dicts or None
+        """
+        filepath = path.abspath(filepath)
+        st = stat(filepath)
+        with self._lock:
+            db = self._connect()
+            row = db.execute(
+                "SELECT size, mtime, info FROM probe WHERE path=?", (filepath,)
+            ).fetchone()
+            if row is None or row[:2] != (st.st_size, st.st_mtime_ns):
+                return None
+            self._atimes[filepath] = time()
+            if len(self._atimes) >= self.ATIME_BATCH:
+                self._flush_atimes(db)
+        return json.loads(row[2], object_hook=decode_fraction)
+
+    def put(self, filepath, info):
+        """cache video stream info
+
+        :param filepath: path of the video file
+        :type filepath: str
+        :param info: video stream info
+        :type info: list of dicts
+        """
+        filepath = path.abspath(filepath)
+        st = stat(filepath)
+        data = json.dumps(info, default=encode_fraction)
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO probe VALUES (?,?,?,?,?)",
+                (filepath, st.st_size, st.st_mtime_ns, data, time()),
+            )
+            db.commit()
+            self._nput += 1
+            if self._nput >= max(1, self.max_entries // 100):
+                self._nput = 0
+                self._evict(db)
+
+    def _evict(self, db):
+        self._flush_atimes(db)
+        n = db.execute("SELECT COUNT(*) FROM probe").fetchone()[0] - self.max_entries
+        if n > 0:
+            db.execute(
+                "DELETE FROM probe WHERE path IN "
+                "(SELECT path FROM probe ORDER BY atime LIMIT ?)",
+                (n,),
+            )
+            db.commit()
+
+    def invalidate(self, filepath=None):
+        """remove cached entries
+
+        :param filepath: file or folder to invalidate, defaults to None (everything)
+        :type filepath: str, optional
+        """
+        with self._lock:
+            db = self._connect()
+            if filepath is None:
+                db.execute("DELETE FROM probe")
+            else:
+                filepath = path.abspath(filepath)
+                prefix = path.join(filepath, "")
+                db.execute(
+                    "DELETE FROM probe WHERE path=? OR substr(path,1,?)=?",
+                    (filepath, len(prefix), prefix),
+                )
+            db.commit()
+
+
+_probe_cache = None
+
+
+def enable_probe_cache(filename=None, max_entries=100000):
+    """enable the persistent probe cache
+
+    :param filename: SQLite database file, defaults to None ("probe.sqlite" in cache_dir())
+    :type filename: str, optional
+    :param max_entries: maximum number of cached files, defaults to 100000
+    :type max_entries: int, optional
+    :return: the activated cache
+    :rtype: ProbeCache
+    """
+    global _probe_cache
+    disable_probe_cache()
+    _probe_cache = ProbeCache(filename, max_entries)
+    return _probe_cache
+
+
+def disable_probe_cache():
+    """disable the persistent probe cache"""
+    global _probe_cache
+    if _probe_cache is not None:
+        _probe_cache.close()
+    _probe_cache = None
+
+
+def get_probe_cache():
+    """get the active probe cache
+
+    :return: the active cache or None if disabled
+    :rtype: ProbeCache or None
+    """
+    return _probe_cache
+
+
+def _video_streams_basic(url):
+    # returns the info and whether it came from the cache
+    from ffmpegio import probe
+
+    cache = _probe_cache
+    if cache is None or not path.isfile(url):
+        return probe.video_streams_basic(url), False
+
+    try:
+        info = cache.get(url)
+    except Exception as e:
+        logging.warning(f"probe cache failed: {e}")
+        return probe.video_streams_basic(url), False
+
+    if info is not None:
+        return info, True
+
+    info = probe.video_streams_basic(url)
+    try:
+        cache.put(url, info)
+    except Exception as e:
+        logging.warning(f"probe cache failed: {e}")
+
+    return info, False
+
+
+def video_streams_basic(url):
+    """retrieve basic info of video streams, through the probe cache if enabled
+
+    :param url: URL of the media file
+    :type url: str
+    :return: list of video stream information (see ffmpegio.probe.video_streams_basic)
+    :rtype: list of dicts
+    """
+
+    if not metrics.enabled():
+        return _video_streams_basic(url)[0]
+
+    t0 = time()
+    info, cached, error = None, False, None
+    try:
+        info, cached = _video_streams_basic(url)
+        return info
+    except Exception as e:
+        error = str(e) or type(e).__name__
+        raise
+    finally:
+        metrics.emit(
+            {
+                "event": "probe",
+                "src": url,
+                "start": t0,
+                "wall_time": time() - t0,
+                "cached": cached,
+                "error": error,
+            }
+        )
@@ -0,0 +1,616 @@
+import argparse
+import json
+import logging
+from os import cpu_count, path
+import sys
+
+from . import __version__, cache, configure, metrics, probe
+from .batch import plan_batch, run_batch, shared_outputs
+from .fov import detect_fov, fov_profile
+from .jobqueue import QueueWorker, coordinate, open_queue
+from .journal import Journal
+from .qa import contact_sheets
+from .watch import WatchDaemon
+
+
+def load_context(config=None, overrides=()):
+    """load the fluorofix context
+
+    :param config: option JSON file to merge onto the default options,
+                   defaults to None
+    :type config: str, optional
+    :param overrides: options (e.g., from option JSON files found in the input
+                      folders) to merge in order, defaults to ()
+    :type overrides: seq of dicts, optional
+    :return: validated fluorofix context
+    :rtype: dict
+    """
+    ctx = configure.defaultOption()
+    if config:
+        ctx = configure.readOptionJSON(config, ctx)
+    for opts in overrides:
+        ctx = configure.mergeOptionJSON(opts, ctx)
+    configure.validateOptions(ctx)
+    return ctx
+
+
+def format_seconds(secs):
+    """format a duration as [h:]mm:ss
+
+    :param secs: duration in seconds
+    :type secs: float or None
+    :rtype: str
+    """
+    if secs is None:
+        return "?"
+    m, s = divmod(round(secs), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
+
+def print_plan(plans, max_workers=None, file=None):
+    """print the dry-run plan of a batch run
+
+    :param plans: plan_batch() output
+    :type plans: dict
+    :param max_workers: number of concurrent jobs, defaults to None
+    :type max_workers: int, optional
+    :param file: output stream, defaults to None (sys.stdout)
+    :type file: file-like, optional
+    :return: number of jobs with an output collision or an error
+    :rtype: int
+    """
+
+    file = file or sys.stdout
+    nbad = 0
+    total_cost = total_duration = 0.0
+    for src, plan in sorted(plans.items()):
+        print(f"{src}\n  -> {plan['dst']}", file=file)
+        if plan["error"]:
+            print(f"  ERROR: {plan['error']}", file=file)
+            nbad += 1
+            continue
+
+        (w, h), (outw, outh) = plan["input_size"], plan["output_size"]
+        details = [f"profile: {plan['prof']}", f"{w}x{h} -> {outw}x{outh}"]
+        if plan["crop"]:
+            x, y, cw, ch = plan["crop"]
+            details.append(f"crop {cw}x{ch}+{x}+{y}")
+        details.append(f"duration {format_seconds(plan['duration'])}")
+        if plan["dup_of"]:
+            details.append(f"duplicate of {plan['dup_of']}")
+        else:
+            details.append(f"est. {format_seconds(plan['cost'])} CPU")
+        print(f"  {', '.join(details)}", file=file)
+
+        if plan["collision"] == "shared":
+            print("  COLLISION: other jobs write the same output file", file=file)
+        elif plan["collision"] == "exists":
+            print("  COLLISION: output file exists (not overwritten)", file=file)
+        nbad += plan["collision"] is not None
+
+        total_cost += plan["cost"] or 0.0
+        total_duration += plan["duration"] or 0.0
+
+    ncpus = cpu_count() or 1
+    print(
+        f"\n{len(plans)} file(s), {format_seconds(total_duration)} of video, "
+        f"est. {format_seconds(total_cost)} CPU time "
+        f"(~{format_seconds(total_cost / ncpus)} on {ncpus} cores), "
+        f"{nbad} problem(s)",
+        file=file,
+    )
+    if max_workers:
+        print(f"{max_workers} concurrent job(s)", file=file)
+    return nbad
+
+
+def create_parser():
+    """create the command-line argument parser
+
+    :rtype: argparse.ArgumentParser
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="fluorofix",
+        description="Correct the pixel aspect ratio of and de-identify "
+        "videofluoroscopic recordings.",
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="video files and folders to process (option JSON files found in "
+        "the folders are applied in path order)",
+    )
+    parser.add_argument("-c", "--config", help="option JSON file")
+    parser.add_argument("-o", "--output-folder", help="output folder")
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="print the plan of the batch run without transcoding",
+    )
+    parser.add_argument(
+        "--qa",
+        metavar="FOLDER",
+        default=None,
+        help="render the de-identification QA contact sheets (keyframes before "
+        "and after masking) in FOLDER instead of transcoding",
+    )
+    parser.add_argument(
+        "--detect-fov",
+        action="store_true",
+        help="detect the field of view of the videos and print their profiles "
+        "as an option JSON instead of transcoding",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of concurrent jobs (default: a half of the CPU cores)",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="number of FFmpeg threads per job"
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="overwrite existing output files"
+    )
+    parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="encode identical source videos only once",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the jobs completed by a previous run (journaled in the "
+        "output folder)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep watching the input folders and process new videos as they "
+        "are written",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=5.0,
+        help="seconds a new file must stay unchanged before it is processed "
+        "in watch mode (default: 5)",
+    )
+    parser.add_argument(
+        "--polling",
+        action="store_true",
+        help="poll the watched folders instead of using inotify",
+    )
+    parser.add_argument(
+        "--queue",
+        metavar="URL",
+        default=None,
+        help="distribute the jobs through a job queue: an SQLite file on storage "
+        "shared by the nodes or a redis:// URL. Queues the videos and reports the "
+        "progress of the workers until all the jobs have finished",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="run the jobs of --queue on this node until the queue is drained "
+        "(the options are those of the run which queued the jobs)",
+    )
+    parser.add_argument(
+        "--node",
+        default=None,
+        help="node name reported by the queue worker (default: host name)",
+    )
+    parser.add_argument(
+        "--lease",
+        type=float,
+        default=60.0,
+        help="seconds a queue worker holds a job without a heartbeat before it "
+        "is retried elsewhere (default: 60)",
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        metavar="PATH",
+        default=None,
+        help="append the metrics records (jobs, probes, batch and watch "
+        "progress) to a JSON-lines file",
+    )
+    parser.add_argument(
+        "--prometheus",
+        metavar="PATH",
+        default=None,
+        help="export the metrics as a Prometheus text file (for the textfile "
+        "collector of the node exporter)",
+    )
+    parser.add_argument(
+        "--probe-cache",
+        default=None,
+        help="probe cache database file (default: in the user cache folder)",
+    )
+    parser.add_argument(
+        "--no-probe-cache", action="store_true", help="disable the probe cache"
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="only print warnings and errors"
+    )
+    parser.add_argument(
+        "--version", action="version", version=f"%(prog)s {__version__}"
+    )
+    return parser
+
+
+def _apply_args(ctx, args):
+    if args.output_folder:
+        ctx["OutputFolder"] = args.output_folder
+    if args.overwrite:
+        ctx["Overwrite"] = True
+    return ctx
+
+
+def add_metrics_sinks(args):
+    """register the metrics sinks requested on the command line
+
+    :param args: parsed command-line arguments
+    :type args: argparse.Namespace
+    :return: registered sinks
+    :rtype: list of Callable
+    """
+    sinks = []
+    if args.metrics_jsonl:
+        sinks.append(metrics.add_sink(metrics.JSONLinesSink(args.metrics_jsonl)))
+    if args.prometheus:
+        sinks.append(metrics.add_sink(metrics.PrometheusSink(args.prometheus)))
+    return sinks
+
+
+def remove_metrics_sinks(sinks):
+    """unregister the sinks of add_metrics_sinks() and write the final metrics
+
+    :param sinks: add_metrics_sinks() output
+    :type sinks: list of Callable
+    """
+    for sink in sinks:
+        metrics.remove_sink(sink)
+        if isinstance(sink, metrics.PrometheusSink):
+            sink.flush()
+
+
+def watch(ctx, args):
+    """run the watch-folder daemon until interrupted
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param args: parsed command-line arguments
+    :type args: argparse.Namespace
+    :return: exit status
+    :rtype: int
+    """
+
+    folders = [p for p in args.paths if path.isdir(p)]
+    if len(folders) != len(args.paths):
+        logging.error("only folders can be watched")
+        return 2
+
+    journal = None
+    if args.resume:
+        journal = Journal.for_folder(ctx.get("OutputFolder", None) or folders[0])
+
+    def report(src, res):
+        status = "done" if res["error"] is None else f"failed: {res['error']}"
+        print(f"{src}: {status}", flush=True)
+
+    daemon = WatchDaemon(
+        ctx,
+        folders,
+        max_workers=args.jobs,
+        threads=args.threads,
+        settle=args.settle,
+        journal=journal,
+        polling=args.polling,
+        callback=report,
+    )
+    print(f"Watching {', '.join(folders)} (Ctrl+C to stop)", flush=True)
+    try:
+        daemon.run()
+    finally:
+        if journal is not None:
+            journal.close()
+    return 0
+
+
+def qa_sheets(ctx, files, args):
+    """render the QA contact sheets of the videos
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param files: analyze_files() output
+    :type files: dict
+    :param args: parsed command-line arguments
+    :type args: argparse.Namespace
+    :return: exit status
+    :rtype: int
+    """
+
+    sheets, pages = contact_sheets(ctx, files, args.qa, max_workers=args.jobs)
+    nfailed = sum(sheet is None for sheet in sheets.values())
+    for src, sheet in sorted(sheets.items()):
+        print(f"{src}\n  -> {sheet or 'FAILED'}")
+    for page in pages:
+        print(f"batch sheet: {page}")
+    print(f"\n{len(sheets) - nfailed} sheet(s), {nfailed} failed")
+    return 1 if nfailed else 0
+
+
+def print_queue_status(counts, nodes, file=None):
+    """print the progress of a job queue
+
+    :param counts: queue_counts() output
+    :type counts: dict
+    :param nodes: node_stats() output
+    :type nodes: dict
+    :param file: output stream, defaults to None (sys.stdout)
+    :type file: file-like, optional
+    """
+
+    file = file or sys.stdout
+    print(
+        f"queued: {counts['queued']}, running: {counts['leased']}, "
+        f"done: {counts['done']}, failed: {counts['failed']}",
+        file=file,
+    )
+    if nodes:
+        print(
+            f"  {'node':<24} {'done':>6} {'failed':>6} {'active':>6} "
+            f"{'jobs/h':>8} {'MB/s':>8}",
+            file=file,
+        )
+    for node, s in sorted(nodes.items()):
+        rate = "-" if s["jobs_per_hour"] is None else f"{s['jobs_per_hour']:.1f}"
+        mbps = "-" if s["bytes_per_sec"] is None else f"{s['bytes_per_sec'] / 1e6:.2f}"
+        print(
+            f"  {node:<24} {s['done']:>6} {s['failed']:>6} {s['active']:>6} "
+            f"{rate:>8} {mbps:>8}",
+            file=file,
+        )
+    file.flush()
+
+
+def queue_jobs(ctx, files, args):
+    """queue the videos and report the progress of the queue workers
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param files: analyze_files() output
+    :type files: dict
+    :param args: parsed command-line arguments
+    :type args: argparse.Namespace
+    :return: exit status
+    :rtype: int
+    """
+
+    last = None
+
+    def report(counts, nodes):
+        nonlocal last
+        if counts != last:
+            print_queue_status(counts, nodes)
+            last = counts
+
+    queue = open_queue(args.queue)
+    try:
+        nqueued, counts, _ = coordinate(queue, ctx, files, callback=report)
+        failed = [job for job in queue.jobs() if job["status"] == "failed"]
+    except KeyboardInterrupt:
+        print("Stopped monitoring: the queued jobs remain in the queue")
+        return 0
+    finally:
+        queue.close()
+
+    print(f"\n{nqueued} job(s) queued in this run")
+    for job in failed:
+        print(f"{job['src']}: failed on {job['node']}: {job['error']}")
+    return 1 if counts["failed"] else 0
+
+
+def queue_worker(args):
+    """run the jobs of a job queue on this node until the queue is drained
+
+    :param args: parsed command-line arguments
+    :type args: argparse.Namespace
+    :return: exit status
+    :rtype: int
+    """
+
+    def report(job, res):
+        status = "done" if res["error"] is None else f"failed: {res['error']}"
+        print(f"{job['src']} (attempt {job['attempts']}): {status}", flush=True)
+
+    queue = open_queue(args.queue)
+    worker = QueueWorker(
+        queue,
+        node=args.node,
+        max_workers=args.jobs,
+        threads=args.threads,
+        lease=args.lease,
+        callback=report,
+    )
+    print(f"Worker {worker.node} running the jobs of {args.queue}", flush=True)
+    try:
+        worker.run()
+    except RuntimeError as e:
+        logging.error(e)
+        return 2
+    finally:
+        queue.close()
+    print(f"\n{worker.processed} job(s) run, {worker.failed} failed")
+    return 1 if worker.failed else 0
+
+
+def print_fov_profiles(paths, file=None):
+    """detect the field of view of videos and print their profiles
+
+    :param paths: video files and folders
+    :type paths: seq of str
+    :param file: output stream, defaults to None (sys.stdout)
+    :type file: file-like, optional
+    :return: exit status
+    :rtype: int
+    """
+
+    profiles = {}
+    nfailed = 0
+    for src in probe.iter_files(paths):
+        if src.endswith(".json"):
+            continue
+        try:
+            info = cache.video_streams_basic(src)[0]
+        except:
+            continue  # not a video file
+        try:
+            fov = detect_fov(src, info)
+        except Exception as e:
+            logging.error(f"{src}: {e}")
+            nfailed += 1
+            continue
+
+        logging.info(f"{src}: {fov['shape']} field of view (score {fov['score']:.3f})")
+        entry = fov_profile(fov, info)
+        name = base = f"auto {info['width']}x{info['height']}"
+        i = 1
+        while name in profiles and profiles[name] != entry:
+            i += 1
+            name = f"{base} ({i})"
+        profiles[name] = entry
+
+    print(json.dumps({"Profiles": profiles}, indent=2), file=file or sys.stdout)
+    return 1 if nfailed else 0
+
+
+def main(argv=None):
+    """run fluorofix from the command line
+
+    :param argv: command-line arguments, defaults to None (sys.argv[1:])
+    :type argv: seq of str, optional
+    :return: exit status: 0 if succeeded, 1 if any job failed (or has a
+             problem in dry run), 2 if the batch was not started
+    :rtype: int
+    """
+
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    if args.watch and (args.dry_run or args.qa or args.detect_fov or args.queue):
+        parser.error(
+            "--watch cannot be used with --dry-run, --qa, --detect-fov, or --queue"
+        )
+    if args.worker and not args.queue:
+        parser.error("--worker requires --queue")
+    if not (args.paths or args.worker):
+        parser.error("the following arguments are required: paths")
+    logging.basicConfig(
+        level=logging.WARNING if args.quiet else logging.INFO,
+        format="%(levelname)s: %(message)s",
+    )
+
+    try:
+        sinks = add_metrics_sinks(args)
+    except OSError as e:
+        logging.error(f"cannot write the metrics: {e}")
+        return 2
+
+    if not args.no_probe_cache:
+        try:
+            cache.enable_probe_cache(args.probe_cache)
+        except Exception as e:
+            logging.warning(f"probe cache disabled: {e}")
+
+    try:
+        if args.worker:
+            try:
+                return queue_worker(args)
+            except (OSError, ImportError) as e:
+                logging.error(e)
+                return 2
+
+        if args.detect_fov:
+            return print_fov_profiles(args.paths)
+
+        try:
+            ctx = _apply_args(load_context(args.config), args)
+            if args.watch:
+                return watch(ctx, args)
+            vid_files, opts = probe.find_files(args.paths)
+            if opts:
+                # match the videos with the option files found in the inputs
+                overrides = [opts[f] for f in sorted(opts)]
+                ctx = _apply_args(load_context(args.config, overrides), args)
+            files = probe.match_files(ctx, vid_files, args.jobs, args.dedupe)
+        except (OSError, ValueError) as e:
+            logging.error(e)
+            return 2
+
+        if not files:
+            print("No video files to process.")
+            return 0
+
+        if args.dry_run:
+            return 1 if print_plan(plan_batch(ctx, files), args.jobs) else 0
+
+        if args.qa:
+            return qa_sheets(ctx, files, args)
+
+        shared = shared_outputs(ctx, files)
+        if shared:
+            for dst, srcs in shared.items():
+                logging.error(f"{dst} would be written by {', '.join(srcs)}")
+            return 2
+
+        if args.queue:
+            try:
+                return queue_jobs(ctx, files, args)
+            except (OSError, ImportError) as e:
+                logging.error(e)
+                return 2
+
+        journal = None
+        if args.resume:
+            folder = ctx.get("OutputFolder", None) or path.commonpath(
+                [path.dirname(path.abspath(d["dst"])) for d in files.values()]
+            )
+            journal = Journal.for_folder(folder)
+
+        n = len(files)
+        ndone = 0
+
+        def report(src, res):
+            nonlocal ndone
+            ndone += 1
+            if res["skipped"]:
+                status = "skipped (already done)"
+            elif res["error"] is None:
+                status = f"done in {format_seconds(res['elapsed'])}"
+            else:
+                status = f"failed: {res['error']}"
+            print(f"({ndone}/{n}) {src}: {status}", flush=True)
+
+        try:
+            results = run_batch(
+                ctx,
+                files,
+                max_workers=args.jobs,
+                threads=args.threads,
+                callback=report,
+                journal=journal,
+            )
+        finally:
+            if journal is not None:
+                journal.close()
+
+        nfailed = sum(res["error"] is not None for res in results.values())
+        print(f"\n{n - nfailed} succeeded, {nfailed} failed")
+        return 1 if nfailed else 0
+    finally:
+        cache.disable_probe_cache()
+        remove_metrics_sinks(sinks)
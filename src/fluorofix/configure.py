@@ -1,7 +1,24 @@
 from copy import deepcopy
+import hashlib
 import itertools
 import json
-import cerberus
+import logging
+from os import getpid, makedirs, path, replace
+from threading import Lock
+
+from .cache import cache_dir
+from .profiles import compile_matcher
+
+# context options which affect the output video
+OUTPUT_OPTIONS = (
+    "SquarePixel",
+    "Scaling",
+    "CropVideo",
+    "ApplyMask",
+    "KeepAudio",
+    "OutputOptions",
+    "Decimate",
+)
 
 
 def writeOptionJSON(filename, ctx):
@@ -60,65 +77,211 @@ def defaultOption():
         "OutputExt": ".mp4",
         "OutputOptions": {"preset": "slow", "crf": 18, "pix_fmt": "yuv420p"},
         "Overwrite": False,
+        "Duplicates": "hardlink",
+        "Decimate": False,
     }
 
 
-def validateOptions(ctx):
+def _option_schema():
     pos_int = {"type": "integer", "min": 0}
     pos_real = {"type": "float", "min": 0}
-    v = cerberus.Validator(
-        {
-            "Profiles": {
-                "type": "dict",
-                "keysrules": {"type": "string"},
-                "valuesrules": {
-                    "type": "list",
-                    "items": [
-                        {"type": "dict", "keysrules": {"type": "string"}},
-                        {
-                            "type": "dict",
-                            "schema": {
-                                "sar": {
-                                    "type": "list",
-                                    "items": [pos_int, pos_int],
-                                },
-                                "circ": {
-                                    "type": "list",
-                                    "items": [pos_int, pos_int, pos_int],
-                                },
-                                "inkscape-page": {
-                                    "type": "list",
-                                    "items": [pos_real, pos_real],
-                                },
-                                "inkscape-circ": {
-                                    "type": "list",
-                                    "items": [
-                                        {"type": "float"},
-                                        {"type": "float"},
-                                        pos_real,
-                                        pos_real,
-                                    ],
-                                },
+    return {
+        "Profiles": {
+            "type": "dict",
+            "keysrules": {"type": "string"},
+            "valuesrules": {
+                "type": "list",
+                "items": [
+                    {"type": "dict", "keysrules": {"type": "string"}},
+                    {
+                        "type": "dict",
+                        "schema": {
+                            "sar": {
+                                "type": "list",
+                                "items": [pos_int, pos_int],
+                            },
+                            # the field of view may extend beyond the frame
+                            "circ": {
+                                "type": "list",
+                                "items": [
+                                    {"type": "integer"},
+                                    {"type": "integer"},
+                                    pos_int,
+                                ],
+                            },
+                            "rect": {
+                                "type": "list",
+                                "items": [
+                                    {"type": "integer"},
+                                    {"type": "integer"},
+                                    pos_int,
+                                    pos_int,
+                                ],
+                            },
+                            "inkscape-page": {
+                                "type": "list",
+                                "items": [pos_real, pos_real],
+                            },
+                            "inkscape-circ": {
+                                "type": "list",
+                                "items": [
+                                    {"type": "float"},
+                                    {"type": "float"},
+                                    pos_real,
+                                    pos_real,
+                                ],
                             },
                         },
-                    ],
-                },
-                "empty": False,
+                    },
+                ],
             },
-            "SquarePixel": {"type": "boolean"},
-            "Scaling": {"type": "string", "allowed": ["up", "down"]},
-            "CropVideo": {"type": "boolean"},
-            "ApplyMask": {"type": "boolean"},
-            "KeepAudio": {"type": "boolean"},
-            "OutputFolder": {"type": "string", "nullable": True, "empty": True},
-            "OutputSuffix": {"type": "string", "empty": True},
-            "OutputExt": {"type": "string", "empty": False},
-            "OutputOptions": {"type": "dict"},
-            "Overwrite": {"type": "boolean", "empty": False},
-        }
+            "empty": False,
+        },
+        "SquarePixel": {"type": "boolean"},
+        "Scaling": {"type": "string", "allowed": ["up", "down"]},
+        "CropVideo": {"type": "boolean"},
+        "ApplyMask": {"type": "boolean"},
+        "KeepAudio": {"type": "boolean"},
+        "OutputFolder": {"type": "string", "nullable": True, "empty": True},
+        "OutputSuffix": {"type": "string", "empty": True},
+        "OutputExt": {"type": "string", "empty": False},
+        "OutputOptions": {"type": "dict"},
+        "Overwrite": {"type": "boolean", "empty": False},
+        "Duplicates": {"type": "string", "allowed": ["hardlink", "copy", "record"]},
+        "Decimate": {
+            "type": ["boolean", "dict"],
+            "schema": {
+                "hi": pos_int,
+                "lo": pos_int,
+                "frac": pos_real,
+                "max": {"type": "integer"},
+            },
+        },
+    }
+
+
+_validator = None
+_validator_lock = Lock()
+_schema_hash = None
+_validated = None  # hashes of the validated options
+
+VALIDATED_FILE = "validated_options.json"  # in cache_dir()
+MAX_VALIDATED = 256  # maximum number of hashes kept in VALIDATED_FILE
+
+
+def _get_validator():
+    # compile the option schema only once
+    global _validator
+    if _validator is None:
+        import cerberus
+
+        _validator = cerberus.Validator(_option_schema())
+    return _validator
+
+
+def options_hash(ctx):
+    """hash fluorofix options together with the option schema
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :return: SHA-1 hex digest
+    :rtype: str
+    """
+    global _schema_hash
+    if _schema_hash is None:
+        schema = json.dumps(_option_schema(), sort_keys=True)
+        _schema_hash = hashlib.sha1(schema.encode("utf-8")).hexdigest()
+    data = json.dumps([_schema_hash, ctx], sort_keys=True, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def _validated_file():
+    return path.join(cache_dir(), VALIDATED_FILE)
+
+
+def _load_validated():
+    global _validated
+    if _validated is None:
+        try:
+            with open(_validated_file(), "rt") as f:
+                _validated = dict.fromkeys(json.load(f))
+        except (OSError, ValueError, TypeError):
+            _validated = {}
+    return _validated
+
+
+def _save_validated(key):
+    validated = _load_validated()
+    validated[key] = None
+    while len(validated) > MAX_VALIDATED:
+        validated.pop(next(iter(validated)))
+    filename = _validated_file()
+    try:
+        makedirs(path.dirname(filename), exist_ok=True)
+        tmpfile = f"{filename}.{getpid()}.tmp"
+        with open(tmpfile, "wt") as f:
+            json.dump(list(validated), f)
+        replace(tmpfile, filename)
+    except OSError as e:
+        logging.warning(f"failed to save the validated options: {e}")
+
+
+def validateOptions(ctx):
+    """validate fluorofix options
+
+    Validated options are memoized by their hash (in memory and in
+    cache_dir()) so that the schema validator is only loaded for new options.
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :raises ValueError: if invalid
+    """
+
+    key = options_hash(ctx)
+    with _validator_lock:
+        validated = key in _load_validated()
+        if not validated:
+            v = _get_validator()
+            if not v.validate(ctx):
+                raise ValueError(v.errors)
+
+    if "Profiles" in ctx:
+        # compile the profiles to reject bad conditions and report ambiguities
+        compile_matcher(ctx["Profiles"])
+
+    if not validated:
+        with _validator_lock:
+            _save_validated(key)
+
+
+def nearest_sar(ratio):
+    """snap a measured pixel aspect ratio to the nearest i:(i+1) or (i+1):i
+
+    :param ratio: measured sample aspect ratio (not 1)
+    :type ratio: float
+    :return: sample aspect ratio [num, den]
+    :rtype: list of 2 ints
+    """
+    pred = (
+        (lambda i: (i + 1) * ratio > i)
+        if ratio < 1
+        else (lambda i: (i + 1) > i * ratio)
+    )
+
+    *_, i = itertools.takewhile(pred, itertools.count(1))
+    return (
+        (
+            [i, i + 1]
+            if (ratio - (i / (i + 1))) < (((i + 1) / (i + 2)) - ratio)
+            else [i + 1, i + 2]
+        )
+        if ratio < 1
+        else (
+            [i + 1, i]
+            if (((i + 1) / i) - ratio) < (ratio - ((i + 2) / (i + 1)))
+            else [i + 2, i + 1]
+        )
     )
-    if not v.validate(ctx):
-        raise ValueError(v.errors)
 
 
 def convert_inkscape(format, height):
@@ -130,25 +293,7 @@ def convert_inkscape(format, height):
 
     sar = circ[3] / circ[2]  # w/h
     if sar != 1:
-        pred = (
-            (lambda i: (i + 1) * sar > i) if sar < 1 else (lambda i: (i + 1) > i * sar)
-        )
-
-        *_, i = itertools.takewhile(pred, itertools.count(1))
-        sar = (
-            (
-                [i, i + 1]
-                if (sar - (i / (i + 1))) < (((i + 1) / (i + 2)) - sar)
-                else [i + 1, i + 2]
-            )
-            if sar < 1
-            else (
-                [i + 1, i]
-                if (((i + 1) / i) - sar) < (sar - ((i + 2) / (i + 1)))
-                else [i + 2, i + 1]
-            )
-        )
-        format["sar"] = sar
+        sar = format["sar"] = nearest_sar(sar)
         sar = sar[0] / sar[1]
 
     try:
@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mmap
+from os import cpu_count, path
+
+SAMPLE_SIZE = 2**16  # bytes per sampled chunk
+NUM_SAMPLES = 16  # number of chunks sampled by quick_hash
+
+
+def quick_hash(file, nsamples=NUM_SAMPLES, sample_size=SAMPLE_SIZE):
+    """fast content fingerprint: file size + hash of evenly spaced chunks
+
+    The file is memory-mapped so only the sampled pages are read. A file
+    smaller than the total sample size is hashed entirely.
+
+    :param file: file path
+    :type file: str
+    :param nsamples: number of chunks to sample, defaults to NUM_SAMPLES
+    :type nsamples: int, optional
+    :param sample_size: size of each chunk in bytes, defaults to SAMPLE_SIZE
+    :type sample_size: int, optional
+    :return: hex digest (identical files always have the same digest)
+    :rtype: str
+    """
+
+    size = path.getsize(file)
+    h = hashlib.blake2b(str(size).encode("ascii"), digest_size=20)
+    if size:
+        with open(file, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as m:
+            if size <= nsamples * sample_size:
+                h.update(m)
+            else:
+                step = (size - sample_size) / (nsamples - 1)
+                for i in range(nsamples):
+                    offset = round(i * step)
+                    h.update(m[offset : offset + sample_size])
+    return h.hexdigest()
+
+
+def full_hash(file, bufsize=2**20):
+    """hash the entire content of a file
+
+    :param file: file path
+    :type file: str
+    :param bufsize: read size in bytes, defaults to 1 MiB
+    :type bufsize: int, optional
+    :return: hex digest
+    :rtype: str
+    """
+    h = hashlib.blake2b(digest_size=20)
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(bufsize), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _group_by(files, key, executor):
+    groups = {}
+    for file, k in zip(files, executor.map(key, files)):
+        groups.setdefault(k, []).append(file)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def find_duplicates(files, max_workers=None):
+    """find files with identical contents
+
+    Files are first grouped by size, then by quick_hash(), and only the files
+    which still collide are confirmed by full_hash().
+
+    :param files: files to check
+    :type files: iterable of str
+    :param max_workers: number of concurrent hashing threads, defaults to None
+                        (number of CPU cores)
+    :type max_workers: int, optional
+    :return: duplicate files mapped to their original (the first in sorted order
+             of each group of identical files)
+    :rtype: dict
+    """
+
+    bysize = {}
+    for file in files:
+        try:
+            bysize.setdefault(path.getsize(file), []).append(file)
+        except OSError:
+            pass
+
+    dups = {}
+    with ThreadPoolExecutor(max_workers=max_workers or cpu_count() or 1) as executor:
+        for group in (g for g in bysize.values() if len(g) > 1):
+            for candidates in _group_by(group, quick_hash, executor):
+                for same in _group_by(candidates, full_hash, executor):
+                    orig, *others = sorted(same)
+                    dups.update((f, orig) for f in others)
+    return dups
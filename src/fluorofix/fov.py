@@ -0,0 +1,399 @@
+from fractions import Fraction
+import logging
+from math import ceil
+from subprocess import PIPE
+
+from . import cache
+from .configure import nearest_sar
+from .profiles import compile_matcher
+
+SAR_TOLERANCE = 0.03  # measured aspect ratios within 1 +/- this are square
+MIN_FRAMES = 16  # fewest keyframes to detect from before decoding all frames
+
+
+def sample_frames(src, src_info=None, width=320, max_frames=300, keyframes=True):
+    """decode downscaled grayscale frames of a video for field-of-view detection
+
+    :param src: video file
+    :type src: str
+    :param src_info: video stream info of src, defaults to None (to probe)
+    :type src_info: dict, optional
+    :param width: width to downscale the frames to, defaults to 320
+    :type width: int, optional
+    :param max_frames: maximum number of frames, defaults to 300
+    :type max_frames: int, optional
+    :param keyframes: True to decode the keyframes only, defaults to True. If
+                      the video has fewer than MIN_FRAMES keyframes, frames
+                      evenly spaced over the video are decoded instead.
+    :type keyframes: bool, optional
+    :return: nframes-by-height-by-width uint8 array (the frames are not
+             squared: each pixel is a stored pixel)
+    :rtype: numpy.ndarray
+    """
+
+    import numpy as np
+    from ffmpegio import ffmpegprocess
+
+    if src_info is None:
+        try:
+            src_info = cache.video_streams_basic(src)[0]
+        except:
+            raise ValueError("not a video file")
+
+    vidw, vidh = src_info["width"], src_info["height"]
+    w = min(width, vidw) // 2 * 2
+    h = max(round(vidh * w / vidw / 2) * 2, 2)
+
+    vf = f"scale={w}:{h},format=gray"
+    if not keyframes:
+        duration = src_info.get("duration", None) or 0.0
+        nframes = duration * float(src_info.get("frame_rate", None) or 30)
+        step = ceil(nframes / max_frames)
+        if step > 1:
+            vf = f"framestep={step},{vf}"
+
+    args = {
+        "inputs": [(src, {"skip_frame": "nokey"} if keyframes else {})],
+        "outputs": [
+            (
+                "-",
+                {
+                    "vf": vf,
+                    "f": "rawvideo",
+                    "pix_fmt": "gray",
+                    "fps_mode": "passthrough",
+                    "an": None,
+                },
+            )
+        ],
+    }
+    ret = ffmpegprocess.run(args, capture_log=True, stdout=PIPE)
+    if ret.returncode:
+        raise RuntimeError(f"FFmpeg failed to decode {src}")
+
+    frames = np.frombuffer(ret.stdout, np.uint8)
+    frames = frames[: frames.size // (w * h) * w * h].reshape(-1, h, w)
+    if keyframes and len(frames) < MIN_FRAMES:
+        return sample_frames(src, src_info, width, max_frames, False)
+    if len(frames) > max_frames:
+        frames = frames[np.linspace(0, len(frames) - 1, max_frames).round().astype(int)]
+    return frames
+
+
+def temporal_stats(frames, chunk=64):
+    """per-pixel temporal maximum and variance of frames
+
+    :param frames: nframes-by-height-by-width array
+    :type frames: numpy.ndarray
+    :param chunk: number of frames to accumulate at a time, defaults to 64
+    :type chunk: int, optional
+    :return: maximum and variance images
+    :rtype: tuple of 2 numpy.ndarray
+    """
+
+    import numpy as np
+
+    n = len(frames)
+    if not n:
+        raise ValueError("no frame")
+    s = np.zeros(frames.shape[1:], np.float64)
+    s2 = np.zeros_like(s)
+    mx = np.zeros(frames.shape[1:], frames.dtype)
+    for i in range(0, n, chunk):
+        f = frames[i : i + chunk]
+        np.maximum(mx, f.max(axis=0), out=mx)
+        f = f.astype(np.float32)
+        s += f.sum(axis=0)
+        s2 += (f * f).sum(axis=0)
+    mean = s / n
+    return mx, np.maximum(s2 / n - mean * mean, 0.0)
+
+
+def _otsu(values, nbins=256):
+    # threshold which best separates the values into 2 classes
+    import numpy as np
+
+    hist, edges = np.histogram(values, nbins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * centers)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = w0 * w1 * (m0 / w0 - (m0[-1] - m0) / w1) ** 2
+    return centers[np.nanargmax(between[:-1])]
+
+
+def _open(mask, r=1):
+    # morphological opening with a (2r+1)-square: drops specks narrower than it
+    import numpy as np
+
+    h, w = mask.shape
+
+    def filt(m, reduce, pad):
+        p = np.pad(m, r, constant_values=pad)
+        out = m.copy()
+        for dy in range(2 * r + 1):
+            for dx in range(2 * r + 1):
+                reduce(out, p[dy : dy + h, dx : dx + w], out=out)
+        return out
+
+    return filt(filt(mask, np.logical_and, True), np.logical_or, False)
+
+
+def active_region(var):
+    """pixels of the active image area: those which vary over time
+
+    Outside the field of view, the frame is constant (including burned-in
+    text), while the X-ray noise alone makes every pixel inside it vary.
+
+    :param var: temporal variance image
+    :type var: numpy.ndarray
+    :return: boolean image, True in the active area
+    :rtype: numpy.ndarray
+    """
+
+    import numpy as np
+
+    v = np.log1p(var)
+    if v.max() - v.min() < 1e-6:
+        return np.ones(var.shape, bool)
+    mask = _open(v > _otsu(v))
+
+    # the field of view is convex: fill in the still parts inside it
+    for m in (mask, mask.T):
+        rows = np.flatnonzero(m.any(axis=1))
+        first = m[rows].argmax(axis=1)
+        last = m.shape[1] - 1 - m[rows, ::-1].argmax(axis=1)
+        cols = np.arange(m.shape[1])
+        m[rows] = (cols >= first[:, None]) & (cols <= last[:, None])
+    return mask
+
+
+def _boundary_points(mask):
+    # edge points of the region, except where it is cut by the frame edges
+    import numpy as np
+
+    h, w = mask.shape
+    pts = []
+    for m, swap in ((mask, False), (mask.T, True)):
+        rows = np.flatnonzero(m.any(axis=1))
+        first = m[rows].argmax(axis=1)
+        last = m.shape[1] - 1 - m[rows, ::-1].argmax(axis=1)
+        for x, keep in ((first, first > 0), (last + 1, last < m.shape[1] - 1)):
+            p = np.stack([x[keep], rows[keep] + 0.5], axis=1)
+            pts.append(p[:, ::-1] if swap else p)
+    return np.concatenate(pts)
+
+
+def _fit_ellipse(pts):
+    # least-squares axis-aligned ellipse: a x^2 + c y^2 + d x + e y = 1
+    import numpy as np
+
+    # centered so that the origin is inside the ellipse
+    mx, my = pts.mean(axis=0)
+    x, y = pts[:, 0] - mx, pts[:, 1] - my
+    A = np.stack([x * x, y * y, x, y], axis=1)
+    keep = np.ones(len(pts), bool)
+    for _ in range(3):
+        coef, *_ = np.linalg.lstsq(A[keep], np.ones(keep.sum()), rcond=None)
+        res = np.abs(A @ coef - 1)
+        # drop the outliers (e.g., burned-in text touching the field of view)
+        med = np.median(res[keep])
+        keep = res <= max(3 * med, 1e-9)
+    a, c, d, e = coef
+    if a <= 0 or c <= 0:
+        raise ValueError("no ellipse fits the field of view")
+    cx, cy = -d / (2 * a), -e / (2 * c)
+    f = 1 + a * cx * cx + c * cy * cy
+    return cx + mx, cy + my, np.sqrt(f / a), np.sqrt(f / c)
+
+
+def _iou(a, b):
+    return (a & b).sum() / max((a | b).sum(), 1)
+
+
+def fit_fov(mask):
+    """fit a circle/ellipse or a rectangle to the active image area
+
+    :param mask: active area (see active_region())
+    :type mask: numpy.ndarray
+    :return: {"shape": "circ" or "rect", "x0", "y0", "w", "h", "score"} in
+             mask pixels, score is the intersection over union of the fitted
+             shape and the mask
+    :rtype: dict
+    """
+
+    import numpy as np
+
+    from .transcode import render_mask_alpha
+
+    h, w = mask.shape
+    ys, xs = np.nonzero(mask)
+    if not len(xs):
+        raise ValueError("no active image area")
+
+    # rectangle: robust extent of the area
+    x0, x1 = np.percentile(xs, [0.5, 99.5])
+    y0, y1 = np.percentile(ys, [0.5, 99.5])
+    fits = [
+        {
+            "shape": "rect",
+            "x0": float(x0),
+            "y0": float(y0),
+            "w": float(x1 - x0 + 1),
+            "h": float(y1 - y0 + 1),
+        }
+    ]
+
+    pts = _boundary_points(mask)
+    if len(pts) >= 8:
+        try:
+            cx, cy, rx, ry = _fit_ellipse(pts)
+            fits.append(
+                {
+                    "shape": "circ",
+                    "x0": float(cx - rx + 0.5),
+                    "y0": float(cy - ry + 0.5),
+                    "w": float(2 * rx),
+                    "h": float(2 * ry),
+                }
+            )
+        except (ValueError, np.linalg.LinAlgError):
+            pass
+
+    for fit in fits:
+        shape = {k: fit[k] for k in ("x0", "y0", "w", "h")}
+        shape["is_rect"] = fit["shape"] == "rect"
+        fit["score"] = float(_iou(~render_mask_alpha(w, h, [shape]), mask))
+    return max(fits, key=lambda fit: fit["score"])
+
+
+def detect_fov(src, src_info=None, width=320, max_frames=300):
+    """detect the field of view of a video
+
+    :param src: video file
+    :type src: str
+    :param src_info: video stream info of src, defaults to None (to probe)
+    :type src_info: dict, optional
+    :param width: width to downscale the frames to, defaults to 320
+    :type width: int, optional
+    :param max_frames: maximum number of frames to sample, defaults to 300
+    :type max_frames: int, optional
+    :return: {"shape", "x0", "y0", "w", "h", "score"} (see fit_fov()) in the
+             stored video pixels, with "sar": [num, den] measured from the
+             circular field of view (None if square or rectangular) and
+             "nframes": the number of sampled frames
+    :rtype: dict
+    """
+
+    if src_info is None:
+        try:
+            src_info = cache.video_streams_basic(src)[0]
+        except:
+            raise ValueError("not a video file")
+
+    frames = sample_frames(src, src_info, width, max_frames)
+    _, var = temporal_stats(frames)
+    fov = fit_fov(active_region(var))
+
+    # back to the video pixels
+    sx = src_info["width"] / frames.shape[2]
+    sy = src_info["height"] / frames.shape[1]
+    fov["x0"] = (fov["x0"] - 0.5) * sx + 0.5
+    fov["y0"] = (fov["y0"] - 0.5) * sy + 0.5
+    fov["w"] *= sx
+    fov["h"] *= sy
+
+    fov["sar"] = None
+    if fov["shape"] == "circ":
+        # a round field of view looks stretched if the pixels are not square
+        ratio = fov["h"] / fov["w"]
+        if abs(ratio - 1) > SAR_TOLERANCE:
+            if 0.5 < ratio < 2:
+                fov["sar"] = nearest_sar(ratio)
+            else:
+                logging.warning(f"{src}: implausible pixel aspect ratio {ratio:.3f}")
+    fov["nframes"] = len(frames)
+    return fov
+
+
+def fov_profile(fov, src_info):
+    """form a profile entry from a detected field of view
+
+    :param fov: detect_fov() output
+    :type fov: dict
+    :param src_info: video stream info of the video
+    :type src_info: dict
+    :return: profile entry [match, spec] of the "Profiles" option, matching the
+             frame size of the video
+    :rtype: list
+    """
+
+    x0, y0, w, h = fov["x0"], fov["y0"], fov["w"], fov["h"]
+    spec = {}
+    if fov["shape"] == "circ":
+        sar = fov["sar"]
+        if sar:
+            spec["sar"] = sar
+        sar = Fraction(*sar) if sar else 1
+        # circ is defined on the square-pixel frame (see profile_masks)
+        if sar < 1:
+            dia = w
+            y0 /= sar
+        elif sar > 1:
+            dia = h
+            x0 *= sar
+        else:
+            dia = (w + h) / 2
+        spec["circ"] = [round(x0), round(y0), round(dia / 2) * 2]
+    else:
+        sar = Fraction(src_info.get("sample_aspect_ratio", None) or 1)
+        if sar < 1:
+            y0 /= sar
+            h /= sar
+        elif sar > 1:
+            x0 *= sar
+            w *= sar
+        spec["rect"] = [round(x0), round(y0), round(w), round(h)]
+
+    return [{"width": src_info["width"], "height": src_info["height"]}, spec]
+
+
+def auto_profile(ctx, src, src_info=None, name=None, min_score=0.9):
+    """add a profile for a video which no profile matches
+
+    The field of view of the video is detected and its profile entry is added
+    to the "Profiles" option of the context, e.g., for a video which
+    probe.check_file() found no profile for.
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param src: video file
+    :type src: str
+    :param src_info: video stream info of src, defaults to None (to probe)
+    :type src_info: dict, optional
+    :param name: profile name, defaults to None ("auto <width>x<height>")
+    :type name: str, optional
+    :param min_score: lowest acceptable fit score, defaults to 0.9
+    :type min_score: float, optional
+    :raises ValueError: if the field of view cannot be detected reliably
+    :return: name of the new profile
+    :rtype: str
+    """
+
+    if src_info is None:
+        try:
+            src_info = cache.video_streams_basic(src)[0]
+        except:
+            raise ValueError("not a video file")
+
+    fov = detect_fov(src, src_info)
+    if fov["score"] < min_score:
+        raise ValueError(
+            f"{src}: field of view not detected reliably (score {fov['score']:.2f})"
+        )
+
+    name = name or f"auto {src_info['width']}x{src_info['height']}"
+    ctx["Profiles"][name] = fov_profile(fov, src_info)
+    compile_matcher(ctx["Profiles"])
+    return name
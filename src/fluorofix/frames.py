@@ -0,0 +1,291 @@
+from fractions import Fraction
+import ffmpegio
+import numpy as np
+
+from . import cache
+from .transcode import (
+    adjust_masks,
+    color_rgba,
+    get_output_size,
+    masks_to_crop,
+    render_mask_alpha,
+)
+
+# parameters of FFmpeg's default (bicubic) scaler, see libswscale
+BICUBIC_B = 0.0
+BICUBIC_C = 0.6
+
+
+def _bicubic(x, b=BICUBIC_B, c=BICUBIC_C):
+    # Mitchell-Netravali cubic kernel
+    x = np.abs(x)
+    x2, x3 = x * x, x * x * x
+    return (
+        np.where(
+            x < 1,
+            (12 - 9 * b - 6 * c) * x3 + (-18 + 12 * b + 6 * c) * x2 + (6 - 2 * b),
+            np.where(
+                x < 2,
+                (-b - 6 * c) * x3
+                + (6 * b + 30 * c) * x2
+                + (-12 * b - 48 * c) * x
+                + (8 * b + 24 * c),
+                0.0,
+            ),
+        )
+        / 6
+    )
+
+
+def _resample_filter(nin, nout):
+    # bicubic resampling taps (indices & weights) as FFmpeg's scale filter:
+    # pixel centers aligned, kernel widened when downscaling, edges replicated
+    ratio = nin / nout
+    scale = max(ratio, 1.0)
+    x = (np.arange(nout) + 0.5) * ratio - 0.5
+    ntaps = int(np.ceil(4 * scale)) + 1
+    i = np.floor(x - 2 * scale).astype(np.intp) + 1 + np.arange(ntaps)[:, None]
+    w = _bicubic((i - x) / scale)
+    w /= w.sum(axis=0)
+    return np.clip(i, 0, nin - 1), w.astype(np.float32)
+
+
+class FrameProcessor:
+    """crop, rescale, and mask batches of RGB video frames with NumPy
+
+    Frames are rescaled with the bicubic kernel of FFmpeg's scale filter, so
+    the output matches the FFmpeg filtergraph of transcode() up to rounding
+    and chroma subsampling, except along the mask edges: the mask is drawn
+    after rescaling here but before rescaling in the filtergraph.
+
+    All the geometry (crop window, rescaling indices, and mask pixels) is
+    computed once at construction, and the output buffer is reused across
+    the calls while the batch size is unchanged. Hence, the array returned by
+    a call is overwritten by the next call.
+
+    :param width: input video frame width
+    :type width: int
+    :param height: input video frame height
+    :type height: int
+    :param mask_shapes: mask shape specifications (keyword arguments for
+                        create_mask_alpha), defaults to None
+    :type mask_shapes: sequence of dicts, optional
+    :param sar: sample aspect ratio, defaults to 1
+    :type sar: int or Fraction, optional
+    :param square: non-None to square non-square pixels, defaults to None
+    :type square: None, "upscale" or "downscale", optional
+    :param crop: tuple (x0, y0, w, h) to crop, None to crop to the masks, or
+                 False to not crop, defaults to None
+    :type crop: sequence of 4 ints, None or False, optional
+    :param color: mask color, defaults to "black"
+    :type color: str, optional
+    """
+
+    def __init__(
+        self,
+        width,
+        height,
+        mask_shapes=None,
+        sar=1,
+        square=None,
+        crop=None,
+        color="black",
+    ):
+        mask_shapes = mask_shapes or []
+        sar = Fraction(sar or 1)
+
+        if crop is None:
+            crop = masks_to_crop(width, height, mask_shapes)
+        if crop is None or crop is False:
+            crop = (0, 0, width, height)
+        x0, y0, w, h = (int(v) for v in crop)
+        self.window = (slice(y0, y0 + h), slice(x0, x0 + w))
+
+        self.width, self.height = get_output_size(width, height, sar, square, crop)
+
+        # resampling along the stretched axis
+        self._axis = None
+        if self.height != h:
+            self._axis = 1
+            self._taps = _resample_filter(h, self.height)
+            self._taps[1].shape = (-1, self.height, 1, 1)
+        elif self.width != w:
+            self._axis = 2
+            self._taps = _resample_filter(w, self.width)
+            self._taps[1].shape = (-1, self.width, 1)
+
+        self.mask = (
+            render_mask_alpha(
+                self.width,
+                self.height,
+                adjust_masks(width, height, mask_shapes, sar, square, crop),
+            )
+            if len(mask_shapes)
+            else None
+        )
+        self.color = np.frombuffer(color_rgba(color), np.uint8)[:3]
+
+        self._buffers = None
+
+    @property
+    def shape(self):
+        """output frame shape (height, width, 3)"""
+        return (self.height, self.width, 3)
+
+    def _get_buffers(self, n):
+        if self._buffers is None or self._buffers[0].shape[0] != n:
+            shape = (n, *self.shape)
+            self._buffers = (
+                np.empty(shape, np.uint8),
+                *(
+                    (
+                        np.empty(shape, np.uint8),
+                        np.empty(shape, np.float32),
+                        np.empty(shape, np.float32),
+                    )
+                    if self._axis
+                    else ()
+                ),
+            )
+        return self._buffers
+
+    def __call__(self, frames):
+        """process a batch of frames
+
+        :param frames: n-by-height-by-width-by-3 RGB frames
+        :type frames: numpy.ndarray
+        :return: n-by-height-by-width-by-3 processed frames (reused buffer)
+        :rtype: numpy.ndarray
+        """
+
+        frames = frames[(slice(None), *self.window)]
+        out, *tmp = self._get_buffers(frames.shape[0])
+
+        if self._axis:
+            index, weights = self._taps
+            b, f, g = tmp
+            f.fill(0.0)
+            for i, w in zip(index, weights):
+                np.take(frames, i, axis=self._axis, out=b)
+                np.multiply(b, w, out=g)
+                f += g
+            np.rint(f, out=f)
+            np.clip(f, 0, 255, out=f)
+            np.copyto(out, f, casting="unsafe")
+        else:
+            np.copyto(out, frames)
+
+        if self.mask is not None:
+            out[:, self.mask] = self.color
+
+        return out
+
+
+def transcode_frames(
+    src,
+    dst=None,
+    callback=None,
+    tstart=None,
+    tend=None,
+    mask_shapes=None,
+    src_info=None,
+    sar=None,
+    square=None,
+    crop=None,
+    color="black",
+    enc_config=None,
+    blocksize=16,
+    overwrite=False,
+):
+    """apply mask to src video in Python and re-encode and/or pass the frames on
+
+    This is an alternative to transcode() which decodes the raw RGB frames and
+    applies the crop, SAR rescaling and mask with FrameProcessor. Only the
+    video stream is written to dst.
+
+    :param src: input video file
+    :type src: str
+    :param dst: output video file, defaults to None (no output file)
+    :type dst: str, optional
+    :param callback: function called with each processed batch of frames:
+                     callback(frames). The frames array is reused by the next
+                     batch. Defaults to None
+    :type callback: Callable, optional
+    :param tstart: start time in seconds, defaults to None
+    :type tstart: float, optional
+    :param tend: end time in seconds, defaults to None
+    :type tend: float, optional
+    :param mask_shapes: mask shape specifications (keyword arguments for
+                        create_mask_alpha), defaults to None
+    :type mask_shapes: sequence of dicts, optional
+    :param src_info: video stream info of src, defaults to None (to probe)
+    :type src_info: dict, optional
+    :param sar: sample aspect ratio, defaults to None (src's)
+    :type sar: int or Fraction, optional
+    :param square: non-None to square non-square pixels, defaults to None
+    :type square: None, "upscale" or "downscale", optional
+    :param crop: tuple (x0, y0, w, h) to crop, None to crop to the masks, or
+                 False to not crop, defaults to None
+    :type crop: sequence of 4 ints, None or False, optional
+    :param color: mask color, defaults to "black"
+    :type color: str, optional
+    :param enc_config: output options, defaults to None
+    :type enc_config: dict, optional
+    :param blocksize: number of frames to process at once, defaults to 16
+    :type blocksize: int, optional
+    :param overwrite: True to overwrite dst, defaults to False
+    :type overwrite: bool, optional
+    :return: dst
+    :rtype: str or None
+    """
+
+    if src_info is None:
+        try:
+            src_info = cache.video_streams_basic(src)[0]
+        except:
+            raise ValueError("not a video file")
+
+    width = src_info["width"]
+    height = src_info["height"]
+    if sar is None:
+        sar = src_info.get("sample_aspect_ratio", None)
+    sar = Fraction(sar or 1)
+
+    proc = FrameProcessor(width, height, mask_shapes, sar, square, crop, color)
+    inbuf = np.empty((blocksize, height, width, 3), np.uint8)
+
+    opts = {"pix_fmt": "rgb24"}
+    if tstart is not None:
+        opts["ss_in"] = tstart
+    if tend is not None:
+        opts["to_in"] = tend
+
+    with ffmpegio.open(src, "rv", blocksize=blocksize, **opts) as reader:
+        writer = None
+        try:
+            if dst is not None:
+                outsar = Fraction(1) if square else sar
+                writer = ffmpegio.open(
+                    dst,
+                    "wv",
+                    rate_in=reader.rate,
+                    s_in=(proc.width, proc.height),
+                    pix_fmt_in="rgb24",
+                    vf=f"setsar={outsar.numerator}/{outsar.denominator}",
+                    overwrite=overwrite,
+                    **(enc_config or {}),
+                )
+            while True:
+                n = reader.readinto(inbuf)
+                if not n:
+                    break
+                frames = proc(inbuf[:n])
+                if callback is not None:
+                    callback(frames)
+                if writer is not None:
+                    writer.write(frames)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    return dst
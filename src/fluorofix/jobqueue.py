@@ -0,0 +1,936 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import json
+import logging
+from os import cpu_count, getpid, makedirs, path
+import socket
+import sqlite3
+from threading import Event, Lock, Thread
+from time import time
+from uuid import uuid4
+
+from . import metrics
+from .batch import file_size, link_duplicate, partial_name, run_job
+from .cache import decode_fraction, encode_fraction
+from .journal import config_hash
+
+# job states
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+def default_node():
+    """name of this node reported to the queue
+
+    :return: host name
+    :rtype: str
+    """
+    return socket.gethostname()
+
+
+class JobQueue(ABC):
+    """base class of the job queues shared by the nodes of a distributed run
+
+    A coordinator enqueues the analyze_files() entries of the videos, and the
+    workers on the nodes lease the jobs one at a time. A lease expires unless
+    its worker renews it with heartbeats, and the failed jobs and the jobs
+    whose lease expired are retried with exponential backoff until they have
+    been attempted `max_attempts` times. The lease times are compared across
+    the nodes, so their clocks must be synchronized (e.g., by NTP).
+
+    A job is a dict: {"id", "src", "data", "size", "status", "attempts",
+    "node", "token", "lease_until", "not_before", "started", "finished",
+    "elapsed", "error"}, where "data" is the analyze_files() entry of "src"
+    and "token" identifies the current lease.
+
+    :param max_attempts: maximum number of attempts of a job, defaults to 3
+    :type max_attempts: int, optional
+    :param backoff: seconds to wait before the first retry, doubled for each
+                    further retry, defaults to 30.0
+    :type backoff: float, optional
+    :param max_backoff: maximum seconds to wait before a retry, defaults to 600.0
+    :type max_backoff: float, optional
+    """
+
+    def __init__(self, max_attempts=3, backoff=30.0, max_backoff=600.0):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def retry_delay(self, attempts):
+        """seconds to wait before retrying a job
+
+        :param attempts: number of attempts so far
+        :type attempts: int
+        :rtype: float
+        """
+        return min(self.backoff * 2 ** max(attempts - 1, 0), self.max_backoff)
+
+    @abstractmethod
+    def set_context(self, ctx):
+        """store the fluorofix context which the workers run the jobs with
+
+        :param ctx: fluorofix context
+        :type ctx: dict
+        """
+
+    @abstractmethod
+    def get_context(self):
+        """get the stored fluorofix context
+
+        :return: fluorofix context or None if not set
+        :rtype: dict or None
+        """
+
+    @abstractmethod
+    def enqueue(self, jobs):
+        """add jobs to the queue
+
+        A job of a source file which is already in the queue is queued again
+        only if it has failed, or if it is done but its data have changed
+        since.
+
+        :param jobs: (src, data) pairs
+        :type jobs: iterable of tuples
+        :return: number of jobs queued
+        :rtype: int
+        """
+
+    @abstractmethod
+    def lease(self, node, duration, now=None):
+        """lease the next job which is due
+
+        :param node: name of the node running the job
+        :type node: str
+        :param duration: seconds until the lease expires without a heartbeat
+        :type duration: float
+        :param now: current time, defaults to None (time.time())
+        :type now: float, optional
+        :return: leased job or None if no job is due
+        :rtype: dict or None
+        """
+
+    @abstractmethod
+    def heartbeat(self, job, duration, now=None):
+        """extend the lease of a job
+
+        :param job: leased job
+        :type job: dict
+        :param duration: seconds from now until the lease expires
+        :type duration: float
+        :param now: current time, defaults to None (time.time())
+        :type now: float, optional
+        :return: False if the lease has been lost
+        :rtype: bool
+        """
+
+    @abstractmethod
+    def complete(self, job, error=None, elapsed=None, now=None):
+        """record the outcome of a leased job
+
+        A failed job is queued again after retry_delay() unless it has been
+        attempted max_attempts times.
+
+        :param job: leased job
+        :type job: dict
+        :param error: error message if failed, defaults to None
+        :type error: str, optional
+        :param elapsed: seconds the job took, defaults to None
+        :type elapsed: float, optional
+        :param now: current time, defaults to None (time.time())
+        :type now: float, optional
+        :return: False if the lease had been lost (the outcome is discarded)
+        :rtype: bool
+        """
+
+    @abstractmethod
+    def requeue_expired(self, now=None):
+        """retry (or fail) the jobs whose lease has expired
+
+        lease() does this as well, so it is needed only while no worker is
+        leasing jobs.
+
+        :param now: current time, defaults to None (time.time())
+        :type now: float, optional
+        """
+
+    @abstractmethod
+    def pending(self):
+        """number of the jobs which are queued or running
+
+        :rtype: int
+        """
+
+    @abstractmethod
+    def jobs(self):
+        """all the jobs in the queue
+
+        :rtype: list of dicts
+        """
+
+    def close(self):
+        """close the connection to the queue"""
+        pass
+
+
+_JOB_COLUMNS = (
+    "id",
+    "src",
+    "data",
+    "size",
+    "status",
+    "attempts",
+    "node",
+    "token",
+    "lease_until",
+    "not_before",
+    "started",
+    "finished",
+    "elapsed",
+    "error",
+)
+
+
+class SQLiteQueue(JobQueue):
+    """job queue in an SQLite database on storage shared by the nodes
+
+    The database is locked for each update, so it suits the jobs of a batch
+    run (minutes long), not high-rate messaging. It uses the default rollback
+    journal, which works on network file systems with working file locks
+    (WAL mode does not).
+
+    :param filename: SQLite database file
+    :type filename: str
+    :param **kwargs: JobQueue arguments
+    """
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(**kwargs)
+        self.filename = filename
+        self._lock = Lock()
+        self._db = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {
+            "filename": self.filename,
+            "max_attempts": self.max_attempts,
+            "backoff": self.backoff,
+            "max_backoff": self.max_backoff,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connect(self):
+        # (re)connect if first use or in a forked process
+        if self._db is None or self._pid != getpid():
+            if self.filename != ":memory:":
+                makedirs(path.dirname(path.abspath(self.filename)), exist_ok=True)
+            self._db = sqlite3.connect(
+                self.filename,
+                timeout=60,
+                check_same_thread=False,
+                isolation_level=None,  # transactions are explicit
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, "
+                "src TEXT UNIQUE, data TEXT, size INTEGER, status TEXT, "
+                "attempts INTEGER, node TEXT, token TEXT, lease_until REAL, "
+                "not_before REAL, started REAL, finished REAL, elapsed REAL, "
+                "error TEXT)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, not_before)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._pid = getpid()
+        return self._db
+
+    @contextmanager
+    def _transaction(self):
+        # lock the database for writing for the duration of the transaction
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            if self._db is not None and self._pid == getpid():
+                self._db.close()
+            self._db = None
+
+    def set_context(self, ctx):
+        with self._transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('context', ?)",
+                (json.dumps(ctx, default=encode_fraction),),
+            )
+
+    def get_context(self):
+        with self._lock:
+            row = (
+                self._connect()
+                .execute("SELECT value FROM meta WHERE key='context'")
+                .fetchone()
+            )
+        return None if row is None else json.loads(row[0], object_hook=decode_fraction)
+
+    def enqueue(self, jobs):
+        rows = [
+            (
+                src,
+                json.dumps(data, sort_keys=True, default=encode_fraction),
+                file_size(src),
+            )
+            for src, data in jobs
+        ]
+        with self._transaction() as db:
+            n = db.total_changes
+            db.executemany(
+                "INSERT INTO jobs (src, data, size, status, attempts, not_before) "
+                "VALUES (?, ?, ?, 'queued', 0, 0) ON CONFLICT (src) DO UPDATE SET "
+                "data=excluded.data, size=excluded.size, status='queued', "
+                "attempts=0, node=NULL, token=NULL, lease_until=NULL, not_before=0, "
+                "started=NULL, finished=NULL, elapsed=NULL, error=NULL "
+                "WHERE status='failed' OR (status='done' AND data!=excluded.data)",
+                rows,
+            )
+            return db.total_changes - n
+
+    def _retry(self, db, id, attempts, error, now):
+        if attempts >= self.max_attempts:
+            db.execute(
+                "UPDATE jobs SET status='failed', token=NULL, lease_until=NULL, "
+                "finished=?, error=? WHERE id=?",
+                (now, error, id),
+            )
+        else:
+            db.execute(
+                "UPDATE jobs SET status='queued', token=NULL, lease_until=NULL, "
+                "not_before=?, error=? WHERE id=?",
+                (now + self.retry_delay(attempts), error, id),
+            )
+
+    def _expire(self, db, now):
+        for id, attempts in db.execute(
+            "SELECT id, attempts FROM jobs WHERE status='leased' AND lease_until<?",
+            (now,),
+        ).fetchall():
+            self._retry(db, id, attempts, "lease expired", now)
+
+    def requeue_expired(self, now=None):
+        with self._transaction() as db:
+            self._expire(db, time() if now is None else now)
+
+    def lease(self, node, duration, now=None):
+        now = time() if now is None else now
+        with self._transaction() as db:
+            self._expire(db, now)
+            row = db.execute(
+                "SELECT id FROM jobs WHERE status='queued' AND not_before<=? "
+                "ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET status='leased', attempts=attempts+1, node=?, "
+                "token=?, lease_until=?, started=?, elapsed=NULL WHERE id=?",
+                (node, uuid4().hex, now + duration, now, row[0]),
+            )
+            return self._get(db, row[0])
+
+    def _get(self, db, id):
+        row = db.execute(
+            f"SELECT {', '.join(_JOB_COLUMNS)} FROM jobs WHERE id=?", (id,)
+        ).fetchone()
+        return None if row is None else self._job(row)
+
+    def _job(self, row):
+        job = dict(zip(_JOB_COLUMNS, row))
+        job["data"] = json.loads(job["data"], object_hook=decode_fraction)
+        return job
+
+    def heartbeat(self, job, duration, now=None):
+        now = time() if now is None else now
+        with self._transaction() as db:
+            return bool(
+                db.execute(
+                    "UPDATE jobs SET lease_until=? WHERE id=? AND token=? "
+                    "AND status='leased'",
+                    (now + duration, job["id"], job["token"]),
+                ).rowcount
+            )
+
+    def complete(self, job, error=None, elapsed=None, now=None):
+        now = time() if now is None else now
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT attempts FROM jobs WHERE id=? AND token=? AND status='leased'",
+                (job["id"], job["token"]),
+            ).fetchone()
+            if row is None:
+                return False
+            db.execute("UPDATE jobs SET elapsed=? WHERE id=?", (elapsed, job["id"]))
+            if error:
+                self._retry(db, job["id"], row[0], error, now)
+            else:
+                db.execute(
+                    "UPDATE jobs SET status='done', token=NULL, lease_until=NULL, "
+                    "finished=?, error=NULL WHERE id=?",
+                    (now, job["id"]),
+                )
+            return True
+
+    def pending(self):
+        with self._lock:
+            return (
+                self._connect()
+                .execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'leased')"
+                )
+                .fetchone()[0]
+            )
+
+    def jobs(self):
+        with self._lock:
+            rows = (
+                self._connect()
+                .execute(f"SELECT {', '.join(_JOB_COLUMNS)} FROM jobs ORDER BY id")
+                .fetchall()
+            )
+        return [self._job(row) for row in rows]
+
+
+# Lua functions shared by the scripts of RedisQueue
+# KEYS: jobs (hash id -> job JSON), ready (zset id -> not_before), leases (zset
+#       id -> lease_until), srcs (hash src -> id), seq (id counter)
+# ARGV[1..4]: now, max_attempts, backoff, max_backoff
+_LUA_LIB = """
+local jobs, ready, leases, srcs, seq = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local now = tonumber(ARGV[1])
+local max_attempts = tonumber(ARGV[2])
+
+local function load(id)
+  return cjson.decode(redis.call('HGET', jobs, id))
+end
+
+local function save(job)
+  redis.call('HSET', jobs, job.id, cjson.encode(job))
+end
+
+local function retry(job, err)
+  redis.call('ZREM', leases, job.id)
+  job.token = nil
+  job.lease_until = nil
+  job.error = err
+  if job.attempts >= max_attempts then
+    job.status = 'failed'
+    job.finished = now
+  else
+    local delay = math.min(
+      tonumber(ARGV[3]) * 2 ^ math.max(job.attempts - 1, 0), tonumber(ARGV[4]))
+    job.status = 'queued'
+    job.not_before = now + delay
+    redis.call('ZADD', ready, job.not_before, job.id)
+  end
+  save(job)
+end
+
+local function expire()
+  for _, id in ipairs(redis.call('ZRANGEBYSCORE', leases, '-inf', '(' .. now)) do
+    retry(load(id), 'lease expired')
+  end
+end
+
+local function leased(id, token)
+  local data = redis.call('HGET', jobs, id)
+  if not data then return nil end
+  local job = cjson.decode(data)
+  if job.status ~= 'leased' or job.token ~= token then return nil end
+  return job
+end
+"""
+
+_LUA_SCRIPTS = {
+    # ARGV[5..7]: src, data, size
+    "enqueue": """
+local id = redis.call('HGET', srcs, ARGV[5])
+if id then
+  local job = load(id)
+  if not (job.status == 'failed' or (job.status == 'done' and job.data ~= ARGV[6])) then
+    return 0
+  end
+else
+  id = string.format('%012d', redis.call('INCR', seq))
+  redis.call('HSET', srcs, ARGV[5], id)
+end
+save({id = id, src = ARGV[5], data = ARGV[6], size = tonumber(ARGV[7]),
+      status = 'queued', attempts = 0, not_before = 0})
+redis.call('ZADD', ready, 0, id)
+return 1
+""",
+    "expire": """
+expire()
+return 0
+""",
+    # ARGV[5..7]: node, lease_until, token
+    "lease": """
+expire()
+local ids = redis.call('ZRANGEBYSCORE', ready, '-inf', now, 'LIMIT', 0, 1)
+if #ids == 0 then return nil end
+local job = load(ids[1])
+redis.call('ZREM', ready, job.id)
+redis.call('ZADD', leases, ARGV[6], job.id)
+job.status = 'leased'
+job.attempts = job.attempts + 1
+job.node = ARGV[5]
+job.token = ARGV[7]
+job.lease_until = tonumber(ARGV[6])
+job.started = now
+job.elapsed = nil
+save(job)
+return cjson.encode(job)
+""",
+    # ARGV[5..7]: id, token, lease_until
+    "heartbeat": """
+local job = leased(ARGV[5], ARGV[6])
+if not job then return 0 end
+job.lease_until = tonumber(ARGV[7])
+redis.call('ZADD', leases, ARGV[7], job.id)
+save(job)
+return 1
+""",
+    # ARGV[5..8]: id, token, error, elapsed
+    "complete": """
+local job = leased(ARGV[5], ARGV[6])
+if not job then return 0 end
+job.elapsed = tonumber(ARGV[8])
+if ARGV[7] ~= '' then
+  retry(job, ARGV[7])
+else
+  redis.call('ZREM', leases, job.id)
+  job.status = 'done'
+  job.token = nil
+  job.lease_until = nil
+  job.error = nil
+  job.finished = now
+  save(job)
+end
+return 1
+""",
+}
+
+
+class RedisQueue(JobQueue):
+    """job queue in a Redis server
+
+    Requires the redis package. Each queue operation is a Lua script, so it is
+    atomic across the nodes.
+
+    :param url: Redis server URL, defaults to "redis://localhost:6379/0"
+    :type url: str, optional
+    :param name: prefix of the Redis keys of the queue, defaults to "fluorofix"
+    :type name: str, optional
+    :param **kwargs: JobQueue arguments
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", name="fluorofix", **kwargs):
+        import redis
+
+        super().__init__(**kwargs)
+        self.url = url
+        self.name = name
+        self._client = redis.Redis.from_url(url)
+        self._keys = [f"{name}:{k}" for k in ("jobs", "ready", "leases", "srcs", "seq")]
+        self._scripts = {
+            k: self._client.register_script(_LUA_LIB + s)
+            for k, s in _LUA_SCRIPTS.items()
+        }
+
+    def __getstate__(self):
+        return {
+            "url": self.url,
+            "name": self.name,
+            "max_attempts": self.max_attempts,
+            "backoff": self.backoff,
+            "max_backoff": self.max_backoff,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _call(self, script, now, *args):
+        return self._scripts[script](
+            keys=self._keys,
+            args=[
+                time() if now is None else now,
+                self.max_attempts,
+                self.backoff,
+                self.max_backoff,
+                *args,
+            ],
+        )
+
+    def _job(self, data):
+        job = {k: None for k in _JOB_COLUMNS}
+        job.update(json.loads(data))
+        job["data"] = json.loads(job["data"], object_hook=decode_fraction)
+        return job
+
+    def close(self):
+        self._client.close()
+
+    def set_context(self, ctx):
+        self._client.set(
+            f"{self.name}:context", json.dumps(ctx, default=encode_fraction)
+        )
+
+    def get_context(self):
+        data = self._client.get(f"{self.name}:context")
+        return None if data is None else json.loads(data, object_hook=decode_fraction)
+
+    def enqueue(self, jobs):
+        n = 0
+        for src, data in jobs:
+            n += self._call(
+                "enqueue",
+                None,
+                src,
+                json.dumps(data, sort_keys=True, default=encode_fraction),
+                file_size(src),
+            )
+        return n
+
+    def requeue_expired(self, now=None):
+        self._call("expire", now)
+
+    def lease(self, node, duration, now=None):
+        now = time() if now is None else now
+        data = self._call("lease", now, node, now + duration, uuid4().hex)
+        return None if data is None else self._job(data)
+
+    def heartbeat(self, job, duration, now=None):
+        now = time() if now is None else now
+        return bool(
+            self._call("heartbeat", now, job["id"], job["token"], now + duration)
+        )
+
+    def complete(self, job, error=None, elapsed=None, now=None):
+        return bool(
+            self._call(
+                "complete",
+                now,
+                job["id"],
+                job["token"],
+                error or "",
+                "" if elapsed is None else elapsed,
+            )
+        )
+
+    def pending(self):
+        return self._client.zcard(self._keys[1]) + self._client.zcard(self._keys[2])
+
+    def jobs(self):
+        jobs = [self._job(data) for data in self._client.hvals(self._keys[0])]
+        return sorted(jobs, key=lambda job: job["id"])
+
+
+def open_queue(url, **kwargs):
+    """open a job queue
+
+    :param url: "redis://", "rediss://", or "unix://" URL of a Redis server,
+                otherwise the path of an SQLite database file
+    :type url: str
+    :param **kwargs: JobQueue arguments
+    :return: job queue
+    :rtype: JobQueue
+    """
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisQueue(url, **kwargs)
+    return SQLiteQueue(url, **kwargs)
+
+
+def queue_counts(jobs):
+    """number of jobs in each state
+
+    :param jobs: JobQueue.jobs() output
+    :type jobs: list of dicts
+    :return: {"queued", "leased", "done", "failed"}
+    :rtype: dict
+    """
+    counts = {QUEUED: 0, LEASED: 0, DONE: 0, FAILED: 0}
+    for job in jobs:
+        counts[job["status"]] += 1
+    return counts
+
+
+def node_stats(jobs):
+    """throughput of each node from its finished jobs
+
+    The throughput is measured over the span from the start of the node's
+    first job to the end of its last job.
+
+    :param jobs: JobQueue.jobs() output
+    :type jobs: list of dicts
+    :return: per-node {"done", "failed", "active", "bytes", "busy", "span",
+             "jobs_per_hour", "bytes_per_sec"}
+    :rtype: dict
+    """
+    nodes = {}
+    for job in jobs:
+        node = job["node"]
+        if node is None:
+            continue
+        s = nodes.setdefault(
+            node,
+            {
+                "done": 0,
+                "failed": 0,
+                "active": 0,
+                "bytes": 0,
+                "busy": 0.0,
+                "first": None,
+                "last": None,
+            },
+        )
+        if job["status"] == LEASED:
+            s["active"] += 1
+            continue
+        if job["status"] == DONE:
+            s["done"] += 1
+            s["bytes"] += job["size"] or 0
+        elif job["status"] == FAILED:
+            s["failed"] += 1
+        else:
+            continue  # waiting for a retry
+        s["busy"] += job["elapsed"] or 0.0
+        if job["started"] is not None and job["finished"] is not None:
+            if s["first"] is None or job["started"] < s["first"]:
+                s["first"] = job["started"]
+            if s["last"] is None or job["finished"] > s["last"]:
+                s["last"] = job["finished"]
+
+    for s in nodes.values():
+        first, last = s.pop("first"), s.pop("last")
+        span = s["span"] = last - first if first is not None else 0.0
+        s["jobs_per_hour"] = s["done"] * 3600 / span if span > 0 else None
+        s["bytes_per_sec"] = s["bytes"] / span if span > 0 else None
+    return nodes
+
+
+class QueueWorker:
+    """run the jobs of a job queue on this node
+
+    The worker leases up to `max_workers` jobs at a time and runs them with
+    batch.run_job() in the fluorofix context stored in the queue. While a job
+    runs, a heartbeat renews its lease every third of the lease duration, so
+    the job is only retried elsewhere if this node stops responding. A job
+    whose lease is lost anyway is aborted.
+
+    :param queue: job queue
+    :type queue: JobQueue
+    :param node: name of this node, defaults to None (default_node())
+    :type node: str, optional
+    :param max_workers: number of concurrent jobs, defaults to None (a half of
+                        the CPU cores)
+    :type max_workers: int, optional
+    :param threads: number of threads each FFmpeg job may use, defaults to None
+    :type threads: int, optional
+    :param lease: seconds a lease lasts without a heartbeat, defaults to 60.0
+    :type lease: float, optional
+    :param poll: seconds between the checks for new jobs, defaults to 5.0
+    :type poll: float, optional
+    :param callback: function called as each job completes: callback(job,
+                     result), defaults to None
+    :type callback: Callable, optional
+    """
+
+    def __init__(
+        self,
+        queue,
+        node=None,
+        max_workers=None,
+        threads=None,
+        lease=60.0,
+        poll=5.0,
+        callback=None,
+    ):
+        self.queue = queue
+        self.node = node or default_node()
+        self.max_workers = max_workers or max(1, (cpu_count() or 1) // 2)
+        self.threads = threads
+        self.lease = lease
+        self.poll = poll
+        self.callback = callback
+        self.processed = 0
+        self.failed = 0
+
+    def _heartbeat(self, job, stop, lost):
+        while not stop.wait(self.lease / 3):
+            try:
+                if not self.queue.heartbeat(job, self.lease):
+                    logging.warning(f"{job['src']}: lease lost, aborting the job")
+                    lost.set()
+                    return
+            except Exception as e:
+                logging.warning(f"{job['src']}: heartbeat failed: {e}")
+
+    def _work(self, ctx, job):
+        stop, lost = Event(), Event()
+        thread = Thread(target=self._heartbeat, args=(job, stop, lost), daemon=True)
+        thread.start()
+        try:
+            # FFmpeg is stopped once the lease is lost, and the partial output
+            # is named after the lease so it never collides with a new lease's
+            return run_job(
+                ctx,
+                job["src"],
+                job["data"],
+                self.threads,
+                progress=lambda status, done: lost.is_set(),
+                tmpfile=partial_name(job["data"]["dst"], job["token"][:12]),
+            )
+        finally:
+            stop.set()
+            thread.join()
+
+    def _collect(self, done, running):
+        for future in done:
+            job = running.pop(future)
+            res = future.result()  # run_job never raises
+            if not self.queue.complete(job, res["error"], res["elapsed"]):
+                logging.warning(f"{job['src']}: lease lost, outcome discarded")
+            self.processed += 1
+            if res["error"] is not None:
+                self.failed += 1
+                logging.warning(f"{job['src']}: {res['error']}")
+            if self.callback is not None:
+                self.callback(job, res)
+
+    def run(self, stop=None, drain=True):
+        """run jobs until stopped (or until the queue is drained)
+
+        :param stop: event to stop the worker, defaults to None
+        :type stop: threading.Event, optional
+        :param drain: True to return once no job is queued or running in the
+                      queue, defaults to True (otherwise wait for more jobs)
+        :type drain: bool, optional
+        :raises RuntimeError: if the queue has no fluorofix context
+        """
+
+        stop = stop or Event()
+        running = {}  # future -> job
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                while not stop.is_set():
+                    while len(running) < self.max_workers:
+                        job = self.queue.lease(self.node, self.lease)
+                        if job is None:
+                            break
+                        ctx = self.queue.get_context()
+                        if ctx is None:
+                            self.queue.complete(job, "no context in the queue")
+                            raise RuntimeError("the queue has no fluorofix context")
+                        logging.info(f"leased {job['src']} (attempt {job['attempts']})")
+                        running[executor.submit(self._work, ctx, job)] = job
+                    if running:
+                        done, _ = wait(running, self.poll, FIRST_COMPLETED)
+                        self._collect(done, running)
+                    elif drain and not self.queue.pending():
+                        break
+                    else:
+                        stop.wait(self.poll)
+            except KeyboardInterrupt:
+                logging.info("stopping: waiting for the running jobs")
+            finally:
+                self._collect(wait(running)[0], running)
+
+
+def _link_duplicates(ctx, dups, jobs):
+    # link the duplicates whose original job has finished (dups is updated)
+    finished = {job["src"]: job for job in jobs if job["status"] in (DONE, FAILED)}
+    for src, data in list(dups.items()):
+        job = finished.get(path.abspath(data["dup_of"]), None)
+        if job is None:
+            continue
+        del dups[src]
+        error = job["error"] if job["status"] == FAILED else None
+        res = link_duplicate(ctx, data, {"dst": job["data"]["dst"], "error": error})
+        if res["error"] is not None:
+            logging.warning(f"{src}: {res['error']}")
+
+
+def coordinate(queue, ctx, files, interval=10.0, callback=None, stop=None):
+    """enqueue videos and monitor the queue until all the jobs have finished
+
+    The jobs are queued largest first with absolute paths, which must be valid
+    on all the nodes. Their data carry the config_hash() of the jobs, so the
+    jobs done with a different configuration are queued again.
+
+    The videos marked as duplicates ("dup_of" item) are not queued: their
+    outputs are linked from the outputs of their originals as those finish
+    (see batch.link_duplicate()).
+
+    :param queue: job queue
+    :type queue: JobQueue
+    :param ctx: fluorofix context, shared with the workers through the queue
+    :type ctx: dict
+    :param files: first output of analyze_files()
+    :type files: dict
+    :param interval: seconds between the progress reports, defaults to 10.0
+    :type interval: float, optional
+    :param callback: function called with each progress report:
+                     callback(counts, nodes) (see queue_counts() and
+                     node_stats()), defaults to None
+    :type callback: Callable, optional
+    :param stop: event to stop monitoring, defaults to None
+    :type stop: threading.Event, optional
+    :return: number of jobs queued, and the final queue_counts() and
+             node_stats()
+    :rtype: tuple
+    """
+
+    stop = stop or Event()
+    queue.set_context(ctx)
+    dups = {src: data for src, data in files.items() if data.get("dup_of", None)}
+    srcs = sorted(
+        (src for src in files if src not in dups), key=file_size, reverse=True
+    )
+    nqueued = queue.enqueue(
+        (
+            path.abspath(src),
+            {
+                **files[src],
+                "dst": path.abspath(files[src]["dst"]),
+                "config": config_hash(ctx, files[src]["prof"]),
+            },
+        )
+        for src in srcs
+    )
+    logging.info(f"queued {nqueued} job(s)")
+
+    while True:
+        queue.requeue_expired()
+        jobs = queue.jobs()
+        if dups:
+            _link_duplicates(ctx, dups, jobs)
+        counts, nodes = queue_counts(jobs), node_stats(jobs)
+        if metrics.enabled():
+            metrics.emit({"event": "queue", "time": time(), **counts})
+        if callback is not None:
+            callback(counts, nodes)
+        if not (counts[QUEUED] or counts[LEASED]) or stop.wait(interval):
+            return nqueued, counts, nodes
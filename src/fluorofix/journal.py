@@ -0,0 +1,190 @@
+import hashlib
+import json
+from os import getpid, makedirs, path, stat
+import sqlite3
+from threading import Lock
+from time import time
+
+from .cache import encode_fraction
+from .configure import OUTPUT_OPTIONS
+
+JOURNAL_FILE = ".fluorofix-journal.sqlite"
+
+
+def config_hash(ctx, prof):
+    """hash the effective configuration of a job
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param prof: name of the profile matched to the video
+    :type prof: str
+    :return: SHA-1 hex digest of the profile specification and the output options
+    :rtype: str
+    """
+    cfg = {k: ctx.get(k, None) for k in OUTPUT_OPTIONS}
+    cfg["Profile"] = ctx["Profiles"][prof][1]
+    data = json.dumps(cfg, sort_keys=True, default=encode_fraction)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class Journal:
+    """SQLite journal of the batch jobs to resume interrupted batch runs
+
+    Each job is recorded with the fingerprint (size and modification time) of
+    its source file, the hash of its effective configuration, and its status
+    ("running", "done", or "failed"). A job is complete only if it is "done",
+    the source and the configuration have not changed since, and its output
+    file exists.
+
+    :param filename: SQLite database file
+    :type filename: str
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = Lock()
+        self._db = None
+        self._pid = None
+
+    @classmethod
+    def for_folder(cls, folder):
+        """open the journal of an output folder
+
+        :param folder: output folder
+        :type folder: str
+        :return: journal stored in the folder
+        :rtype: Journal
+        """
+        return cls(path.join(folder, JOURNAL_FILE))
+
+    def __getstate__(self):
+        return {"filename": self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connect(self):
+        # (re)connect if first use or in a forked process
+        if self._db is None or self._pid != getpid():
+            if self.filename != ":memory:":
+                makedirs(path.dirname(path.abspath(self.filename)), exist_ok=True)
+            self._db = sqlite3.connect(
+                self.filename, timeout=30, check_same_thread=False
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (src TEXT PRIMARY KEY, "
+                "size INTEGER, mtime INTEGER, config TEXT, dst TEXT, "
+                "status TEXT, error TEXT, updated REAL)"
+            )
+            self._db.commit()
+            self._pid = getpid()
+        return self._db
+
+    def close(self):
+        """close the database connection"""
+        with self._lock:
+            if self._db is not None and self._pid == getpid():
+                self._db.close()
+            self._db = None
+
+    def get(self, src):
+        """get the journal entry of a source file
+
+        :param src: source video file
+        :type src: str
+        :return: entry {"size", "mtime", "config", "dst", "status", "error",
+                 "updated"} or None if not journaled
+        :rtype: dict or None
+        """
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT size, mtime, config, dst, status, error, updated "
+                    "FROM jobs WHERE src=?",
+                    (path.abspath(src),),
+                )
+                .fetchone()
+            )
+        if row is None:
+            return None
+        keys = ("size", "mtime", "config", "dst", "status", "error", "updated")
+        return dict(zip(keys, row))
+
+    def is_done(self, src, dst, config):
+        """True if the job has been completed with the current source and config
+
+        :param src: source video file
+        :type src: str
+        :param dst: output video file
+        :type dst: str
+        :param config: config_hash() of the job
+        :type config: str
+        :rtype: bool
+        """
+        entry = self.get(src)
+        if entry is None or entry["status"] != "done":
+            return False
+        try:
+            st = stat(src)
+        except OSError:
+            return False
+        return (
+            (entry["size"], entry["mtime"]) == (st.st_size, st.st_mtime_ns)
+            and entry["config"] == config
+            and entry["dst"] == path.abspath(dst)
+            and path.isfile(dst)
+        )
+
+    def start(self, src, dst, config):
+        """record the start of a job
+
+        :param src: source video file
+        :type src: str
+        :param dst: output video file
+        :type dst: str
+        :param config: config_hash() of the job
+        :type config: str
+        """
+        try:
+            st = stat(src)
+            size, mtime = st.st_size, st.st_mtime_ns
+        except OSError:
+            size = mtime = None  # the job is going to fail
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?,?,?)",
+                (
+                    path.abspath(src),
+                    size,
+                    mtime,
+                    config,
+                    path.abspath(dst),
+                    "running",
+                    None,
+                    time(),
+                ),
+            )
+            db.commit()
+
+    def finish(self, src, error=None):
+        """record the completion of a job
+
+        :param src: source video file
+        :type src: str
+        :param error: error message if failed, defaults to None
+        :type error: str, optional
+        """
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "UPDATE jobs SET status=?, error=?, updated=? WHERE src=?",
+                (
+                    "failed" if error else "done",
+                    error,
+                    time(),
+                    path.abspath(src),
+                ),
+            )
+            db.commit()
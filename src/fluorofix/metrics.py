@@ -0,0 +1,353 @@
+import json
+import logging
+from os import makedirs, path, replace
+import re
+from threading import Lock
+from time import time
+
+_sinks = []
+
+
+def add_sink(sink):
+    """start sending metrics records to a sink
+
+    :param sink: function called with each record: sink(record), e.g.,
+                 JSONLinesSink or PrometheusSink
+    :type sink: Callable
+    :return: the sink
+    :rtype: Callable
+    """
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    """stop sending metrics records to a sink
+
+    :param sink: sink added by add_sink()
+    :type sink: Callable
+    """
+    try:
+        _sinks.remove(sink)
+    except ValueError:
+        pass
+
+
+def enabled():
+    """True if any sink is collecting the metrics records"""
+    return len(_sinks) > 0
+
+
+def emit(record):
+    """send a metrics record to all the sinks (a failed sink is only logged)
+
+    :param record: metrics record with at least the "event" item
+    :type record: dict
+    """
+    for sink in list(_sinks):
+        try:
+            sink(record)
+        except Exception as e:
+            logging.warning(f"metrics sink failed: {e}")
+
+
+def _makedirs(filename):
+    folder = path.dirname(path.abspath(filename))
+    makedirs(folder, exist_ok=True)
+
+
+class JSONLinesSink:
+    """append metrics records to a JSON-lines file
+
+    :param filename: output file
+    :type filename: str
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = Lock()
+        _makedirs(filename)
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock, open(self.filename, "at") as f:
+            f.write(line)
+
+
+class PrometheusSink:
+    """export aggregated metrics records as a Prometheus text file
+
+    The file is meant for the textfile collector of the node exporter. It is
+    replaced atomically, at most once every `interval` seconds for the probe
+    and watch records, and on every transcode and batch record.
+
+    :param filename: output file (should end with ".prom")
+    :type filename: str
+    :param prefix: metric name prefix, defaults to "fluorofix"
+    :type prefix: str, optional
+    :param interval: minimum seconds between writes of probe updates, defaults to 1.0
+    :type interval: float, optional
+    """
+
+    def __init__(self, filename, prefix="fluorofix", interval=1.0):
+        self.filename = filename
+        self.prefix = prefix
+        self.interval = interval
+        self._lock = Lock()
+        self._last_write = 0.0
+        self.counters = {}
+        self.gauges = {}
+        _makedirs(filename)
+
+    def _inc(self, name, value=1, labels=""):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + (value or 0)
+
+    def _set(self, name, value, labels=""):
+        if value is not None:
+            self.gauges[(name, labels)] = value
+
+    def __call__(self, record):
+        event = record.get("event")
+        with self._lock:
+            if event == "transcode":
+                status = "failed" if record.get("error") else "ok"
+                self._inc("transcode_jobs_total", 1, f'status="{status}"')
+                self._inc("transcode_seconds_total", record.get("wall_time"))
+                self._inc("transcode_bytes_read_total", record.get("bytes_in"))
+                self._inc("transcode_bytes_written_total", record.get("bytes_out"))
+                self._inc("transcode_frames_total", record.get("frame"))
+                self._set("transcode_last_fps", record.get("fps"))
+                self._set("transcode_last_speed", record.get("speed"))
+                rss = record.get("maxrss")
+                if rss is not None:
+                    peak = self.gauges.get(("transcode_peak_rss_bytes", ""), 0)
+                    self._set("transcode_peak_rss_bytes", max(peak, rss))
+            elif event == "probe":
+                cached = "true" if record.get("cached") else "false"
+                self._inc("probe_total", 1, f'cached="{cached}"')
+                self._inc("probe_seconds_total", record.get("wall_time"))
+            elif event == "watch":
+                for k in ("pending", "queued", "active", "processed", "failed"):
+                    self._set(f"watch_{k}_files", record.get(k))
+                self._set("watch_last_latency_seconds", record.get("latency"))
+            elif event == "batch":
+                for k in (
+                    "files_total",
+                    "files_done",
+                    "files_failed",
+                    "files_skipped",
+                    "eta",
+                    "files_per_second",
+                    "bytes_per_second",
+                ):
+                    self._set(f"batch_{k}", record.get(k))
+
+            now = time()
+            if (
+                event not in ("probe", "watch")
+                or now - self._last_write >= self.interval
+            ):
+                self._last_write = now
+                self._write()
+
+    def flush(self):
+        """write the current metrics"""
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        lines = []
+        for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+            names = sorted({name for name, _ in values})
+            for name in names:
+                lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+                for (n, labels), value in sorted(values.items()):
+                    if n == name:
+                        labels = f"{{{labels}}}" if labels else ""
+                        lines.append(f"{self.prefix}_{name}{labels} {value}")
+
+        tmpfile = f"{self.filename}.tmp"
+        with open(tmpfile, "wt") as f:
+            f.write("\n".join(lines) + "\n")
+        replace(tmpfile, self.filename)
+
+
+def parse_benchmark_log(log):
+    """parse the resource usage that FFmpeg reports with its -benchmark option
+
+    :param log: FFmpeg log (stderr)
+    :type log: str
+    :return: utime, stime, and rtime in seconds and maxrss in bytes (only the
+             items found in the log)
+    :rtype: dict
+    """
+
+    res = {}
+    m = re.search(r"bench: utime=([\d.]+)s stime=([\d.]+)s rtime=([\d.]+)s", log)
+    if m:
+        res["utime"], res["stime"], res["rtime"] = (float(v) for v in m.groups())
+    m = re.search(r"bench: maxrss=(\d+)(KiB|kB)", log)
+    if m:
+        res["maxrss"] = int(m[1]) * 1024
+    return res
+
+
+def _file_size(url):
+    if isinstance(url, list):
+        sizes = [_file_size(u) for u in url]
+        return None if None in sizes else sum(sizes)
+    try:
+        return path.getsize(url) if isinstance(url, str) else None
+    except OSError:
+        return None
+
+
+class ProgressRecorder:
+    """FFmpeg progress callback which keeps the latest progress fields
+
+    :param callback: user progress callback to forward the updates to,
+                     defaults to None
+    :type callback: Callable, optional
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.status = {}
+
+    def __call__(self, status, done):
+        self.status.update(status)
+        if self.callback is not None:
+            return self.callback(status, done)
+
+    def fields(self):
+        """the latest frame, fps, speed, and out_time (in seconds)
+
+        :rtype: dict
+        """
+        status = self.status
+        res = {k: status.get(k) for k in ("frame", "fps")}
+        try:
+            res["speed"] = float(str(status["speed"]).rstrip("x"))
+        except (KeyError, ValueError):
+            res["speed"] = None
+        try:
+            res["out_time"] = int(status["out_time_us"]) / 1e6
+        except (KeyError, ValueError):
+            res["out_time"] = None
+        return res
+
+    def record(self, event, src, dst, start, error=None, log=None):
+        """form the metrics record of a finished FFmpeg job
+
+        :param event: job type, e.g., "transcode"
+        :type event: str
+        :param src: input url
+        :type src: str or stream
+        :param dst: output url (or urls of a multi-output job)
+        :type dst: str, list of str, or stream
+        :param start: job start time (time.time())
+        :type start: float
+        :param error: error message if failed, defaults to None
+        :type error: str, optional
+        :param log: FFmpeg log to parse the -benchmark output from, defaults to None
+        :type log: str, optional
+        :return: metrics record
+        :rtype: dict
+        """
+
+        rec = {
+            "event": event,
+            "src": src if isinstance(src, str) else "pipe",
+            "dst": dst if isinstance(dst, (str, list)) else "pipe",
+            "start": start,
+            "wall_time": time() - start,
+            "error": error,
+            "bytes_in": _file_size(src),
+            "bytes_out": _file_size(dst),
+            **self.fields(),
+        }
+        rec["bitrate"] = (
+            rec["bytes_out"] * 8 / rec["out_time"]
+            if rec["bytes_out"] and rec["out_time"]
+            else None
+        )
+        if log:
+            rec.update(parse_benchmark_log(log))
+        return rec
+
+
+class BatchProgress:
+    """batch-level progress aggregator
+
+    Pass an instance as the `callback` argument of run_batch(). Each update
+    emits a "batch" metrics record. The skipped jobs (already done in a
+    resumed batch, or linked as duplicates) are counted as done but left out
+    of the rates and of the remaining work of the ETA.
+
+    :param total: total number of files, defaults to None (unknown)
+    :type total: int, optional
+    :param callback: function to forward the updates to: callback(src, result),
+                     defaults to None
+    :type callback: Callable, optional
+    :param duplicates: number of the files which will be linked as duplicates,
+                       defaults to 0
+    :type duplicates: int, optional
+    """
+
+    def __init__(self, total=None, callback=None, duplicates=0):
+        self.total = total
+        self.callback = callback
+        self.duplicates = duplicates
+        self.start = time()
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.linked = 0
+        self.bytes_in = 0
+        self._lock = Lock()
+
+    def __call__(self, src, result):
+        with self._lock:
+            self.done += 1
+            if result.get("error") is not None:
+                self.failed += 1
+            if result.get("dup_of", None):
+                self.linked += 1
+                self.skipped += 1
+            elif result.get("skipped", False):
+                self.skipped += 1
+            else:
+                self.bytes_in += _file_size(src) or 0
+            rec = self.record()
+        emit(rec)
+        if self.callback is not None:
+            self.callback(src, result)
+
+    @property
+    def eta(self):
+        """estimated seconds to finish the batch (None if unknown)"""
+        processed = self.done - self.skipped
+        if not (self.total and processed):
+            return None
+        remaining = self.total - self.done - max(self.duplicates - self.linked, 0)
+        return (time() - self.start) / processed * max(remaining, 0)
+
+    def record(self):
+        """current batch progress as a metrics record
+
+        :rtype: dict
+        """
+        elapsed = time() - self.start
+        processed = self.done - self.skipped
+        return {
+            "event": "batch",
+            "files_total": self.total,
+            "files_done": self.done,
+            "files_failed": self.failed,
+            "files_skipped": self.skipped,
+            "elapsed": elapsed,
+            "eta": self.eta,
+            "files_per_second": processed / elapsed if elapsed else None,
+            "bytes_per_second": self.bytes_in / elapsed if elapsed else None,
+        }
@@ -0,0 +1,168 @@
+from fractions import Fraction
+from os import path
+
+from .transcode import (
+    form_transcode_args,
+    frame_map_file,
+    is_stream,
+    run_transcode_args,
+    write_frame_map,
+)
+
+# video stream properties which a transcode plan depends on
+PLAN_INFO = ("width", "height", "sample_aspect_ratio", "pix_fmt", "codec_name")
+
+# placeholder urls of the plan's FFmpeg arguments
+_SRC = "{src}"
+_DST = "{dst}"
+
+
+def _encode(value):
+    # JSON-compatible value
+    if isinstance(value, Fraction):
+        return f"{value.numerator}/{value.denominator}"
+    if isinstance(value, tuple):
+        return [_encode(v) for v in value]
+    return value
+
+
+class TranscodePlan:
+    """FFmpeg arguments of a transcode job, compiled for a video geometry
+
+    A plan depends only on the frame geometry and format of the source video
+    (see PLAN_INFO) and the transcode options, so one plan serves all the
+    videos of a profile at a resolution: running it only binds the input and
+    output files. Plans are picklable and can be converted to and from
+    JSON-compatible dicts (to_dict() and from_dict()) to be shipped to other
+    processes or machines.
+
+    :param src_info: video stream info of a source video
+    :type src_info: dict
+    :param kwargs: transcode() arguments: mask_shapes, sar, square, crop,
+                   color, enc_config, decimate, and remux
+    :type kwargs: dict
+    """
+
+    def __init__(self, src_info, kwargs):
+        self.src_info = {k: src_info.get(k, None) for k in PLAN_INFO}
+        self.kwargs = kwargs
+        self.args = form_transcode_args(_SRC, _DST, self.src_info, **kwargs)
+
+    @property
+    def decimate(self):
+        """True if the plan drops duplicate frames"""
+        return bool(self.kwargs.get("decimate", None))
+
+    def bind(self, src, dst, threads=None):
+        """form the FFmpeg arguments of a job
+
+        :param src: input video file
+        :type src: str
+        :param dst: output video file
+        :type dst: str
+        :param threads: number of threads FFmpeg may use, defaults to None
+        :type threads: int, optional
+        :return: FFmpeg arguments
+        :rtype: dict
+        """
+
+        if is_stream(src) or is_stream(dst):
+            raise ValueError("transcode plans only bind files")
+
+        inputs = self.args["inputs"]
+        if len(inputs) > 1 and not path.exists(inputs[1][0]):
+            # mask image not in the cache of this machine (or evicted)
+            self.args = form_transcode_args(_SRC, _DST, self.src_info, **self.kwargs)
+            inputs = self.args["inputs"]
+
+        (_, inopts), *others = inputs
+        (_, outopts), *_ = self.args["outputs"]
+        outopts = {**outopts}
+        if threads:
+            outopts["threads"] = threads
+        return {
+            "inputs": [(src, {**inopts}), *((url, {**opts}) for url, opts in others)],
+            "outputs": [(dst, outopts)],
+            "global_options": {**self.args["global_options"]},
+        }
+
+    def run(
+        self,
+        src,
+        dst,
+        progress=None,
+        overwrite=False,
+        threads=None,
+        sidecar=None,
+        frame_rate=None,
+    ):
+        """transcode a video with the plan
+
+        :param src: input video file
+        :type src: str
+        :param dst: output video file
+        :type dst: str
+        :param progress: progress monitor object, defaults to None
+        :type progress: Callable, optional
+        :param overwrite: True to overwrite dst, defaults to False
+        :type overwrite: bool, optional
+        :param threads: number of threads FFmpeg may use, defaults to None
+        :type threads: int, optional
+        :param sidecar: frame map CSV file of a decimated video, defaults to
+                        None (frame_map_file(dst)); False to not write
+        :type sidecar: str or bool, optional
+        :param frame_rate: frame rate of src, required to write the frame map
+        :type frame_rate: Fraction, optional
+        :raises RuntimeError: if FFmpeg fails
+        :return: output video file
+        :rtype: str
+        """
+
+        run_transcode_args(self.bind(src, dst, threads), src, dst, progress, overwrite)
+        if self.decimate and sidecar is not False:
+            write_frame_map(dst, sidecar or frame_map_file(dst), frame_rate)
+        return dst
+
+    def to_dict(self):
+        """JSON-compatible representation of the plan
+
+        :rtype: dict
+        """
+        return {
+            "src_info": {k: _encode(v) for k, v in self.src_info.items()},
+            "kwargs": {k: _encode(v) for k, v in self.kwargs.items()},
+            "args": {
+                "inputs": [list(x) for x in self.args["inputs"]],
+                "outputs": [list(x) for x in self.args["outputs"]],
+                "global_options": self.args["global_options"],
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """restore a plan from its to_dict() output without recompiling it
+
+        :param data: to_dict() output
+        :type data: dict
+        :rtype: TranscodePlan
+        """
+
+        plan = cls.__new__(cls)
+        src_info = {**data["src_info"]}
+        sar = src_info.get("sample_aspect_ratio", None)
+        if sar is not None:
+            src_info["sample_aspect_ratio"] = Fraction(sar)
+        kwargs = {**data["kwargs"]}
+        if kwargs.get("sar", None) is not None:
+            kwargs["sar"] = Fraction(kwargs["sar"])
+        if kwargs.get("crop", None):
+            kwargs["crop"] = tuple(kwargs["crop"])
+        plan.src_info = src_info
+        plan.kwargs = kwargs
+        args = data["args"]
+        plan.args = {
+            "inputs": [tuple(x) for x in args["inputs"]],
+            "outputs": [tuple(x) for x in args["outputs"]],
+            "global_options": {**args["global_options"]},
+        }
+        return plan
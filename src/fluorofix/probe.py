@@ -1,9 +1,17 @@
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 import logging
 import re
-from ffmpegio import probe
-from os import path, walk
+from os import cpu_count, path, walk
+
+from . import cache, configure
+from .dedupe import find_duplicates
+from .profiles import ProfileMatcher, get_matcher
 
-from . import configure
 
 def remove_file_protocol(url):
     return re.sub(r"^file://(localhost)?(/)?", "", url, flags=re.IGNORECASE)
@@ -15,26 +23,35 @@ def video_info(filepath, profiles=None):
 
     info = None
     try:
-        info = probe.video_streams_basic(filepath)[0]
+        info = cache.video_streams_basic(filepath)[0]
     except:
         pass
 
     prof = None
     try:
-        if info:
+        if info and profiles:
             prof = find_profile(info, profiles)
     finally:
         return info, prof
 
 
 def find_profile(info, profiles):
-    def test(keys):
-        for k, v in keys.items():
-            if str(info[k]) != str(v):
-                return False
-        return True
-
-    return next((k for k, p in profiles.items() if test(p[0])))
+    """find the profile of a video stream
+
+    :param info: video stream info
+    :type info: dict
+    :param profiles: "Profiles" option of a fluorofix context or its compiled
+                     matcher
+    :type profiles: dict or ProfileMatcher
+    :return: name of the most specific matching profile
+    :rtype: str
+    """
+    if not isinstance(profiles, ProfileMatcher):
+        profiles = get_matcher(profiles)
+    prof = profiles.match(info)
+    if prof is None:
+        raise ValueError("no profile matches the video")
+    return prof
 
 
 def get_dst(ctx, src, dstfile=None, dstdir=None):
@@ -95,37 +112,152 @@ def get_dst(ctx, src, dstfile=None, dstdir=None):
     return dst
 
 
-def check_file(ctx, filepath):
+def match_video(ctx, filepath, info):
+    """match a probed video file to its profile and output file
 
-    res = {"prof": None, "dst": None}
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param filepath: video file
+    :type filepath: str
+    :param info: video stream info of the file
+    :type info: dict
+    :return: {"prof", "dst"}, both None if not matched
+    :rtype: dict
+    """
 
-    try:
-        info = probe.video_streams_basic(filepath)[0]
-        assert info["codec_name"] != "ansi"
+    res = {"prof": None, "dst": None}
+    if info["codec_name"] != "ansi":
         try:
             res["prof"] = find_profile(info, ctx["Profiles"])
             res["dst"] = get_dst(ctx, filepath)
         except Exception as e:
             logging.warning(e)
+    return res
+
+
+def check_file(ctx, filepath):
+
+    try:
+        info = cache.video_streams_basic(filepath)[0]
     except:
-        pass
+        return {"prof": None, "dst": None}
 
-    return res
+    return match_video(ctx, filepath, info)
 
 
-def analyze_files(ctx, paths):
-    # scan for json file in the input
-    vid_files, json_files = set(), set()
+def iter_files(paths):
+    """iterate over files, walking directories lazily
 
+    :param paths: files and directories
+    :type paths: seq of str
+    :yield: file path
+    :rtype: str
+    """
     for x in paths:
         if path.isdir(x):
-            for y in [path.join(p, f) for p, _, fs in walk(x) for f in fs]:
-                (vid_files, json_files)[y.endswith(".json")].add(y)
+            for p, _, fs in walk(x):
+                for f in fs:
+                    yield path.join(p, f)
         else:
-            (vid_files, json_files)[x.endswith(".json")].add(x)
+            yield x
+
+
+def check_files(ctx, files, max_workers=None):
+    """check files concurrently and yield the matched videos as they are ready
+
+    At most ``2 * max_workers`` files are in flight at any time, so `files` may
+    be a lazy iterator of arbitrary length.
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param files: files to check
+    :type files: iterable of str
+    :param max_workers: number of concurrent probes, defaults to None (number of CPU cores)
+    :type max_workers: int, optional
+    :yield: file path and its check_file() output
+    :rtype: tuple of str and dict
+    """
+
+    def check(file):
+        return file, check_file(ctx, file)
+
+    max_workers = max_workers or cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for file in files:
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_data = future.result()
+                    if file_data[1]["prof"] is not None:
+                        yield file_data
+            pending.add(executor.submit(check, file))
+
+        for future in as_completed(pending):
+            file_data = future.result()
+            if file_data[1]["prof"] is not None:
+                yield file_data
+
+
+def scan_files(ctx, paths, max_workers=None):
+    """streaming variant of analyze_files: yield matched videos as they are probed
+
+    Option JSON files are ignored.
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param paths: files and directories to scan
+    :type paths: seq of str
+    :param max_workers: number of concurrent probes, defaults to None (number of CPU cores)
+    :type max_workers: int, optional
+    :yield: video file path and {"prof", "dst"}
+    :rtype: tuple of str and dict
+    """
+
+    files = (f for f in iter_files(paths) if not f.endswith(".json"))
+    yield from check_files(ctx, files, max_workers)
+
+
+def find_files(paths):
+    """collect the candidate video files and the option JSON files
+
+    :param paths: files and directories to scan
+    :type paths: seq of str
+    :return: candidate video files and the options of the JSON files
+             {file: options}
+    :rtype: tuple of set and dict
+    """
+    vid_files, json_files = set(), set()
+    for x in iter_files(paths):
+        (vid_files, json_files)[x.endswith(".json")].add(x)
+    return vid_files, {file: configure.readOptionJSON(file) for file in json_files}
+
+
+def match_files(ctx, vid_files, max_workers=None, dedupe=False):
+    """probe video files and match them to their profiles
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param vid_files: candidate video files
+    :type vid_files: iterable of str
+    :param max_workers: number of concurrent probes, defaults to None
+    :type max_workers: int, optional
+    :param dedupe: True to mark identical videos ("dup_of" item), defaults to False
+    :type dedupe: bool, optional
+    :return: matched videos {file: {"prof", "dst"}}
+    :rtype: dict
+    """
+
+    files = dict(check_files(ctx, vid_files, max_workers))
+
+    if dedupe:
+        # mark identical videos to be encoded only once
+        for dup, orig in find_duplicates(files, max_workers).items():
+            files[dup]["dup_of"] = orig
+
+    return files
+
 
-    return {
-        file: data
-        for file, data in [(file, check_file(ctx, file)) for file in vid_files]
-        if data["prof"] is not None
-    }, {file: configure.readOptionJSON(file) for file in json_files}
+def analyze_files(ctx, paths, max_workers=None, dedupe=False):
+    vid_files, opts = find_files(paths)
+    return match_files(ctx, vid_files, max_workers, dedupe), opts
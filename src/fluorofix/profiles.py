@@ -0,0 +1,245 @@
+from fractions import Fraction
+import logging
+import re
+from threading import Lock
+
+WILDCARD = "*"  # match condition: the stream property must only be present
+
+_re_number = re.compile(r"^\s*[-+]?(\d+(\.\d*)?|\.\d+)\s*([/:]\s*\d+\s*)?$")
+
+
+def normalize_value(value):
+    """convert a stream property or a match value to a comparable value
+
+    Numbers, numeric strings ("1080", "29.97", "30000/1001", "8:9"), and
+    2-element number lists ([8, 9]) become Fraction so that, e.g., 1080,
+    "1080", and 1080.0 all compare equal. Other values are kept as they are.
+
+    :param value: value to normalize
+    :type value: any
+    :return: normalized value
+    :rtype: Fraction, str, or any
+    """
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, Fraction)):
+        return Fraction(value)
+    if isinstance(value, float):
+        return Fraction(repr(value))
+    if isinstance(value, str):
+        if _re_number.match(value):
+            return Fraction(value.replace(":", "/").replace(" ", ""))
+        return value
+    if (
+        isinstance(value, (list, tuple))
+        and len(value) == 2
+        and all(isinstance(v, int) and not isinstance(v, bool) for v in value)
+        and value[1]
+    ):
+        return Fraction(*value)
+    return value
+
+
+def _hashable(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+class _Range:
+    def __init__(self, spec):
+        unknown = set(spec) - {"min", "max"}
+        if unknown:
+            raise ValueError(f"unknown range condition keys: {sorted(unknown)}")
+        self.min = normalize_value(spec.get("min", None))
+        self.max = normalize_value(spec.get("max", None))
+
+    def __contains__(self, value):
+        try:
+            return (self.min is None or value >= self.min) and (
+                self.max is None or value <= self.max
+            )
+        except TypeError:
+            return False
+
+    def overlaps(self, other):
+        try:
+            return (
+                self.min is None or other.max is None or self.min <= other.max
+            ) and (self.max is None or other.min is None or other.min <= self.max)
+        except TypeError:
+            return False
+
+
+class _Profile:
+    def __init__(self, name, order, conditions):
+        self.name = name
+        self.order = order
+        self.exact = {}
+        self.ranges = {}
+        self.wildcards = set()
+        for k, v in conditions.items():
+            if v == WILDCARD:
+                self.wildcards.add(k)
+            elif isinstance(v, dict):
+                self.ranges[k] = _Range(v)
+            else:
+                self.exact[k] = _hashable(normalize_value(v))
+        self.signature = tuple(sorted(self.exact))
+        self.key = tuple(self.exact[k] for k in self.signature)
+        self.specificity = (len(self.exact), len(self.ranges), len(self.wildcards))
+
+    def test(self, values):
+        return all(values(k) is not None for k in self.wildcards) and all(
+            values(k) in r for k, r in self.ranges.items()
+        )
+
+    def overlaps(self, other):
+        # True if a stream could satisfy the conditions of both profiles
+        for k, v in self.exact.items():
+            if k in other.exact and other.exact[k] != v:
+                return False
+            if k in other.ranges and v not in other.ranges[k]:
+                return False
+        for k, r in self.ranges.items():
+            if k in other.exact and other.exact[k] not in r:
+                return False
+            if k in other.ranges and not r.overlaps(other.ranges[k]):
+                return False
+        return True
+
+
+class ProfileMatcher:
+    """compiled matcher of the "Profiles" option
+
+    Each profile is matched by the conditions in its match dict. A condition
+    value can be:
+
+    - a value which the stream property must equal. Numbers are compared as
+      numbers regardless of their JSON type (see normalize_value()).
+    - "*" for any value as long as the stream property is present.
+    - {"min": lo, "max": hi} for an inclusive range (either bound optional).
+
+    Profiles are indexed by their exact-match keys and values so that matching
+    a stream takes one dict lookup per distinct set of exact-match keys. When
+    multiple profiles match, the most specific one wins: the one with the most
+    exact conditions, then the most range conditions, then the most wildcards.
+    Equally specific profiles which may match the same stream are ambiguous;
+    they are logged when compiled and the one defined first wins.
+
+    :param profiles: "Profiles" option of a fluorofix context
+    :type profiles: dict
+    """
+
+    def __init__(self, profiles):
+        self._index = {}
+        self._profiles = []
+        for order, (name, (conditions, *_)) in enumerate(profiles.items()):
+            prof = _Profile(name, order, conditions)
+            self._profiles.append(prof)
+            sig = self._index.setdefault(prof.signature, {})
+            sig.setdefault(prof.key, []).append(prof)
+
+        self.ambiguities = self._find_ambiguities()
+        for a, b in self.ambiguities:
+            logging.warning(
+                f'profiles "{a}" and "{b}" are equally specific and may match '
+                f'the same video ("{a}" takes precedence)'
+            )
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def _find_ambiguities(self):
+        groups = {}
+        for prof in self._profiles:
+            groups.setdefault(prof.specificity, []).append(prof)
+        return [
+            (a.name, b.name)
+            for group in groups.values()
+            for i, a in enumerate(group)
+            for b in group[i + 1 :]
+            if a.overlaps(b) and b.overlaps(a)
+        ]
+
+    def candidates(self, info):
+        """all the profiles which match a video stream, most specific first
+
+        :param info: video stream info
+        :type info: dict
+        :return: names of the matching profiles
+        :rtype: list of str
+        """
+
+        normalized = {}
+
+        def values(k):
+            try:
+                return normalized[k]
+            except KeyError:
+                v = normalized[k] = _hashable(normalize_value(info.get(k, None)))
+                return v
+
+        matches = []
+        for sig, table in self._index.items():
+            try:
+                profs = table.get(tuple(values(k) for k in sig), ())
+            except TypeError:  # unhashable stream property
+                continue
+            matches.extend(p for p in profs if p.test(values))
+
+        matches.sort(key=lambda p: (tuple(-n for n in p.specificity), p.order))
+        return [p.name for p in matches]
+
+    def match(self, info):
+        """find the profile of a video stream
+
+        :param info: video stream info
+        :type info: dict
+        :return: name of the most specific matching profile or None if none matches
+        :rtype: str or None
+        """
+        names = self.candidates(info)
+        return names[0] if names else None
+
+
+_matchers = {}
+_matchers_lock = Lock()
+_MAX_MATCHERS = 8
+
+
+def compile_matcher(profiles):
+    """compile the matcher of the profiles and cache it for get_matcher()
+
+    Call it again after modifying the profiles in place.
+
+    :param profiles: "Profiles" option of a fluorofix context
+    :type profiles: dict
+    :return: compiled matcher
+    :rtype: ProfileMatcher
+    """
+
+    matcher = ProfileMatcher(profiles)
+    with _matchers_lock:
+        _matchers.pop(id(profiles), None)
+        if len(_matchers) >= _MAX_MATCHERS:
+            _matchers.pop(next(iter(_matchers)))
+        _matchers[id(profiles)] = (profiles, matcher)
+    return matcher
+
+
+def get_matcher(profiles):
+    """get the compiled matcher of the profiles, compiling it only once
+
+    The matcher is cached per profiles object (validateOptions() compiles it),
+    so profiles modified in place must be recompiled with compile_matcher().
+
+    :param profiles: "Profiles" option of a fluorofix context
+    :type profiles: dict
+    :return: compiled matcher
+    :rtype: ProfileMatcher
+    """
+
+    with _matchers_lock:
+        entry = _matchers.get(id(profiles), None)
+        if entry is not None and entry[0] is profiles:
+            return entry[1]
+    return compile_matcher(profiles)
@@ -0,0 +1,451 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from math import ceil
+from os import makedirs, path
+from tempfile import TemporaryDirectory
+
+from . import cache
+from .batch import job_options
+from .transcode import (
+    adjust_masks,
+    color_rgba,
+    form_filtergraph,
+    get_output_size,
+    render_mask_alpha,
+    write_png,
+)
+
+MARGIN = 4  # pixels around each source/output pair
+BACKGROUND = "gray"  # color of the margins and the empty cells
+
+
+def frame_times(duration, nframes=6):
+    """evenly spaced times to sample the frames of a video at
+
+    :param duration: video duration in seconds
+    :type duration: float or None
+    :param nframes: number of frames, defaults to 6
+    :type nframes: int, optional
+    :return: sample times in seconds, [0.0] if the duration is unknown
+    :rtype: list of float
+    """
+    if not duration:
+        return [0.0]
+    return [(i + 0.5) * duration / nframes for i in range(nframes)]
+
+
+def _even(x):
+    return max(2 * round(x / 2), 2)
+
+
+def render_outline(width, height, mask_shapes, thickness=1):
+    """render the outline of a mask (the boundary of its opaque area)
+
+    :param width: image width
+    :type width: int
+    :param height: image height
+    :type height: int
+    :param mask_shapes: mask shape specifications (keyword arguments for create_mask_alpha)
+    :type mask_shapes: sequence of dicts
+    :param thickness: line width on each side of the boundary, defaults to 1
+    :type thickness: int, optional
+    :return: height-by-width boolean array, True on the outline
+    :rtype: numpy.ndarray
+    """
+
+    import numpy as np
+
+    alpha = render_mask_alpha(width, height, mask_shapes)
+    t = thickness
+    padded = np.pad(alpha, t, mode="edge")
+    outline = np.zeros_like(alpha)
+    for dy in range(-t, t + 1):
+        for dx in range(-t, t + 1):
+            outline |= (
+                padded[t + dy : t + dy + height, t + dx : t + dx + width] != alpha
+            )
+    return outline
+
+
+def _outline_image(filename, width, height, mask_shapes, color):
+    import numpy as np
+
+    rgba = np.zeros((height, width, 4), np.uint8)
+    rgba[render_outline(width, height, mask_shapes)] = np.frombuffer(
+        color_rgba(color), np.uint8
+    )
+    write_png(filename, rgba)
+    return filename
+
+
+def _scale_masks(mask_shapes, sx, sy):
+    return [
+        {
+            **d,
+            "x0": d["x0"] * sx,
+            "y0": d["y0"] * sy,
+            "w": d["w"] * sx,
+            "h": d["h"] * sy,
+        }
+        for d in mask_shapes
+    ]
+
+
+def plan_sheet(src, src_info, kwargs, nframes=6, height=160, cols=3):
+    """plan the contact sheet of a video
+
+    :param src: video file
+    :type src: str
+    :param src_info: video stream info of src
+    :type src_info: dict
+    :param kwargs: transcode() arguments of the video: mask_shapes, sar,
+                   square, crop, and (optionally) color
+    :type kwargs: dict
+    :param nframes: number of sampled frames, defaults to 6
+    :type nframes: int, optional
+    :param height: height of the frame images in the sheet, defaults to 160
+    :type height: int, optional
+    :param cols: number of source/output pairs per row, defaults to 3
+    :type cols: int, optional
+    :return: sheet plan {"src", "info", "kwargs", "times", "panels", "cell",
+             "cols", "size"}
+    :rtype: dict
+    """
+
+    width, vidh = src_info["width"], src_info["height"]
+    sar = kwargs.get("sar", None) or 1
+    square = kwargs.get("square", None)
+    crop = kwargs.get("crop", None) or None
+    outw, outh = get_output_size(width, vidh, sar, square, crop)
+    outsar = 1 if square else sar
+
+    # display (square-pixel) widths of the source and output frame images
+    panels = (
+        _even(height * width * sar / vidh),
+        _even(height * outw * outsar / outh),
+    )
+    cell = (sum(panels) + 2 * MARGIN, height + 2 * MARGIN)
+    times = frame_times(src_info.get("duration", None), nframes)
+    cols = min(cols, len(times))
+    return {
+        "src": src,
+        "info": src_info,
+        "kwargs": kwargs,
+        "times": times,
+        "panels": panels,
+        "cell": cell,
+        "cols": cols,
+        "size": (cols * cell[0], ceil(len(times) / cols) * cell[1]),
+    }
+
+
+def _stack(labels, positions, size, out):
+    # place the labeled images on a canvas
+    if len(labels) == 1:
+        w, h = size
+        return f"{labels[0]}pad={w}:{h}:0:0:color={BACKGROUND}{out}"
+    layout = "|".join(f"{x}_{y}" for x, y in positions)
+    return (
+        f"{''.join(labels)}xstack=inputs={len(labels)}:layout={layout}"
+        f":fill={BACKGROUND}{out}"
+    )
+
+
+def form_sheet_args(plans, dsts, folder, page=None, page_cols=4, outline="red"):
+    """form the FFmpeg arguments to render the contact sheets of videos at once
+
+    Each sampled frame is decoded by seeking its input to the keyframe at or
+    before the sample time and decoding that keyframe only. The frame is
+    shown as is and as masked by transcode(), side by side, both with the
+    outline of the mask drawn on.
+
+    :param plans: sheet plans (see plan_sheet())
+    :type plans: seq of dicts
+    :param dsts: contact sheet image files, one per plan
+    :type dsts: seq of str
+    :param folder: folder to write the outline images in
+    :type folder: str
+    :param page: batch contact sheet image file with the middle frame of every
+                 video, defaults to None (no batch sheet)
+    :type page: str, optional
+    :param page_cols: number of videos per row of the batch sheet, defaults to 4
+    :type page_cols: int, optional
+    :param outline: outline color, defaults to "red"; None to not draw
+    :type outline: str, optional
+    :return: FFmpeg arguments
+    :rtype: dict
+    """
+
+    inputs = []
+    graph = []
+    outputs = []
+    page_cells = []
+
+    def add_input(url, opts=None):
+        inputs.append((url, opts or {}))
+        return len(inputs) - 1
+
+    def add_image(url, label, n):
+        # single image shared by the n sampled frames of a video
+        i = add_input(url)
+        graph.append(f"[{i}:v]split={n}" + "".join(f"[{label}{k}]" for k in range(n)))
+
+    for j, plan in enumerate(plans):
+        info, kwargs, times = plan["info"], plan["kwargs"], plan["times"]
+        n = len(times)
+        width, height = info["width"], info["height"]
+        sw, mw = plan["panels"]
+        cellh = plan["cell"][1] - 2 * MARGIN
+        mask_shapes = kwargs.get("mask_shapes", None) or []
+        sar = kwargs.get("sar", None) or 1
+        square = kwargs.get("square", None)
+        crop = kwargs.get("crop", None) or None
+
+        outlines = [None, None]
+        if outline and mask_shapes:
+            outsize = get_output_size(width, height, sar, square, crop)
+            outshapes = adjust_masks(width, height, mask_shapes, sar, square, crop)
+            outlines = [
+                _outline_image(
+                    path.join(folder, f"outline_{j}_{name}.png"),
+                    panelw,
+                    cellh,
+                    _scale_masks(shapes, panelw / w, cellh / h),
+                    outline,
+                )
+                for name, panelw, shapes, (w, h) in (
+                    ("src", sw, mask_shapes, (width, height)),
+                    ("out", mw, outshapes, outsize),
+                )
+            ]
+            for name, url in zip(("os", "oo"), outlines):
+                add_image(url, f"{name}{j}_", n)
+
+        cells = []
+        for k, t in enumerate(times):
+            i = add_input(
+                plan["src"], {"skip_frame": "nokey", "noaccurate_seek": None, "ss": t}
+            )
+            f = f"f{j}_{k}"
+            graph.append(
+                f"[{i}:v]trim=end_frame=1,setpts=PTS-STARTPTS,split[{f}a][{f}b]"
+            )
+
+            # as transcode() would mask it
+            mask_png, fg = form_filtergraph(
+                width,
+                height,
+                mask_shapes,
+                sar,
+                square,
+                crop,
+                kwargs.get("color", "black"),
+                info.get("pix_fmt", None),
+                src=f"{f}b",
+                mask=f"mk{j}_{k}",
+                out=f"{f}m",
+            )
+            if mask_png is not None:
+                if k == 0:
+                    add_image(mask_png, f"mk{j}_", n)
+                graph.append(fg)
+            else:
+                graph.append(f"[{f}b]{fg or 'null'}[{f}m]")
+
+            for name, src, panelw, url in (
+                ("os", f"{f}a", sw, outlines[0]),
+                ("oo", f"{f}m", mw, outlines[1]),
+            ):
+                chain = f"[{src}]scale={panelw}:{cellh},setsar=1"
+                graph.append(
+                    f"{chain}[{f}{name}];[{f}{name}][{name}{j}_{k}]overlay[{f}{name}x]"
+                    if url
+                    else f"{chain}[{f}{name}x]"
+                )
+
+            graph.append(
+                f"[{f}osx][{f}oox]hstack,pad=iw+{2 * MARGIN}:ih+{2 * MARGIN}"
+                f":{MARGIN}:{MARGIN}:color={BACKGROUND}"
+                + (f",split[{f}c][{f}p]" if page and k == n // 2 else f"[{f}c]")
+            )
+            cells.append(f"[{f}c]")
+
+        cellw, cellh = plan["cell"]
+        cols = plan["cols"]
+        positions = [(k % cols * cellw, k // cols * cellh) for k in range(n)]
+        graph.append(_stack(cells, positions, plan["size"], f"[sheet{j}]"))
+        outputs.append((dsts[j], {"map": f"[sheet{j}]", "frames:v": 1, "update": 1}))
+
+        if page:
+            page_cells.append((f"[f{j}_{n // 2}p]", plan["cell"]))
+
+    if page:
+        cellw = max(w for _, (w, _) in page_cells)
+        cellh = max(h for _, (_, h) in page_cells)
+        cols = min(page_cols, len(page_cells))
+        labels = []
+        for j, (label, _) in enumerate(page_cells):
+            graph.append(
+                f"{label}pad={cellw}:{cellh}:(ow-iw)/2:(oh-ih)/2"
+                f":color={BACKGROUND}[page{j}]"
+            )
+            labels.append(f"[page{j}]")
+        positions = [(j % cols * cellw, j // cols * cellh) for j in range(len(labels))]
+        size = (cols * cellw, ceil(len(labels) / cols) * cellh)
+        graph.append(_stack(labels, positions, size, "[page]"))
+        outputs.append((page, {"map": "[page]", "frames:v": 1, "update": 1}))
+
+    return {
+        "inputs": inputs,
+        "outputs": outputs,
+        "global_options": {"filter_complex": ";".join(graph)},
+    }
+
+
+def render_sheets(plans, dsts, page=None, page_cols=4, outline="red"):
+    """render the contact sheets of videos in one FFmpeg run
+
+    :param plans: sheet plans (see plan_sheet())
+    :type plans: seq of dicts
+    :param dsts: contact sheet image files, one per plan
+    :type dsts: seq of str
+    :param page: batch contact sheet image file, defaults to None
+    :type page: str, optional
+    :param page_cols: number of videos per row of the batch sheet, defaults to 4
+    :type page_cols: int, optional
+    :param outline: mask outline color, defaults to "red"; None to not draw
+    :type outline: str, optional
+    :raises RuntimeError: if FFmpeg fails
+    """
+
+    from ffmpegio import ffmpegprocess
+
+    with TemporaryDirectory() as tmpdir:
+        args = form_sheet_args(plans, dsts, tmpdir, page, page_cols, outline)
+        ret = ffmpegprocess.run(args, capture_log=True, overwrite=True)
+    if ret.returncode:
+        raise RuntimeError(f"FFmpeg failed to render the contact sheets: {ret.stderr}")
+
+
+def sheet_file(src, folder):
+    """contact sheet image file of a video
+
+    :param src: video file
+    :type src: str
+    :param folder: output folder
+    :type folder: str
+    :rtype: str
+    """
+    return path.join(folder, f"{path.splitext(path.basename(src))[0]}_qa.png")
+
+
+def contact_sheets(
+    ctx,
+    files,
+    folder,
+    nframes=6,
+    cols=3,
+    height=160,
+    files_per_run=8,
+    page_cols=4,
+    max_workers=None,
+    outline="red",
+):
+    """render the de-identification QA contact sheets of a batch
+
+    For each video, a few evenly spaced keyframes are shown as they are and as
+    masked by its profile, side by side, with the outline of the mask drawn on
+    both. Only the sampled keyframes are decoded, and the sheets of up to
+    `files_per_run` videos are rendered by one FFmpeg run, which also renders
+    a batch contact sheet page with the middle frame of each of its videos.
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param files: analyze_files() output {file: {"prof", "dst"}}
+    :type files: dict
+    :param folder: output folder of the contact sheet images
+    :type folder: str
+    :param nframes: number of sampled frames per video, defaults to 6
+    :type nframes: int, optional
+    :param cols: number of frame pairs per row of a sheet, defaults to 3
+    :type cols: int, optional
+    :param height: height of the frame images, defaults to 160
+    :type height: int, optional
+    :param files_per_run: maximum number of videos per FFmpeg run, defaults to 8
+    :type files_per_run: int, optional
+    :param page_cols: number of videos per row of a batch page, defaults to 4
+    :type page_cols: int, optional
+    :param max_workers: maximum number of concurrent FFmpeg runs, defaults to
+                        None (ThreadPoolExecutor default)
+    :type max_workers: int, optional
+    :param outline: mask outline color, defaults to "red"
+    :type outline: str, optional
+    :return: {file: sheet image} (None if failed) and the batch sheet pages
+    :rtype: tuple of dict and list of str
+    """
+
+    makedirs(folder, exist_ok=True)
+
+    sheets = {}
+    plans = []
+    used = set()
+    for src, data in sorted(files.items()):
+        try:
+            info = cache.video_streams_basic(src)[0]
+        except Exception as e:
+            logging.warning(f"{src}: not a video file ({e})")
+            sheets[src] = None
+            continue
+        try:
+            kwargs = job_options(ctx, data["prof"], info)
+            plan = plan_sheet(src, info, kwargs, nframes, height, cols)
+        except Exception as e:
+            logging.warning(f"{src}: cannot plan the sheet ({e})")
+            sheets[src] = None
+            continue
+
+        dst = sheet_file(src, folder)
+        root, ext = path.splitext(dst)
+        i = 1
+        while dst in used:  # same name in different folders
+            dst = f"{root}_{i}{ext}"
+            i += 1
+        used.add(dst)
+        plans.append((plan, dst))
+
+    chunks = [plans[i : i + files_per_run] for i in range(0, len(plans), files_per_run)]
+    pages = [path.join(folder, f"qa_batch_{i:03d}.png") for i in range(len(chunks))]
+
+    def run(chunk, page):
+        try:
+            render_sheets(
+                [p for p, _ in chunk], [d for _, d in chunk], page, page_cols, outline
+            )
+            return {p["src"]: d for p, d in chunk}, page
+        except RuntimeError:
+            if len(chunk) == 1:
+                logging.warning(f"{chunk[0][0]['src']}: failed to render the sheet")
+                return {chunk[0][0]["src"]: None}, None
+
+        # find the failing videos one by one
+        res = {}
+        for item in chunk:
+            res.update(run([item], None)[0])
+        ok = [(p, d) for p, d in chunk if res[p["src"]] is not None]
+        if ok and page:
+            try:
+                render_sheets(
+                    [p for p, _ in ok], [d for _, d in ok], page, page_cols, outline
+                )
+            except RuntimeError:
+                page = None
+        return res, page if ok else None
+
+    done = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for res, page in executor.map(run, chunks, pages):
+            sheets.update(res)
+            if page is not None:
+                done.append(page)
+
+    return sheets, done
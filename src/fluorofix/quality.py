@@ -0,0 +1,355 @@
+import json
+import logging
+from math import sqrt
+from os import getpid, makedirs, path, replace
+import re
+from tempfile import TemporaryDirectory
+
+from . import cache
+from .batch import job_options
+from .transcode import adjust_masks, get_output_size, transcode
+
+# CRF search range of the supported encoders
+CRF_RANGES = {"libx264": (0, 51), "libx265": (0, 51), "libsvtav1": (0, 63)}
+
+
+def sample_times(duration, nsamples=3, length=4.0):
+    """evenly spaced sample segments of a video
+
+    :param duration: video duration in seconds
+    :type duration: float
+    :param nsamples: number of segments, defaults to 3
+    :type nsamples: int, optional
+    :param length: segment duration in seconds, defaults to 4.0
+    :type length: float, optional
+    :return: list of (tstart, tend) or [(None, None)] if the video is too short
+             to be sampled
+    :rtype: list of tuples
+    """
+    if not duration or duration <= nsamples * length:
+        return [(None, None)]
+    step = duration / nsamples
+    return [
+        ((i + 0.5) * step - length / 2, (i + 0.5) * step + length / 2)
+        for i in range(nsamples)
+    ]
+
+
+def fov_window(width, height, mask_shapes, sar=1, square=None, crop=None):
+    """largest rectangle in the output frame which is entirely in the field of view
+
+    The field of view is the first mask shape which is not filled in: the
+    rectangle itself or the rectangle inscribed in the ellipse.
+
+    :param width: input video frame width
+    :type width: int
+    :param height: input video frame height
+    :type height: int
+    :param mask_shapes: mask shape specifications
+    :type mask_shapes: sequence of dicts
+    :param sar: sample aspect ratio, defaults to 1
+    :type sar: int or Fraction, optional
+    :param square: non-None to square non-square pixels, defaults to None
+    :type square: None, "upscale" or "downscale", optional
+    :param crop: tuple (x0, y0, w, h) to crop or None, defaults to None
+    :type crop: sequence of 4 ints, optional
+    :return: (x, y, w, h) in the output frame, or None for the whole frame
+    :rtype: tuple of 4 ints or None
+    """
+
+    shapes = adjust_masks(width, height, mask_shapes or [], sar, square, crop or None)
+    fov = next((s for s in shapes if not s.get("fill_in", False)), None)
+    if fov is None:
+        return None
+
+    x0, y0, w, h = fov["x0"], fov["y0"], fov["w"], fov["h"]
+    if not fov.get("is_rect", False):
+        x0 += w * (1 - 1 / sqrt(2)) / 2
+        y0 += h * (1 - 1 / sqrt(2)) / 2
+        w /= sqrt(2)
+        h /= sqrt(2)
+
+    outw, outh = get_output_size(width, height, sar, square, crop or None)
+    x1, y1 = min(x0 + w, outw), min(y0 + h, outh)
+    x0, y0 = max(x0, 0), max(y0, 0)
+    # even size & offsets for the chroma subsampling
+    x = int(x0 + 1) // 2 * 2
+    y = int(y0 + 1) // 2 * 2
+    return (x, y, int(x1 - x) // 2 * 2, int(y1 - y) // 2 * 2)
+
+
+def measure_quality(dist, ref, window=None):
+    """measure SSIM and PSNR of a video against its reference
+
+    :param dist: distorted (encoded) video file
+    :type dist: str
+    :param ref: reference video file
+    :type ref: str
+    :param window: (x, y, w, h) to compare, defaults to None (whole frame)
+    :type window: tuple of 4 ints, optional
+    :return: {"ssim", "psnr"} averaged over all the frames
+    :rtype: dict
+    """
+
+    from ffmpegio import ffmpegprocess
+
+    crop = "crop={2}:{3}:{0}:{1},".format(*window) if window else ""
+    fg = (
+        f"[0:v]{crop}split[d0][d1];[1:v]{crop}split[r0][r1];"
+        "[d0][r0]ssim;[d1][r1]psnr"
+    )
+    args = {
+        "inputs": [(dist, {}), (ref, {})],
+        "outputs": [("-", {"f": "null"})],
+        "global_options": {"filter_complex": fg, "loglevel": "info"},
+    }
+    ret = ffmpegprocess.run(args, capture_log=True)
+    if ret.returncode:
+        raise RuntimeError(f"FFmpeg failed to compare {dist} and {ref}")
+
+    ssim = re.search(r"SSIM .*All:([\d.]+)", ret.stderr)
+    psnr = re.search(r"PSNR .*average:([\d.]+|inf)", ret.stderr)
+    return {
+        "ssim": float(ssim[1]) if ssim else None,
+        "psnr": float(psnr[1]) if psnr else None,
+    }
+
+
+def bisect_crf(test, lo, hi):
+    """find the smallest CRF which passes a test
+
+    :param test: monotonic test function of CRF: False for all CRF below the
+                 boundary, True for all CRF above
+    :type test: Callable
+    :param lo: smallest CRF
+    :type lo: int
+    :param hi: largest CRF
+    :type hi: int
+    :return: smallest passing CRF or None if none passes
+    :rtype: int or None
+    """
+    if not test(hi):
+        return None
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if test(mid):
+            hi = mid
+        else:
+            lo = mid + 1
+    return hi
+
+
+def _encoder_options(codec, enc_config):
+    opts = {**enc_config, "c:v": codec, "an": None}
+    if codec == "libsvtav1" and not isinstance(opts.get("preset", 0), int):
+        opts["preset"] = 8  # x264 preset names are not valid
+    return opts
+
+
+def _quality_cache_file():
+    return path.join(cache.cache_dir(), "quality.json")
+
+
+def _load_cache():
+    try:
+        with open(_quality_cache_file(), "rt") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(key, entry):
+    filename = _quality_cache_file()
+    data = _load_cache()
+    data[key] = entry
+    makedirs(path.dirname(filename), exist_ok=True)
+    tmpfile = f"{filename}.{getpid()}.tmp"
+    with open(tmpfile, "wt") as f:
+        json.dump(data, f, indent=2)
+    replace(tmpfile, filename)
+
+
+def select_output_options(
+    ctx,
+    prof,
+    src,
+    src_info=None,
+    ssim=None,
+    psnr=None,
+    bitrate=None,
+    codecs=("libx264",),
+    nsamples=3,
+    length=4.0,
+    use_cache=True,
+):
+    """pick the OutputOptions of a profile from sampled segments of a video
+
+    A few short segments of `src` are transcoded with the profile's mask and
+    crop plan at each candidate CRF, and their SSIM and PSNR are measured
+    against a lossless encode of the same segments, inside the field of view.
+    CRF is bisected per codec to reach the target: the largest CRF with
+    `ssim` and `psnr` at or above their targets (both must be met if both are
+    given), or the smallest CRF with the `bitrate` at or below the target. Among the codecs, the one with the least
+    bitrate (or the best SSIM for a bitrate target) is chosen.
+
+    The selection is cached per profile (and target) in cache_dir().
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param prof: name of the profile
+    :type prof: str
+    :param src: sample video file of the profile
+    :type src: str
+    :param src_info: video stream info of src, defaults to None (to probe)
+    :type src_info: dict, optional
+    :param ssim: target SSIM, defaults to None (0.98 if no other target is given)
+    :type ssim: float, optional
+    :param psnr: target PSNR in dB, defaults to None
+    :type psnr: float, optional
+    :param bitrate: target bitrate in bits/s, defaults to None
+    :type bitrate: float, optional
+    :param codecs: encoders to compare, defaults to ("libx264",)
+    :type codecs: seq of str, optional
+    :param nsamples: number of sample segments, defaults to 3
+    :type nsamples: int, optional
+    :param length: duration of each sample segment in seconds, defaults to 4.0
+    :type length: float, optional
+    :param use_cache: False to ignore the cached selection, defaults to True
+    :type use_cache: bool, optional
+    :raises ValueError: if a bitrate target is combined with a quality target
+    :return: {"OutputOptions", "codec", "crf", "ssim", "psnr", "bitrate"}
+    :rtype: dict
+    """
+
+    if bitrate is not None and (ssim is not None or psnr is not None):
+        raise ValueError("a bitrate target cannot be combined with SSIM or PSNR")
+    if ssim is None and psnr is None and bitrate is None:
+        ssim = 0.98
+    target = {"ssim": ssim, "psnr": psnr, "bitrate": bitrate}
+
+    enc_config = {**ctx.get("OutputOptions", {})}
+    enc_config.pop("crf", None)
+
+    key = json.dumps(
+        {
+            "profile": [prof, ctx["Profiles"][prof][1]],
+            "target": target,
+            "codecs": list(codecs),
+            "options": enc_config,
+            "samples": [nsamples, length],
+        },
+        sort_keys=True,
+    )
+    if use_cache:
+        entry = _load_cache().get(key, None)
+        if entry is not None:
+            return entry
+
+    if src_info is None:
+        try:
+            src_info = cache.video_streams_basic(src)[0]
+        except Exception:
+            raise ValueError("not a video file")
+
+    kwargs = job_options(ctx, prof, src_info)
+    kwargs.pop("enc_config")
+    kwargs.pop("overwrite")
+    window = fov_window(
+        src_info["width"],
+        src_info["height"],
+        kwargs["mask_shapes"],
+        kwargs["sar"],
+        kwargs["square"],
+        kwargs["crop"],
+    )
+    samples = sample_times(src_info.get("duration", None), nsamples, length)
+
+    with TemporaryDirectory() as tmpdir:
+
+        def encode(name, opts):
+            files = []
+            for i, (t0, t1) in enumerate(samples):
+                dst = path.join(tmpdir, f"{name}_{i}.mkv")
+                transcode(
+                    src,
+                    dst,
+                    t0,
+                    t1,
+                    src_info=src_info,
+                    enc_config=opts,
+                    overwrite=True,
+                    remux=False,
+                    **kwargs,
+                )
+                files.append(dst)
+            return files
+
+        refs = encode(
+            "ref",
+            {
+                **_encoder_options("libx264", enc_config),
+                "preset": "ultrafast",
+                "qp": 0,
+            },
+        )
+        tsample = sum(
+            (t1 - t0) if t0 is not None else src_info.get("duration", 1.0) or 1.0
+            for t0, t1 in samples
+        )
+
+        results = {}
+
+        def evaluate(codec, crf):
+            if (codec, crf) not in results:
+                opts = {**_encoder_options(codec, enc_config), "crf": crf}
+                files = encode(f"{codec}_{crf}", opts)
+                q = [measure_quality(d, r, window) for d, r in zip(files, refs)]
+                results[codec, crf] = {
+                    "ssim": sum(v["ssim"] for v in q) / len(q),
+                    "psnr": sum(v["psnr"] for v in q) / len(q),
+                    "bitrate": sum(path.getsize(f) for f in files) * 8 / tsample,
+                }
+                logging.info(f"{prof}: {codec} crf={crf}: {results[codec, crf]}")
+            return results[codec, crf]
+
+        best = None
+        for codec in codecs:
+            lo, hi = CRF_RANGES.get(codec, (0, 51))
+            if bitrate is not None:
+                crf = bisect_crf(
+                    lambda c: evaluate(codec, c)["bitrate"] <= bitrate, lo, hi
+                )
+            else:
+
+                def too_lossy(c):
+                    q = evaluate(codec, c)
+                    return (ssim is not None and q["ssim"] < ssim) or (
+                        psnr is not None and q["psnr"] < psnr
+                    )
+
+                crf = bisect_crf(too_lossy, lo, hi)
+                crf = hi if crf is None else crf - 1
+                if crf < lo:
+                    crf = None
+            if crf is None:
+                logging.warning(f"{prof}: {codec} cannot reach the target {target}")
+                continue
+
+            res = {"codec": codec, "crf": crf, **evaluate(codec, crf)}
+            if (
+                best is None
+                or (bitrate is None and res["bitrate"] < best["bitrate"])
+                or (bitrate is not None and res["ssim"] > best["ssim"])
+            ):
+                best = res
+
+    if best is None:
+        raise ValueError(f"no codec meets the target {target}")
+
+    best["OutputOptions"] = {
+        **_encoder_options(best["codec"], ctx.get("OutputOptions", {})),
+        "crf": best["crf"],
+    }
+    best["OutputOptions"].pop("an")
+    _save_cache(key, best)
+    return best
@@ -1,9 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from fractions import Fraction
+from functools import lru_cache
+from math import ceil, floor
+import hashlib
+import json
 import logging
-from ffmpegio import probe, ffmpegprocess, FFConcat
+import re
+import struct
+import zlib
+from subprocess import PIPE
 from tempfile import TemporaryDirectory
-from os import path, makedirs
+from threading import Thread, get_ident
+from time import time
+from os import (
+    PathLike,
+    cpu_count,
+    path,
+    makedirs,
+    getpid,
+    listdir,
+    remove,
+    replace,
+    utime,
+)
+
+from . import cache, metrics
 
 
 def create_mask_alpha(vidw, vidh, x0, y0, w, h, fill_in=False, is_rect=False):
@@ -81,6 +103,177 @@ def create_mask(vidw, vidh, mask_shapes, color="black"):
     return f"color=c={color}:s={vidw}x{vidh}[cin];{alpha_fg},[cin]alphamerge,trim=end_frame=1"
 
 
+def render_mask_alpha(vidw, vidh, mask_shapes):
+    """render the alpha channel of a mask (NumPy equivalent of create_mask)
+
+    :param vidw: video frame width
+    :type vidw: int
+    :param vidh: video frame height
+    :type vidh: int
+    :param mask_shapes: mask shape specifications (keyword arguments for create_mask_alpha)
+    :type mask_shapes: sequence of dicts
+    :return: vidh-by-vidw boolean array, True where the mask is opaque
+    :rtype: numpy.ndarray
+    """
+
+    import numpy as np
+
+    X = np.arange(vidw)[np.newaxis, :]
+    Y = np.arange(vidh)[:, np.newaxis]
+
+    alpha = np.zeros((vidh, vidw), bool)
+    for d in mask_shapes:
+        x0, y0, w, h = d["x0"], d["y0"], d["w"], d["h"]
+        fill_in = d.get("fill_in", False)
+        if d.get("is_rect", False):
+            a = (X >= x0) & (X < x0 + w) & (Y >= y0) & (Y < y0 + h)
+            if not fill_in:
+                a = ~a
+        else:
+            rx = w / 2
+            ry = h / 2
+            a = ((X - (x0 + rx - 0.5)) ** 2 / rx**2) + (
+                (Y - (y0 + ry - 0.5)) ** 2 / ry**2
+            )
+            a = a <= 1 if fill_in else a > 1
+        alpha |= a
+
+    return alpha
+
+
+def write_png(filename, rgba):
+    """write an 8-bit RGBA image as a PNG file
+
+    :param filename: output file
+    :type filename: str
+    :param rgba: image
+    :type rgba: numpy.ndarray, uint8, shape (height, width, 4)
+    """
+    import numpy as np
+
+    def chunk(tag, data):
+        return (
+            struct.pack(">I", len(data))
+            + tag
+            + data
+            + struct.pack(">I", zlib.crc32(tag + data))
+        )
+
+    h, w, _ = rgba.shape
+    raw = np.empty((h, w * 4 + 1), np.uint8)
+    raw[:, 0] = 0  # no filter
+    raw[:, 1:] = rgba.reshape(h, -1)
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 6, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+@lru_cache(maxsize=None)
+def color_rgba(color):
+    """resolve an FFmpeg color expression
+
+    :param color: FFmpeg color, e.g., "black", "#ff0000", or "red@0.5"
+    :type color: str
+    :raises ValueError: if FFmpeg does not recognize the color
+    :return: RGBA bytes
+    :rtype: bytes
+    """
+    from ffmpegio import ffmpegprocess
+
+    color, *alpha = color.split("@", 1)
+    color = {"black": "#000000", "white": "#ffffff"}.get(color.lower(), color)
+    m = re.match(r"(?:#|0x)([0-9a-f]{6})([0-9a-f]{2})?$", color, re.IGNORECASE)
+    if m:
+        rgba = bytes.fromhex(m[1] + (m[2] or "ff"))
+    else:
+        out = ffmpegprocess.run(
+            {
+                "inputs": [(f"color=c={color}:s=1x1,format=rgba", {"f": "lavfi"})],
+                "outputs": [("-", {"frames:v": 1, "f": "rawvideo", "pix_fmt": "rgba"})],
+            },
+            capture_log=True,
+        )
+        if out.returncode or len(out.stdout) != 4:
+            raise ValueError(f"invalid color: {color}")
+        rgba = out.stdout
+    if alpha:
+        a = float(alpha[0])
+        rgba = rgba[:3] + bytes([round(rgba[3] * (a if a <= 1 else a / 255))])
+    return rgba
+
+
+MASK_CACHE_SIZE = 256  # maximum number of mask images kept in the disk cache
+
+
+@lru_cache(maxsize=64)
+def _mask_image(vidw, vidh, shapes, color, folder):
+    # shapes: JSON string of mask_shapes
+    import numpy as np
+
+    key = hashlib.sha1(f"{vidw}x{vidh}:{shapes}:{color}".encode()).hexdigest()
+    filename = path.join(folder, f"mask_{key}.png")
+
+    if path.exists(filename):
+        utime(filename)  # mark as recently used
+        return filename
+
+    rgba = np.empty((vidh, vidw, 4), np.uint8)
+    rgba[...] = np.frombuffer(color_rgba(color), np.uint8)
+    alpha = render_mask_alpha(vidw, vidh, json.loads(shapes))
+    rgba[..., 3] = np.where(alpha, rgba[..., 3], 0)
+
+    makedirs(folder, exist_ok=True)
+    tmpname = f"{filename}.{getpid()}.{get_ident()}.tmp"
+    write_png(tmpname, rgba)
+    replace(tmpname, filename)
+
+    # evict least recently used images
+    files = [path.join(folder, f) for f in listdir(folder) if f.startswith("mask_")]
+    if len(files) > MASK_CACHE_SIZE:
+        files.sort(key=path.getmtime)
+        for f in files[: len(files) - MASK_CACHE_SIZE]:
+            try:
+                remove(f)
+            except OSError:
+                pass
+
+    return filename
+
+
+def create_mask_image(vidw, vidh, mask_shapes, color="black", folder=None):
+    """get a pre-rendered RGBA mask image file
+
+    The mask image is rendered once per (vidw, vidh, mask_shapes, color) and is
+    kept in both memory and disk caches.
+
+    :param vidw: video frane width
+    :type vidw: int
+    :param vidh: video frame height
+    :type vidh: int
+    :param mask_shapes: mask shape specifications (keyword arguments for create_mask_alpha)
+    :type mask_shapes: sequence of dicts
+    :param color: mask color, defaults to 'black'
+    :type color: str, optional
+    :param folder: cache folder, defaults to None ("masks" folder in cache.cache_dir())
+    :type folder: str, optional
+    :return: path of the PNG mask image
+    :rtype: str
+    """
+
+    if folder is None:
+        folder = path.join(cache.cache_dir(), "masks")
+
+    shapes = json.dumps([dict(sorted(d.items())) for d in mask_shapes])
+    filename = _mask_image(vidw, vidh, shapes, color, folder)
+    if not path.exists(filename):
+        # evicted from the disk cache by another process
+        _mask_image.cache_clear()
+        filename = _mask_image(vidw, vidh, shapes, color, folder)
+    return filename
+
+
 def masks_to_crop(vidw, vidh, mask_shapes):
     """find extent of unmasked area
 
@@ -200,50 +393,259 @@ def adjust_masks(width, height, mask_shapes, sar=1, square=None, crop=None):
     return mask_shapes
 
 
-def form_vf(width, height, sar=None, src=None, mask=None, square=None, crop=None):
+def plan_masks(width, height, mask_shapes, crop=None):
+    """simplify mask shapes for the cropped video frame
+
+    Masks which the crop already removes are dropped, and rectangular masks are
+    converted to solid boxes (for the drawbox filter). Only the remaining
+    elliptical masks need to be overlaid.
+
+    :param width: original video frame width
+    :type width: int
+    :param height: original video frame height
+    :type height: int
+    :param mask_shapes: mask shape specifications (keyword arguments for create_mask_alpha)
+    :type mask_shapes: sequence of dicts
+    :param crop: tuple (x0, y0, w, h) to crop, defaults to None
+    :type crop: sequence of 4 ints, optional
+    :return: boxes (x, y, w, h) in the cropped frame and the remaining
+             (elliptical) mask shapes in the original frame
+    :rtype: tuple of list of tuples and list of dicts
+    """
+
+    if crop is not None and crop is not False:
+        wx0, wy0, w, h = (int(v) for v in crop)
+        wx1, wy1 = wx0 + w, wy0 + h
+    else:
+        wx0, wy0, wx1, wy1 = 0, 0, width, height
+
+    def add_box(x0, y0, x1, y1):
+        if x0 < x1 and y0 < y1:
+            boxes.append((x0 - wx0, y0 - wy0, x1 - x0, y1 - y0))
+
+    boxes = []
+    shapes = []
+    for d in mask_shapes:
+        x0, y0, w, h = d["x0"], d["y0"], d["w"], d["h"]
+        fill_in = d.get("fill_in", False)
+        if d.get("is_rect", False):
+            # pixels covered by the rectangle, clipped to the crop window
+            ix0 = min(max(ceil(x0), wx0), wx1)
+            iy0 = min(max(ceil(y0), wy0), wy1)
+            ix1 = max(min(ceil(x0 + w), wx1), ix0)
+            iy1 = max(min(ceil(y0 + h), wy1), iy0)
+            if fill_in:
+                add_box(ix0, iy0, ix1, iy1)
+            elif ix0 < ix1 and iy0 < iy1:
+                add_box(wx0, wy0, wx1, iy0)  # top
+                add_box(wx0, iy1, wx1, wy1)  # bottom
+                add_box(wx0, iy0, ix0, iy1)  # left
+                add_box(ix1, iy0, wx1, iy1)  # right
+            else:
+                add_box(wx0, wy0, wx1, wy1)
+        else:
+            rx = w / 2
+            ry = h / 2
+            xe = x0 + rx - 0.5
+            ye = y0 + ry - 0.5
+            if fill_in:
+                keep = (
+                    ceil(xe - rx) < wx1
+                    and floor(xe + rx) >= wx0
+                    and ceil(ye - ry) < wy1
+                    and floor(ye + ry) >= wy0
+                )
+            else:
+                # drop if the crop window lies inside the ellipse
+                keep = any(
+                    (x - xe) ** 2 / rx**2 + (y - ye) ** 2 / ry**2 > 1
+                    for x in (wx0, wx1 - 1)
+                    for y in (wy0, wy1 - 1)
+                )
+            if keep:
+                shapes.append(d)
+
+    return boxes, shapes
+
+
+def overlay_format(pix_fmt):
+    """get the overlay filter format to blend in the video's native pixel format
+
+    :param pix_fmt: pixel format of the video
+    :type pix_fmt: str
+    :return: value of the overlay filter's format option
+    :rtype: str
+    """
+    m = re.match(r"yuvj?(420|422|444)p(10)?", pix_fmt or "")
+    return f"yuv{m[1]}{'p10' if m[2] else ''}" if m else "auto"
+
+
+def form_vf(
+    width,
+    height,
+    sar=None,
+    src=None,
+    mask=None,
+    square=None,
+    crop=None,
+    boxes=None,
+    color="black",
+    mask_first=False,
+    mask_format=None,
+    out="vout",
+):
     # square: None, 'upscale','downscale'
     # sar
     # crop
     # mask
+    # boxes: solid boxes to draw (x, y, w, h) in the cropped frame
+    # mask_first: True to overlay the mask before scaling
+    # mask_format: overlay filter format
+    # out: output label if masked
 
-    filt_specs = []
+    pre_specs = []
 
     if crop is not None and crop is not False:
         x0, y0, width, height = crop
-        filt_specs.append(f"crop={width}:{height}:{x0}:{y0}")
+        pre_specs.append(f"crop={width}:{height}:{x0}:{y0}")
 
-    if not isinstance(sar, Fraction):
-        sar = Fraction(sar)
+    if boxes:
+        pre_specs.extend(
+            f"drawbox=x={x}:y={y}:w={w}:h={h}:color={color}:t=fill"
+            for x, y, w, h in boxes
+        )
+
+    filt_specs = []
 
     if sar is None:
         if square:
             logging.warning("square option is set but SAR is undefined")
-    elif sar != 1 and square:
-        w, h = get_output_size(width, height, sar, square, None)
-        filt_specs.append(f"scale=h={h}" if height != h else f"scale=w={w}")
-        filt_specs.append(f"setsar=1:1")
     else:
-        sarw, sarh = sar.as_integer_ratio()
-        filt_specs.append(f"setsar={sarw}:{sarh}")
+        if not isinstance(sar, Fraction):
+            sar = Fraction(sar)
+        if sar != 1 and square:
+            w, h = get_output_size(width, height, sar, square, None)
+            filt_specs.append(f"scale=h={h}" if height != h else f"scale=w={w}")
+            filt_specs.append(f"setsar=1:1")
+        else:
+            sarw, sarh = sar.as_integer_ratio()
+            # "a:b" would be parsed as the ratio a and its max option b
+            filt_specs.append(f"setsar={sarw}/{sarh}")
 
-    fg = ",".join(filt_specs)
+    if not mask:
+        return ",".join(pre_specs + filt_specs)
 
-    # configure masking setup
-    if mask:
-        # add labels to the main filter chain
-        fg = (
-            f"[{src}]{fg}[main];[main][{mask}]overlay[vout]"
-            if fg
-            else f"[{src}][{mask}]overlay[vout]"
+    overlay = f"overlay=format={mask_format}" if mask_format else "overlay"
+
+    if mask_first:
+        post = ",".join(filt_specs)
+        overlay = f"{overlay},{post}" if post else overlay
+    else:
+        pre_specs.extend(filt_specs)
+
+    # add labels to the main filter chain
+    fg = ",".join(pre_specs)
+    return (
+        f"[{src}]{fg}[{out}_main];[{out}_main][{mask}]{overlay}[{out}]"
+        if fg
+        else f"[{src}][{mask}]{overlay}[{out}]"
+    )
+
+
+def form_filtergraph(
+    width,
+    height,
+    mask_shapes=None,
+    sar=None,
+    square=None,
+    crop=None,
+    color="black",
+    pix_fmt=None,
+    src="0:v",
+    mask="1:v",
+    out="vout",
+):
+    """plan the cheapest filtergraph to crop, mask, and rescale a video
+
+    Masks removed by the crop are dropped, rectangular masks are drawn by
+    drawbox, and the remaining masks are overlaid as a pre-rendered image in
+    the video's native pixel format, before or after the rescaling, whichever
+    has fewer pixels.
+
+    :param width: original video frame width
+    :type width: int
+    :param height: original video frame height
+    :type height: int
+    :param mask_shapes: mask shape specifications (keyword arguments for create_mask_alpha),
+                        defaults to None
+    :type mask_shapes: sequence of dicts, optional
+    :param sar: sample aspect ratio, defaults to None
+    :type sar: int or Fraction, optional
+    :param square: non-None to square non-square pixels, defaults to None
+    :type square: None, "upscale" or "downscale", optional
+    :param crop: tuple (x0, y0, w, h) to crop, defaults to None
+    :type crop: sequence of 4 ints, optional
+    :param color: mask color, defaults to "black"
+    :type color: str, optional
+    :param pix_fmt: pixel format of the video, defaults to None
+    :type pix_fmt: str, optional
+    :param src: label of the video input, defaults to "0:v"
+    :type src: str, optional
+    :param mask: label of the mask image input, defaults to "1:v"
+    :type mask: str, optional
+    :param out: output label of the masked video, defaults to "vout"
+    :type out: str, optional
+    :return: mask image file (None if not needed) and filtergraph. If the mask
+             image is given, the filtergraph is a labeled filter_complex
+             expression with the output label [out]; otherwise, it is a
+             simple filterchain
+    :rtype: tuple of str or None and str
+    """
+
+    boxes, mask_shapes = plan_masks(width, height, mask_shapes or [], crop)
+
+    outsize = get_output_size(width, height, sar or 1, square, crop)
+    cropsize = get_output_size(width, height, 1, None, crop)
+    mask_first = outsize[0] * outsize[1] >= cropsize[0] * cropsize[1]
+
+    mask_png = None
+    if len(mask_shapes):
+        if mask_first:
+            mask_shapes = adjust_masks(width, height, mask_shapes, 1, None, crop)
+        else:
+            mask_shapes = adjust_masks(width, height, mask_shapes, sar, square, crop)
+        mask_png = create_mask_image(
+            *(cropsize if mask_first else outsize), mask_shapes, color
         )
 
-    return fg
+    fg = form_vf(
+        width,
+        height,
+        sar,
+        src,
+        mask if mask_png else False,
+        square,
+        crop,
+        boxes,
+        color,
+        mask_first,
+        overlay_format(pix_fmt),
+        out,
+    )
+
+    return mask_png, fg
 
 
-def concat_videos(urls, infos=None):
+def concat_videos(urls, infos=None, durations=None, ffconcat_url=None):
+    from ffmpegio import FFConcat
 
-    ffconcat = FFConcat()
-    ffconcat.add_files(urls)
+    ffconcat = FFConcat(ffconcat_url=ffconcat_url)
+    if durations is None:
+        ffconcat.add_files(urls)
+    else:
+        # explicit durations keep the timestamps exact across the joints
+        for url, duration in zip(urls, durations):
+            ffconcat.add_file(url, duration=duration)
 
     if infos is not None:
 
@@ -260,6 +662,352 @@ def concat_videos(urls, infos=None):
     return ffconcat
 
 
+def is_stream(url):
+    """True if url is a file descriptor or a file-like object (not a path)
+
+    :param url: input or output url
+    :type url: str, path-like, int, or file-like object
+    :return: True if url must be piped
+    :rtype: bool
+    """
+    return not isinstance(url, (str, bytes, PathLike))
+
+
+def _copy_stream(reader, writer, close_writer=False, bufsize=2**16):
+    # copy reader to writer one chunk at a time. A blocked write (full pipe or
+    # slow sink) blocks further reads, so at most one chunk is held in memory
+    try:
+        while True:
+            data = reader.read(bufsize)
+            if not data:
+                break
+            writer.write(data)
+    except (BrokenPipeError, ValueError):
+        pass  # FFmpeg closed the pipe
+    finally:
+        if close_writer:
+            try:
+                writer.close()
+            except (BrokenPipeError, OSError):
+                pass
+
+
+def run_piped(args, stdin=None, stdout=None, progress=None, overwrite=None):
+    """run FFmpeg with its input and/or output piped from/to Python streams
+
+    :param args: FFmpeg arguments with "pipe:0" input and/or "pipe:1" output
+    :type args: dict
+    :param stdin: input file descriptor or readable binary stream, defaults to None
+    :type stdin: int or file-like object, optional
+    :param stdout: output file descriptor or writable binary stream, defaults to None
+    :type stdout: int or file-like object, optional
+    :param progress: progress callback function, defaults to None
+    :type progress: Callable, optional
+    :param overwrite: True to overwrite if output url exists, defaults to None
+    :type overwrite: bool, optional
+    :return: FFmpeg return code
+    :rtype: int
+    """
+
+    from ffmpegio import ffmpegprocess
+
+    # file descriptors are passed on to FFmpeg directly
+    fdin = open(stdin, "rb", closefd=False) if isinstance(stdin, int) else None
+    fdout = open(stdout, "wb", closefd=False) if isinstance(stdout, int) else None
+
+    proc = ffmpegprocess.Popen(
+        args,
+        progress=progress,
+        overwrite=overwrite,
+        capture_log=None,
+        stdin=fdin,
+        stdout=fdout,
+    )
+
+    threads = []
+    if stdin is not None and fdin is None:
+        threads.append(Thread(target=_copy_stream, args=(stdin, proc.stdin, True)))
+    if stdout is not None and fdout is None:
+        threads.append(Thread(target=_copy_stream, args=(proc.stdout, stdout)))
+
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            t.join()
+        returncode = proc.wait()
+    except:
+        proc.kill()
+        raise
+    finally:
+        for f in (fdin, fdout, proc.stdout):
+            if f is not None:
+                f.close()
+
+    return returncode
+
+
+# bitstream filters to rewrite the aspect ratio in the video headers
+_ASPECT_BSF = {
+    "h264": "h264_metadata=sample_aspect_ratio={sar}",
+    "hevc": "hevc_metadata=sample_aspect_ratio={sar}",
+    "mpeg2video": "mpeg2_metadata=display_aspect_ratio={dar}",
+}
+
+# output options which require re-encoding
+_REMUX_BLOCKERS = ("vf", "filter:v", "r", "s", "t", "to", "ss", "frames:v", "vframes")
+
+# output options which request a video encoder
+_CODEC_OPTIONS = ("c", "codec", "c:v", "codec:v", "vcodec")
+
+# output options which set the encoding quality or bitrate of an encoder
+_RATE_OPTIONS = ("crf", "qp", "b", "b:v", "q:v", "qscale:v")
+
+
+def can_remux(
+    src_info, fg, mask_png, enc_config=None, tstart=None, tend=None, decimate=None
+):
+    """True if a transcode job only needs its aspect ratio rewritten
+
+    The video is not copied if the output options request an encoder other
+    than the source codec, or name an encoder together with an encoding
+    quality or bitrate (e.g., crf). Without an encoder, the quality and
+    bitrate options (e.g., the default crf) only apply to re-encoded videos.
+
+    :param src_info: video stream info of the source
+    :type src_info: dict
+    :param fg: planned filtergraph (see form_filtergraph)
+    :type fg: str
+    :param mask_png: planned mask image (see form_filtergraph)
+    :type mask_png: str or None
+    :param enc_config: output options, defaults to None
+    :type enc_config: dict, optional
+    :param tstart: start time in seconds, defaults to None
+    :type tstart: float, optional
+    :param tend: end time in seconds, defaults to None
+    :type tend: float, optional
+    :param decimate: decimation option, defaults to None
+    :type decimate: bool or dict, optional
+    :rtype: bool
+    """
+
+    enc_config = enc_config or {}
+    if mask_png is not None or decimate or tstart is not None or tend is not None:
+        return False
+    if fg and not re.fullmatch(r"setsar=\d+[:/]\d+", fg):
+        return False
+    if any(k in enc_config for k in _REMUX_BLOCKERS):
+        return False
+    codec = src_info.get("codec_name", None)
+    encoders = [enc_config[k] for k in _CODEC_OPTIONS if k in enc_config]
+    if any(c not in ("copy", codec) for c in encoders):
+        return False
+    if any(c != "copy" for c in encoders) and any(
+        k in enc_config for k in _RATE_OPTIONS
+    ):
+        return False
+    pix_fmt = enc_config.get("pix_fmt", None)
+    return pix_fmt is None or pix_fmt == src_info.get("pix_fmt", None)
+
+
+def remux_options(width, height, sar=None, codec=None):
+    """output options to copy a video, rewriting its aspect ratio
+
+    The aspect ratio is set both in the video bitstream headers (if a
+    bitstream filter exists for the codec) and in the container. The global
+    metadata and chapters of the source are not copied.
+
+    :param width: video frame width
+    :type width: int
+    :param height: video frame height
+    :type height: int
+    :param sar: sample aspect ratio, defaults to None (unchanged)
+    :type sar: int or Fraction, optional
+    :param codec: video codec name, defaults to None
+    :type codec: str, optional
+    :return: output options
+    :rtype: dict
+    """
+
+    opts = {
+        "map": ["0:v:0", "0:a?"],
+        "c": "copy",
+        "map_metadata": -1,
+        "map_chapters": -1,
+    }
+    if sar:
+        sar = Fraction(sar)
+        dar = sar * width / height
+        bsf = _ASPECT_BSF.get(codec, None)
+        if bsf:
+            opts["bsf:v"] = bsf.format(
+                sar=f"{sar.numerator}/{sar.denominator}",
+                dar=f"{dar.numerator}/{dar.denominator}",
+            )
+        opts["aspect"] = f"{dar.numerator}:{dar.denominator}"
+    return opts
+
+
+def form_transcode_args(
+    src,
+    dst,
+    src_info,
+    tstart=None,
+    tend=None,
+    mask_shapes=None,
+    sar=None,
+    square=None,
+    crop=None,
+    color="black",
+    enc_config=None,
+    decimate=None,
+    remux=None,
+):
+    """form the FFmpeg arguments of a transcode job
+
+    :param src: input video file or stream (piped in)
+    :type src: str, int, or file-like object
+    :param dst: output video file or stream (piped out)
+    :type dst: str, int, or file-like object
+    :param src_info: video stream info of src
+    :type src_info: dict
+    :return: FFmpeg arguments (see transcode() for the other parameters)
+    :rtype: dict
+    """
+
+    src_pipe = is_stream(src)
+    dst_pipe = is_stream(dst)
+    enc_config = enc_config or {}
+
+    width = src_info["width"]
+    height = src_info["height"]
+    if sar is None and square is not None:
+        sar = Fraction(src_info.get("sample_aspect_ratio", None) or 1)
+    if crop is None:
+        crop = masks_to_crop(width, height, mask_shapes or [])
+
+    args = {
+        "inputs": [("pipe:0" if src_pipe else src, {})],
+        "outputs": [("pipe:1" if dst_pipe else dst, {**enc_config})],
+        "global_options": {},
+    }
+
+    if dst_pipe:
+        outopts = args["outputs"][0][1]
+        fmt = outopts.setdefault("f", "mp4")
+        if fmt in ("mp4", "mov", "ipod") and "movflags" not in outopts:
+            # non-seekable output
+            outopts["movflags"] = "frag_keyframe+empty_moov+default_base_moof"
+
+    if tstart is not None:
+        args["inputs"][0][1]["ss"] = tstart
+    if tend is not None:
+        args["inputs"][0][1]["to"] = tend
+
+    mask_png, fg = form_filtergraph(
+        width,
+        height,
+        mask_shapes,
+        sar,
+        square,
+        crop,
+        color,
+        src_info.get("pix_fmt", None),
+        src="dec" if decimate else "0:v",
+    )
+    nmasks = mask_png is not None
+    if nmasks:
+        args["inputs"].append((mask_png, {}))
+
+    if remux is not False and can_remux(
+        src_info, fg, mask_png, enc_config, tstart, tend, decimate
+    ):
+        # only the aspect ratio changes: rewrite it without re-encoding
+        dst_url, outopts = args["outputs"][0]
+        args["outputs"][0] = (
+            dst_url,
+            {
+                **remux_options(width, height, sar, src_info.get("codec_name", None)),
+                **_audio_options(outopts),
+            },
+        )
+        fg = None
+
+    if decimate:
+        # drop the duplicates first, so they are not filtered further
+        fg = (
+            f"[0:v]{form_decimate(decimate)}[dec];{fg}"
+            if nmasks
+            else ",".join(v for v in (form_decimate(decimate), fg) if v)
+        )
+        args["outputs"][0][1]["fps_mode"] = "vfr"
+
+    if fg:
+        if nmasks:
+            args["global_options"]["filter_complex"] = fg
+            args["outputs"][0][1]["map"] = ["[vout]", "0:a?"]
+        else:
+            args["outputs"][0][1]["vf"] = fg
+
+    return args
+
+
+def run_transcode_args(args, src, dst, progress=None, overwrite=False):
+    """run FFmpeg with the arguments of a transcode job
+
+    :param args: FFmpeg arguments (see form_transcode_args())
+    :type args: dict
+    :param src: input video file or stream, which args was formed for
+    :type src: str, int, or file-like object
+    :param dst: output video file or stream, which args was formed for
+    :type dst: str, int, or file-like object
+    :param progress: progress monitor object, defaults to None
+    :type progress: Callable, optional
+    :param overwrite: True to overwrite dst, defaults to False
+    :type overwrite: bool, optional
+    :raises RuntimeError: if FFmpeg fails
+    """
+
+    from ffmpegio import ffmpegprocess
+
+    src_pipe = is_stream(src)
+    dst_pipe = is_stream(dst)
+
+    # record the job metrics only if anyone is listening
+    recorder = metrics.ProgressRecorder(progress) if metrics.enabled() else None
+    if recorder is not None:
+        progress = recorder
+    t0 = time()
+    log = None
+
+    if src_pipe or dst_pipe:
+        returncode = run_piped(
+            args,
+            src if src_pipe else None,
+            dst if dst_pipe else None,
+            progress=progress,
+            overwrite=overwrite,
+        )
+    else:
+        if recorder is not None:
+            # FFmpeg reports its CPU time and peak memory
+            args["global_options"]["benchmark"] = None
+        ret = ffmpegprocess.run(
+            args,
+            capture_log=None if recorder is None else True,
+            progress=progress,
+            overwrite=overwrite,
+        )
+        returncode, log = ret.returncode, ret.stderr
+
+    if recorder is not None:
+        error = f"FFmpeg exited with {returncode}" if returncode else None
+        metrics.emit(recorder.record("transcode", src, dst, t0, error, log))
+
+    if returncode:
+        raise RuntimeError("FFmpeg execution failed...")
+
+
 def transcode(
     src,
     dst,
@@ -274,69 +1022,590 @@ def transcode(
     enc_config=None,
     progress=None,
     overwrite=False,
+    decimate=None,
+    sidecar=None,
+    remux=None,
 ):
     """apply mask to src video and transcode
 
-    :param src: input video
-    :type src: str
+    If no pixel needs to change (no crop, mask, or rescaling), the video
+    stream is copied with its aspect ratio rewritten (see can_remux()).
+
+    Both `src` and `dst` may be a binary stream (or a file descriptor), which
+    is piped to/from FFmpeg in chunks. A stream output is written in the
+    fragmented MP4 format unless `enc_config` specifies another format ("f").
+
+    :param src: input video file, file descriptor, or readable binary stream
+    :type src: str, int, or file-like object
+    :param dst: output video file, file descriptor, or writable binary stream
+    :type dst: str, int, or file-like object
+    :param src_info: video stream info of src, defaults to None (to probe).
+                     Required if src is a stream.
+    :type src_info: dict, optional
     :param mask_config: _description_
     :type mask_config: _type_
     :param enc_config: _description_, defaults to None
     :type enc_config: _type_, optional
     :param progress: progress monitor object, defaults to None
     :type progress: ProgressMonitorThread, optional
+    :param decimate: True or mpdecimate options (see form_decimate) to drop the
+                     duplicate frames and write a variable-frame-rate video,
+                     defaults to None
+    :type decimate: bool or dict, optional
+    :param sidecar: CSV file to map the decimated frames to the source frames,
+                    defaults to None (frame_map_file(dst)); False to not write
+    :type sidecar: str or bool, optional
+    :param remux: False to always re-encode, defaults to None (remux if possible)
+    :type remux: bool, optional
     :return: _description_
     :rtype: _type_
     """
 
+    src_pipe = is_stream(src)
+    dst_pipe = is_stream(dst)
+
     if src_info is None:
+        if src_pipe:
+            raise ValueError("src_info must be given to transcode a stream")
         try:
-            src_info = probe.video_streams_basic(src)[0]
+            src_info = cache.video_streams_basic(src)[0]
         except:
             raise ValueError("not a video file")
 
+    args = form_transcode_args(
+        src,
+        dst,
+        src_info,
+        tstart,
+        tend,
+        mask_shapes,
+        sar,
+        square,
+        crop,
+        color,
+        enc_config,
+        decimate,
+        remux,
+    )
+
+    run_transcode_args(args, src, dst, progress, overwrite)
+
+    if decimate and sidecar is not False:
+        if dst_pipe:
+            logging.warning("frame map cannot be written for a stream output")
+        else:
+            write_frame_map(
+                dst, sidecar or frame_map_file(dst), src_info["frame_rate"], tstart
+            )
+
+    return dst
+
+
+def form_multi_transcode_args(
+    src,
+    outputs,
+    src_info,
+    mask_shapes=None,
+    sar=None,
+    crop=None,
+    color="black",
+):
+    """form the FFmpeg arguments of a single-decode multi-output transcode job
+
+    The source is decoded, cropped, and masked once at its native pixel
+    aspect ratio. The masked frames are then split into one branch per
+    output, which is trimmed to the output's time range and rescaled to its
+    size.
+
+    :param src: input video file
+    :type src: str
+    :param outputs: output specifications (see transcode_multi())
+    :type outputs: seq of dicts
+    :param src_info: video stream info of src
+    :type src_info: dict
+    :return: FFmpeg arguments (see transcode_multi() for the other parameters)
+    :rtype: dict
+    """
+
+    if not len(outputs):
+        raise ValueError("no output is specified")
+
     width = src_info["width"]
     height = src_info["height"]
-    if sar is None and square is not None:
-        sar = Fraction(src_info.get("sar", 1.0))
+    if sar is None:
+        sar = Fraction(src_info.get("sample_aspect_ratio", None) or 1)
     if crop is None:
-        crop = masks_to_crop(width, height, mask_shapes)
+        crop = masks_to_crop(width, height, mask_shapes or [])
+    cropw, croph = get_output_size(width, height, 1, None, crop)
+
+    # seek the input to the union of the output time ranges
+    tstarts = [spec.get("tstart", None) for spec in outputs]
+    tends = [spec.get("tend", None) for spec in outputs]
+    inopts = {}
+    t0 = 0
+    if all(t is not None for t in tstarts):
+        t0 = inopts["ss"] = min(tstarts)
+    if all(t is not None for t in tends):
+        inopts["to"] = max(tends)
+
+    args = {"inputs": [(src, inopts)], "outputs": [], "global_options": {}}
+
+    # decode and mask once
+    mask_png, fg = form_filtergraph(
+        width,
+        height,
+        mask_shapes,
+        None,
+        None,
+        crop,
+        color,
+        src_info.get("pix_fmt", None),
+    )
+    n = len(outputs)
+    split = f"split={n}" + "".join(f"[s{i}]" for i in range(n))
+    if mask_png is not None:
+        args["inputs"].append((mask_png, {}))
+        graph = [f"{fg};[vout]{split}"]
+    else:
+        graph = [f"[0:v]{fg},{split}" if fg else f"[0:v]{split}"]
+
+    for i, (spec, tstart, tend) in enumerate(zip(outputs, tstarts, tends)):
+        enc_config = spec.get("enc_config", None) or {}
+        outopts = {**enc_config}
+
+        filters = []
+        if tstart is not None or tend is not None:
+            # trim drops the frames before they are rescaled, and the output
+            # seek cuts the audio and resets the timestamps to zero
+            trim = []
+            if tstart is not None:
+                trim.append(f"start={tstart - t0}")
+                outopts["ss"] = tstart - t0
+            if tend is not None:
+                trim.append(f"end={tend - t0}")
+                outopts["to"] = tend - t0
+            filters.append(f"trim={':'.join(trim)}")
+
+        vf = form_vf(cropw, croph, sar, square=spec.get("square", None))
+        if vf:
+            filters.append(vf)
+        if spec.get("height", None):
+            filters.append(f"scale=-2:{spec['height']}")
+
+        graph.append(f"[s{i}]{','.join(filters) or 'null'}[v{i}]")
+        outopts["map"] = f"[v{i}]" if "an" in enc_config else [f"[v{i}]", "0:a?"]
+        args["outputs"].append((spec["dst"], outopts))
+
+    args["global_options"]["filter_complex"] = ";".join(graph)
+    return args
+
+
+def transcode_multi(
+    src,
+    outputs,
+    src_info=None,
+    mask_shapes=None,
+    sar=None,
+    crop=None,
+    color="black",
+    progress=None,
+    overwrite=False,
+):
+    """apply mask to src video and transcode it to multiple outputs at once
+
+    All the outputs share one decode and one mask pass of the source, so N
+    clips or renditions of a video cost about as much as one. Each output is
+    specified by a dict:
+
+    - "dst": output video file (required)
+    - "tstart", "tend": time range in seconds, defaults to the whole video
+    - "square": None, "upscale", or "downscale" to square the pixels
+    - "enc_config": output options
+    - "height": frame height to downscale to (e.g., a low-resolution proxy)
+
+    :param src: input video file
+    :type src: str
+    :param outputs: output specifications
+    :type outputs: seq of dicts
+    :param src_info: video stream info of src, defaults to None (to probe)
+    :type src_info: dict, optional
+    :param mask_shapes: mask shape specifications, defaults to None
+    :type mask_shapes: sequence of dicts, optional
+    :param sar: sample aspect ratio, defaults to None (as in the source)
+    :type sar: int or Fraction, optional
+    :param crop: tuple (x0, y0, w, h) to crop, defaults to None
+    :type crop: sequence of 4 ints, optional
+    :param color: mask color, defaults to "black"
+    :type color: str, optional
+    :param progress: progress monitor object, defaults to None
+    :type progress: Callable, optional
+    :param overwrite: True to overwrite the outputs, defaults to False
+    :type overwrite: bool, optional
+    :return: output video files
+    :rtype: list of str
+    """
+
+    from ffmpegio import ffmpegprocess
+
+    if is_stream(src) or any(is_stream(spec["dst"]) for spec in outputs):
+        raise ValueError("only files can be transcoded to multiple outputs")
+
+    if src_info is None:
+        try:
+            src_info = cache.video_streams_basic(src)[0]
+        except:
+            raise ValueError("not a video file")
+
+    dsts = [spec["dst"] for spec in outputs]
+    if len(set(path.abspath(dst) for dst in dsts)) != len(dsts):
+        raise ValueError("outputs must be distinct files")
+    if not overwrite:
+        for dst in dsts:
+            if path.exists(dst):
+                raise RuntimeError(f"{dst} already exists")
+
+    args = form_multi_transcode_args(
+        src, outputs, src_info, mask_shapes, sar, crop, color
+    )
+
+    recorder = metrics.ProgressRecorder(progress) if metrics.enabled() else None
+    if recorder is not None:
+        progress = recorder
+        args["global_options"]["benchmark"] = None
+    t0 = time()
+
+    ret = ffmpegprocess.run(
+        args,
+        capture_log=None if recorder is None else True,
+        progress=progress,
+        overwrite=True,
+    )
+
+    if recorder is not None:
+        error = f"FFmpeg exited with {ret.returncode}" if ret.returncode else None
+        metrics.emit(recorder.record("transcode", src, dsts, t0, error, ret.stderr))
+
+    if ret.returncode:
+        raise RuntimeError("FFmpeg execution failed...")
+
+    return dsts
+
+
+def packet_times(src, key_only=False):
+    """list the presentation times of the packets of the first video stream
+
+    The packets are stream-copied to FFmpeg's framecrc muxer (no decoding), so
+    this is fast even for a long video.
+
+    :param src: input video file
+    :type src: str
+    :param key_only: True to list only the keyframes, defaults to False
+    :type key_only: bool, optional
+    :return: sorted presentation times in seconds
+    :rtype: list of Fraction
+    """
+
+    from ffmpegio import ffmpegprocess
 
     args = {
         "inputs": [(src, {})],
-        "outputs": [(dst, {**enc_config})],
+        "outputs": [("-", {"map": "0:v:0", "c": "copy", "f": "framecrc"})],
         "global_options": {},
     }
+    ret = ffmpegprocess.run(args, capture_log=True, stdout=PIPE)
+    if ret.returncode:
+        raise RuntimeError(f"FFmpeg failed to read the packets of {src}")
 
-    if tstart is not None:
-        args["inputs"][0][1]["ss"] = tstart
-    if tend is not None:
-        args["inputs"][0][1]["to"] = tend
+    tb = Fraction(1)
+    pts = []
+    for line in ret.stdout.decode("utf-8").splitlines():
+        if line.startswith("#tb 0:"):
+            tb = Fraction(line[6:].strip())
+        elif line and not line.startswith("#") and not (key_only and "F=" in line):
+            # only the non-key packets carry the flags field
+            pts.append(int(line.split(",")[2]))
 
-    nmasks = 0 if mask_shapes is None else len(mask_shapes)
-    if nmasks > 0:
-        mask_shapes = adjust_masks(width, height, mask_shapes, sar, square, crop)
-        mask_lavfi = create_mask(width, height, mask_shapes, color)
-        args["inputs"].append((mask_lavfi, {"f": "lavfi"}))
+    return [p * tb for p in sorted(pts)]
 
-    fg = form_vf(width, height, sar, "0:v", "1:v" if nmasks else False, square, crop)
-    if fg:
-        if nmasks:
-            args["global_options"]["filter_complex"] = fg
-            args["outputs"][0][1]["map"] = ["[vout]", "0:a?"]
-        else:
-            args["outputs"][0][1]["vf"] = fg
 
-    # makedirs(path.split(dst)[0], exist_ok=True)
-    if ffmpegprocess.run(
-        args, capture_log=None, progress=progress, overwrite=overwrite
-    ).returncode:
+def keyframe_times(src):
+    """list the presentation times of the keyframes of the first video stream
+
+    :param src: input video file
+    :type src: str
+    :return: sorted keyframe times in seconds, relative to the first keyframe
+    :rtype: list of Fraction
+    """
+
+    times = packet_times(src, True)
+    return [t - times[0] for t in times]
+
+
+def form_decimate(decimate=True):
+    """form the mpdecimate filter to drop duplicate frames
+
+    :param decimate: True for the default thresholds or a dict of mpdecimate
+                     options: hi, lo, frac, and max, defaults to True
+    :type decimate: bool or dict, optional
+    :return: filter expression
+    :rtype: str
+    """
+    opts = decimate if isinstance(decimate, dict) else {}
+    return "mpdecimate" + (
+        "=" + ":".join(f"{k}={v}" for k, v in opts.items()) if opts else ""
+    )
+
+
+def frame_map_file(dst):
+    """default path of the frame map sidecar of a decimated video
+
+    :param dst: output video file
+    :type dst: str
+    :return: dst with its extension replaced by "_frames.csv"
+    :rtype: str
+    """
+    return f"{path.splitext(dst)[0]}_frames.csv"
+
+
+def write_frame_map(dst, sidecar, frame_rate, tstart=None):
+    """write the CSV sidecar mapping the frames of a decimated video to the source
+
+    Decimation retains the source timestamps, so the source frame index is
+    recovered from each output frame's timestamp.
+
+    :param dst: decimated video file
+    :type dst: str
+    :param sidecar: CSV file to write
+    :type sidecar: str
+    :param frame_rate: frame rate of the source video
+    :type frame_rate: Fraction
+    :param tstart: start time of the transcoded source segment, defaults to None
+    :type tstart: float, optional
+    :return: source frame indices of the output frames
+    :rtype: list of int
+    """
+
+    frame_rate = Fraction(frame_rate)
+    t0 = Fraction(tstart or 0)
+    times = packet_times(dst)
+    indices = [round((t + t0) * frame_rate) for t in times]
+    with open(sidecar, "wt") as f:
+        f.write("frame,time,source_frame\n")
+        for i, (t, n) in enumerate(zip(times, indices)):
+            f.write(f"{i},{float(t):.6f},{n}\n")
+    return indices
+
+
+def split_at_keyframes(keyframes, nsegments, tstart=None, tend=None):
+    """split a time range into segments starting at keyframes
+
+    Each boundary is placed at the keyframe closest to the even split of the
+    range. Fewer segments are returned if there are not enough keyframes.
+
+    :param keyframes: sorted keyframe times in seconds
+    :type keyframes: seq of numbers
+    :param nsegments: (maximum) number of segments
+    :type nsegments: int
+    :param tstart: start time in seconds, defaults to None (first keyframe)
+    :type tstart: number, optional
+    :param tend: end time in seconds, defaults to None (last keyframe)
+    :type tend: number, optional
+    :return: list of (tstart, tend) pairs with the unbounded ends set to None
+    :rtype: list of tuples
+    """
+
+    t0 = keyframes[0] if tstart is None else tstart
+    t1 = keyframes[-1] if tend is None else tend
+    candidates = [t for t in keyframes if t0 < t < t1]
+
+    bounds = []
+    for i in range(1, nsegments):
+        if not candidates:
+            break
+        target = t0 + (t1 - t0) * i / nsegments
+        t = min(candidates, key=lambda t: abs(t - target))
+        if not bounds or t > bounds[-1]:
+            bounds.append(t)
+
+    return list(zip([tstart, *bounds], [*bounds, tend]))
+
+
+def _audio_options(enc_config):
+    # output options which apply to the audio stream or to the container
+    return {
+        k: v
+        for k, v in enc_config.items()
+        if k in ("an", "ar", "ac", "f", "movflags")
+        or k.startswith(("c:a", "b:a", "q:a", "filter:a", "af", "acodec"))
+    }
+
+
+def transcode_segments(
+    src,
+    dst,
+    nsegments=None,
+    max_workers=None,
+    tstart=None,
+    tend=None,
+    src_info=None,
+    enc_config=None,
+    progress=None,
+    overwrite=False,
+    decimate=None,
+    sidecar=None,
+    **kwargs,
+):
+    """apply mask to src video and transcode it in parallel segments
+
+    The video is split at keyframes into `nsegments` time ranges, which are
+    transcoded concurrently (video only) by transcode() with the same mask and
+    crop plan. The encoded segments are then joined with the concat demuxer
+    without re-encoding while the audio stream is taken from the source.
+
+    :param src: input video file
+    :type src: str
+    :param dst: output video file
+    :type dst: str
+    :param nsegments: number of segments, defaults to None (number of CPU cores)
+    :type nsegments: int, optional
+    :param max_workers: maximum number of concurrent segment jobs, defaults to
+                        None (nsegments)
+    :type max_workers: int, optional
+    :param tstart: start time in seconds, defaults to None
+    :type tstart: float, optional
+    :param tend: end time in seconds, defaults to None
+    :type tend: float, optional
+    :param src_info: video stream info of src, defaults to None (to probe)
+    :type src_info: dict, optional
+    :param enc_config: output options, defaults to None
+    :type enc_config: dict, optional
+    :param progress: progress monitor of the final join, defaults to None
+    :type progress: Callable, optional
+    :param overwrite: True to overwrite dst, defaults to False
+    :type overwrite: bool, optional
+    :param decimate: True or mpdecimate options to drop the duplicate frames,
+                     defaults to None
+    :type decimate: bool or dict, optional
+    :param sidecar: frame map CSV file of the decimated video, defaults to None
+                    (frame_map_file(dst)); False to not write
+    :type sidecar: str or bool, optional
+    :param \\**kwargs: other transcode() arguments: mask_shapes, sar, square,
+                      crop, and color
+    :return: dst
+    :rtype: str
+    """
+
+    from ffmpegio import ffmpegprocess
+
+    if src_info is None:
+        try:
+            src_info = cache.video_streams_basic(src)[0]
+        except:
+            raise ValueError("not a video file")
+
+    enc_config = enc_config or {}
+    nsegments = nsegments or cpu_count() or 1
+
+    keyframes = keyframe_times(src)
+    segments = (
+        split_at_keyframes(keyframes, nsegments, tstart, tend)
+        if len(keyframes)
+        else [(tstart, tend)]
+    )
+    if len(segments) == 1:
+        return transcode(
+            src,
+            dst,
+            tstart,
+            tend,
+            src_info=src_info,
+            enc_config=enc_config,
+            progress=progress,
+            overwrite=overwrite,
+            decimate=decimate,
+            sidecar=sidecar,
+            **kwargs,
+        )
+
+    if not overwrite and path.exists(dst):
+        raise RuntimeError(f"{dst} already exists")
+
+    # segments must share the encoder settings but not the audio
+    vconfig = {k: v for k, v in enc_config.items() if k not in ("f", "movflags")}
+    vconfig["an"] = None
+
+    with TemporaryDirectory() as tmpdir:
+        segfiles = [path.join(tmpdir, f"seg{i:04d}.mp4") for i in range(len(segments))]
+
+        def run_segment(i):
+            t0, t1 = segments[i]
+            return transcode(
+                src,
+                segfiles[i],
+                None if t0 is None else float(t0),
+                None if t1 is None else float(t1),
+                src_info=src_info,
+                enc_config=vconfig,
+                overwrite=True,
+                decimate=decimate,
+                sidecar=False,
+                **kwargs,
+            )
+
+        with ThreadPoolExecutor(max_workers=max_workers or len(segments)) as executor:
+            for _ in executor.map(run_segment, range(len(segments))):
+                pass
+
+        # the durations of all but the last segment are known exactly
+        durations = [
+            None if t1 is None else float(t1 - (t0 or 0)) for t0, t1 in segments
+        ]
+        ffconcat = concat_videos(
+            segfiles, durations=durations, ffconcat_url=path.join(tmpdir, "list.txt")
+        )
+
+        with ffconcat:
+            audio_opts = {}
+            if tstart is not None:
+                audio_opts["ss"] = tstart
+            if tend is not None:
+                audio_opts["to"] = tend
+            args = {
+                "inputs": [
+                    (ffconcat.url, {"f": "concat", "safe": 0}),
+                    (src, audio_opts),
+                ],
+                "outputs": [
+                    (
+                        dst,
+                        {
+                            **_audio_options(enc_config),
+                            "map": ["0:v", "1:a?"],
+                            "c:v": "copy",
+                        },
+                    )
+                ],
+                "global_options": {},
+            }
+            if "an" in enc_config:
+                args["outputs"][0][1]["map"] = "0:v"
+            returncode = ffmpegprocess.run(
+                args, capture_log=None, progress=progress, overwrite=overwrite
+            ).returncode
+
+    if returncode:
         raise RuntimeError("FFmpeg execution failed...")
 
+    if decimate and sidecar is not False:
+        write_frame_map(
+            dst, sidecar or frame_map_file(dst), src_info["frame_rate"], tstart
+        )
+
     return dst
 
 
 if __name__ == "__main__":
+    from ffmpegio import probe
     import configure
 
     config = configure.defaultOption()
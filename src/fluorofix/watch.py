@@ -0,0 +1,461 @@
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import ctypes.util
+import logging
+from os import close, cpu_count, path, read, stat, walk
+import select
+import struct
+import sys
+from threading import Event
+from time import monotonic, sleep, time
+
+from . import metrics, probe
+from .batch import partial_name, run_job
+from .journal import JOURNAL_FILE, config_hash
+
+# inotify flags and event masks (see inotify(7))
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+def _scan(folders):
+    # all the files in the folders with their (size, mtime)
+    files = {}
+    for folder in folders:
+        for p, _, fs in walk(folder):
+            for f in fs:
+                file = path.join(p, f)
+                try:
+                    st = stat(file)
+                except OSError:
+                    continue
+                files[file] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+class PollingWatcher:
+    """detect new and modified files by rescanning folders periodically
+
+    :param folders: folders to watch (recursively)
+    :type folders: seq of str
+    :param interval: seconds between scans, defaults to 2.0
+    :type interval: float, optional
+    """
+
+    def __init__(self, folders, interval=2.0):
+        self.folders = list(folders)
+        self.interval = interval
+        self._files = _scan(self.folders)
+        self._next = monotonic() + interval
+
+    def existing(self):
+        """files present when the watch started
+
+        :rtype: list of str
+        """
+        return list(self._files)
+
+    def poll(self, timeout=None):
+        """wait for changes
+
+        :param timeout: maximum seconds to wait, defaults to None (until the
+                        next scan)
+        :type timeout: float, optional
+        :return: new or modified files (empty if none before the timeout)
+        :rtype: set of str
+        """
+        wait = self._next - monotonic()
+        if timeout is not None and timeout < wait:
+            sleep(max(timeout, 0))
+            return set()
+        sleep(max(wait, 0))
+        self._next = monotonic() + self.interval
+
+        files = _scan(self.folders)
+        changed = {f for f, st in files.items() if self._files.get(f, None) != st}
+        self._files = files
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """detect new and modified files with Linux inotify
+
+    Sub-folders are watched as they are created. If the kernel event queue
+    overflows, the folders are rescanned.
+
+    :param folders: folders to watch (recursively)
+    :type folders: seq of str
+    :raises OSError: if inotify is not available
+    """
+
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+    def __init__(self, folders):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = list(folders)
+        self._dirs = {}  # wd -> folder
+        self._existing = []
+        for folder in self.folders:
+            self._existing.extend(self._add_tree(folder))
+
+    def _add_tree(self, folder):
+        # watch a folder and its sub-folders, and return the files in them
+        files = []
+        for p, _, fs in walk(folder):
+            wd = self._libc.inotify_add_watch(self._fd, p.encode(), self.MASK)
+            if wd < 0:
+                logging.warning(f"cannot watch {p}: {ctypes.get_errno()}")
+                continue
+            self._dirs[wd] = p
+            files.extend(path.join(p, f) for f in fs)
+        return files
+
+    def existing(self):
+        """files present when the watch started
+
+        :rtype: list of str
+        """
+        return list(self._existing)
+
+    def poll(self, timeout=None):
+        """wait for changes
+
+        :param timeout: maximum seconds to wait, defaults to None (indefinitely)
+        :type timeout: float, optional
+        :return: new or modified files (empty if none before the timeout)
+        :rtype: set of str
+        """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return set()
+        try:
+            buf = read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, n = _EVENT.unpack_from(buf, offset)
+            name = buf[offset + _EVENT.size : offset + _EVENT.size + n]
+            offset += _EVENT.size + n
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflowed: rescanning")
+                changed.update(_scan(self.folders))
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            folder = self._dirs.get(wd, None)
+            if folder is None or not n:
+                continue
+            file = path.join(folder, name.rstrip(b"\0").decode(errors="replace"))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.update(self._add_tree(file))
+            else:
+                changed.add(file)
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            close(self._fd)
+            self._fd = -1
+
+
+def make_watcher(folders, polling=False, interval=2.0):
+    """create the best available folder watcher
+
+    :param folders: folders to watch (recursively)
+    :type folders: seq of str
+    :param polling: True to always poll, defaults to False (inotify if available)
+    :type polling: bool, optional
+    :param interval: seconds between scans of the polling watcher, defaults to 2.0
+    :type interval: float, optional
+    :return: watcher with existing(), poll(timeout), and close() methods
+    :rtype: InotifyWatcher or PollingWatcher
+    """
+    if not polling:
+        try:
+            return InotifyWatcher(folders)
+        except (OSError, AttributeError) as e:
+            logging.info(f"inotify not available ({e}): polling the folders")
+    return PollingWatcher(folders, interval)
+
+
+def _is_inside(file, folder):
+    file, folder = path.abspath(file), path.abspath(folder)
+    try:
+        return path.commonpath([file, folder]) == folder
+    except ValueError:  # different drives
+        return False
+
+
+class StabilityTracker:
+    """hold files until they stop changing
+
+    A file is ready once its size and modification time have stayed the same
+    for `settle` seconds.
+
+    :param settle: seconds without change, defaults to 5.0
+    :type settle: float, optional
+    """
+
+    def __init__(self, settle=5.0):
+        self.settle = settle
+        self.pending = {}  # file -> [(size, mtime), since, first seen]
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, file, now=None):
+        """start (or continue) tracking a file
+
+        :param file: file path
+        :type file: str
+        :param now: current time, defaults to None (time.time())
+        :type now: float, optional
+        """
+        now = time() if now is None else now
+        if file not in self.pending:
+            self.pending[file] = [None, now, now]
+
+    def ready(self, now=None):
+        """remove and return the files which have settled
+
+        :param now: current time, defaults to None (time.time())
+        :type now: float, optional
+        :return: settled files mapped to the time they were first seen
+        :rtype: dict
+        """
+        now = time() if now is None else now
+        done = {}
+        for file, entry in list(self.pending.items()):
+            try:
+                st = stat(file)
+            except OSError:
+                del self.pending[file]  # deleted or moved away
+                continue
+            fingerprint = (st.st_size, st.st_mtime_ns)
+            if fingerprint != entry[0]:
+                entry[0], entry[1] = fingerprint, now
+            elif now - entry[1] >= self.settle:
+                del self.pending[file]
+                done[file] = entry[2]
+        return done
+
+
+class WatchDaemon:
+    """transcode videos as they appear in watched folders
+
+    New and modified files are held until fully written (see StabilityTracker),
+    and a bounded pool of workers checks them with probe.check_file() and
+    transcodes the matched videos. When the pool queue is full, the settled
+    files wait their turn. The outputs (and their partial files) are ignored
+    by the watch until `output_ttl` seconds after they are written. Each update
+    emits a "watch" metrics record with the queue depth and the latency (from
+    the file first seen to its output written).
+
+    :param ctx: fluorofix context
+    :type ctx: dict
+    :param folders: folders to watch (recursively)
+    :type folders: seq of str
+    :param max_workers: number of concurrent jobs, defaults to None (a half of
+                        the CPU cores)
+    :type max_workers: int, optional
+    :param threads: number of threads each FFmpeg job may use, defaults to None
+    :type threads: int, optional
+    :param queue_size: maximum number of queued jobs (not yet running),
+                       defaults to None (2 * max_workers)
+    :type queue_size: int, optional
+    :param settle: seconds a file must stay unchanged, defaults to 5.0
+    :type settle: float, optional
+    :param journal: job journal to skip the videos which have been processed,
+                    defaults to None
+    :type journal: Journal, optional
+    :param process_existing: True to also process the files present at start,
+                             defaults to True
+    :type process_existing: bool, optional
+    :param polling: True to poll the folders instead of using inotify,
+                    defaults to False
+    :type polling: bool, optional
+    :param callback: function called as each job completes: callback(src,
+                     result), defaults to None
+    :type callback: Callable, optional
+    :param output_ttl: seconds to ignore the changes of an output file after
+                       its job completes, defaults to 60.0
+    :type output_ttl: float, optional
+    """
+
+    def __init__(
+        self,
+        ctx,
+        folders,
+        max_workers=None,
+        threads=None,
+        queue_size=None,
+        settle=5.0,
+        journal=None,
+        process_existing=True,
+        polling=False,
+        callback=None,
+        output_ttl=60.0,
+    ):
+        self.ctx = ctx
+        self.folders = [path.abspath(f) for f in folders]
+        self.max_workers = max_workers or max(1, (cpu_count() or 1) // 2)
+        self.threads = threads
+        self.queue_size = queue_size or 2 * self.max_workers
+        self.journal = journal
+        self.callback = callback
+        self.output_ttl = output_ttl
+        self.tracker = StabilityTracker(settle)
+        self.watcher = make_watcher(self.folders, polling, min(settle, 2.0) or 1.0)
+        self._ready = []  # settled files waiting for a slot: (file, first seen)
+        self._jobs = {}  # future -> (src, first seen)
+        self._outputs = {}  # output file -> expiry time (None while running)
+        self.processed = 0
+        self.failed = 0
+        self.last_latency = None
+        if process_existing:
+            for file in self.watcher.existing():
+                if not self._ignore(file):
+                    self.tracker.add(file)
+
+    def _ignore(self, file):
+        name = path.basename(file)
+        outdir = self.ctx.get("OutputFolder", None)
+        return (
+            name.startswith(".")
+            or name.endswith(".json")
+            or name.startswith(JOURNAL_FILE)
+            or path.abspath(file) in self._outputs
+            or bool(outdir)
+            and _is_inside(file, outdir)
+        )
+
+    def stats(self):
+        """current state of the daemon
+
+        :return: {"pending", "queued", "active", "processed", "failed",
+                 "latency"}
+        :rtype: dict
+        """
+        running = sum(f.running() for f in self._jobs)
+        return {
+            "pending": len(self.tracker),
+            "queued": len(self._ready) + len(self._jobs) - running,
+            "active": running,
+            "processed": self.processed,
+            "failed": self.failed,
+            "latency": self.last_latency,
+        }
+
+    def _emit(self):
+        if metrics.enabled():
+            metrics.emit({"event": "watch", "time": time(), **self.stats()})
+
+    def _hold_output(self, dst, expiry):
+        # ignore an output file and its partial file until expiry (None: never)
+        for file in (dst, partial_name(dst)):
+            self._outputs[path.abspath(file)] = expiry
+
+    def _process(self, file):
+        # worker job: probe the file and transcode it, returning the planned
+        # output and the job result (None if not processed)
+        data = probe.check_file(self.ctx, file)
+        if data["prof"] is None:
+            return None  # not a video with a profile
+        self._hold_output(data["dst"], None)
+        if self.journal is not None:
+            config = config_hash(self.ctx, data["prof"])
+            if self.journal.is_done(file, data["dst"], config):
+                self._hold_output(data["dst"], time() + self.output_ttl)
+                return None
+            self.journal.start(file, data["dst"], config)
+        return data["dst"], run_job(self.ctx, file, data, self.threads)
+
+    def _submit(self, executor):
+        while self._ready and len(self._jobs) < self.max_workers + self.queue_size:
+            file, seen = self._ready.pop(0)
+            self._jobs[executor.submit(self._process, file)] = (file, seen)
+            logging.info(f"queued {file}")
+
+    def _prune(self, now):
+        # stop ignoring the outputs written more than output_ttl seconds ago
+        for file, expiry in list(self._outputs.items()):
+            if expiry is not None and expiry < now:
+                del self._outputs[file]
+
+    def _collect(self):
+        now = time()
+        for future in [f for f in self._jobs if f.done()]:
+            src, seen = self._jobs.pop(future)
+            out = future.result()  # check_file and run_job never raise
+            if out is None:
+                continue
+            dst, res = out
+            for dst in {dst, res["dst"]}:
+                self._hold_output(dst, now + self.output_ttl)
+            if self.journal is not None:
+                self.journal.finish(src, res["error"])
+            self.processed += 1
+            if res["error"] is not None:
+                self.failed += 1
+                logging.warning(f"{src}: {res['error']}")
+            else:
+                self.last_latency = now - seen
+                logging.info(f"{src} -> {res['dst']}")
+            if self.callback is not None:
+                self.callback(src, res)
+
+    def run(self, stop=None, tick=0.5):
+        """watch the folders until stopped
+
+        :param stop: event to stop the daemon, defaults to None (run until
+                     interrupted)
+        :type stop: threading.Event, optional
+        :param tick: seconds between the checks of settling files and finished
+                     jobs, defaults to 0.5
+        :type tick: float, optional
+        """
+
+        stop = stop or Event()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                while not stop.is_set():
+                    for file in self.watcher.poll(tick):
+                        if not self._ignore(file):
+                            self.tracker.add(file)
+                    self._ready.extend(self.tracker.ready().items())
+                    self._collect()
+                    self._prune(time())
+                    self._submit(executor)
+                    self._emit()
+            except KeyboardInterrupt:
+                logging.info("stopping: waiting for the running jobs")
+            finally:
+                self.watcher.close()
+                for future in self._jobs:
+                    future.cancel()
+                executor.shutdown(wait=True)
+                self._jobs = {f: j for f, j in self._jobs.items() if not f.cancelled()}
+                self._collect()
+                self._emit()
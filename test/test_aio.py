@@ -0,0 +1,93 @@
+import asyncio
+from os import path
+
+import ffmpegio
+import pytest
+
+from fluorofix import aio, cache, configure
+
+INFO = [{"codec_name": "h264", "width": 720, "height": 480}]
+
+asset = path.join(path.dirname(__file__), "assets", "colorchart_720x480.mp4")
+
+
+@pytest.fixture()
+def videos(tmp_path):
+    db = cache.enable_probe_cache(str(tmp_path / "probe.sqlite"))
+    files = []
+    for i in range(4):
+        f = tmp_path / "in" / f"video{i}.mp4"
+        f.parent.mkdir(exist_ok=True)
+        f.write_bytes(b"0")
+        db.put(str(f), INFO)
+        files.append(str(f))
+    yield files
+    cache.disable_probe_cache()
+
+
+def test_analyze_files_async(tmp_path, videos):
+    ctx = configure.defaultOption()
+    ctx["OutputFolder"] = str(tmp_path / "out")
+
+    async def main():
+        res = await aio.check_file_async(ctx, videos[0])
+        assert res["prof"] == "Siemens Axiom (480p)"
+        return await aio.analyze_files_async(ctx, [str(tmp_path / "in")], 2)
+
+    files, opts = asyncio.run(main())
+    assert sorted(files) == videos and opts == {}
+
+
+def test_concurrency_limit():
+    aio.set_concurrency_limit(2)
+    try:
+
+        async def main():
+            sem = aio._default_semaphore()
+            assert sem is aio._default_semaphore()
+            return sem
+
+        # one semaphore per event loop
+        assert asyncio.run(main()) is not asyncio.run(main())
+    finally:
+        aio.set_concurrency_limit(None)
+
+
+def test_transcode_async(tmp_path):
+    info = ffmpegio.probe.video_streams_basic(asset)[0]
+    dst = str(tmp_path / "out.mp4")
+    mask = [dict(x0=45, y0=8, w=530, h=530)]
+
+    async def main():
+        updates = []
+        async for status in aio.iter_transcode(
+            asset, dst, info, mask_shapes=mask, enc_config={"preset": "ultrafast"}
+        ):
+            updates.append(status)
+        return updates
+
+    updates = asyncio.run(main())
+    assert updates[-1]["progress"] == "end" and updates[-1]["frame"] == 30
+    assert ffmpegio.probe.video_streams_basic(dst)[0]["width"] == 530
+
+
+def test_transcode_async_cancel(tmp_path):
+    info = ffmpegio.probe.video_streams_basic(asset)[0]
+    dst = str(tmp_path / "out.mp4")
+
+    async def main():
+        task = asyncio.create_task(
+            aio.transcode_async(
+                asset,
+                dst,
+                src_info=info,
+                mask_shapes=[dict(x0=45, y0=8, w=530, h=530)],
+                enc_config={"preset": "ultrafast"},
+                progress=lambda status, done: task.cancel(),
+            )
+        )
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert not path.exists(dst)
@@ -0,0 +1,64 @@
+from fractions import Fraction
+from fluorofix import batch, configure
+import pytest
+
+
+@pytest.mark.parametrize(
+    "sar, mask",
+    [
+        (1, dict(x0=396, y0=92, w=1144, h=1144)),
+        (Fraction(8, 9), dict(x0=396, y0=82, w=1144, h=1017)),
+        (Fraction(9, 8), dict(x0=352, y0=92, w=1017, h=1144)),
+    ],
+)
+def test_profile_masks(sar, mask):
+    assert batch.profile_masks({"circ": [396, 92, 1144]}, sar) == [mask]
+    assert batch.profile_masks({}, sar) == []
+
+
+def test_profile_masks_rect():
+    mask = dict(x0=100, y0=36, w=520, h=356, is_rect=True)
+    assert batch.profile_masks({"rect": [100, 40, 520, 400]}, Fraction(8, 9)) == [mask]
+
+
+def test_job_options():
+    ctx = configure.defaultOption()
+    info = {"width": 1920, "height": 1080, "sample_aspect_ratio": Fraction(1, 1)}
+    opts = batch.job_options(ctx, "Toshiba Kalare (1080p)", info)
+    assert opts["sar"] == Fraction(8, 9)
+    assert opts["square"] == "upscale"
+    assert opts["crop"] == (396, 82, 1144, 998)
+    assert opts["enc_config"] == ctx["OutputOptions"]
+
+    ctx = {**ctx, "ApplyMask": False, "CropVideo": False, "KeepAudio": False}
+    opts = batch.job_options(ctx, "Toshiba Kalare (1080p)", info)
+    assert opts["mask_shapes"] is None and opts["crop"] is False
+    assert "an" in opts["enc_config"]
+
+
+def test_run_batch_failure(tmp_path):
+    ctx = configure.defaultOption()
+    files = {
+        str(tmp_path / f"missing{i}.mp4"): {
+            "prof": "Toshiba Kalare (1080p)",
+            "dst": str(tmp_path / f"out{i}.mp4"),
+        }
+        for i in range(3)
+    }
+    done = []
+    res = batch.run_batch(ctx, files, max_workers=2, callback=lambda *x: done.append(x))
+    assert set(res) == set(files) and len(done) == 3
+    assert all(r["error"] for r in res.values())
+
+
+def test_run_batch_stream(tmp_path):
+    ctx = configure.defaultOption()
+    jobs = (
+        (
+            str(tmp_path / f"missing{i}.mp4"),
+            {"prof": "Siemens Axiom (480p)", "dst": str(tmp_path / f"out{i}.mp4")},
+        )
+        for i in range(5)
+    )
+    res = batch.run_batch(ctx, jobs, max_workers=1)
+    assert len(res) == 5 and all(r["error"] for r in res.values())
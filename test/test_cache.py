@@ -0,0 +1,71 @@
+from fractions import Fraction
+import os
+from fluorofix import cache
+import pytest
+
+
+@pytest.fixture()
+def files(tmp_path):
+    files = []
+    for i in range(4):
+        f = tmp_path / "sub" / f"video{i}.mp4"
+        f.parent.mkdir(exist_ok=True)
+        f.write_bytes(b"0" * (i + 1))
+        files.append(str(f))
+    return files
+
+
+def test_probe_cache(tmp_path, files):
+    db = cache.ProbeCache(str(tmp_path / "probe.sqlite"), max_entries=2)
+    info = [{"width": 720, "height": 480, "sample_aspect_ratio": Fraction(8, 9)}]
+
+    assert db.get(files[0]) is None
+    db.put(files[0], info)
+    assert db.get(files[0]) == info
+
+    # modified file invalidates the entry
+    st = os.stat(files[0])
+    os.utime(files[0], ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    assert db.get(files[0]) is None
+
+    # least recently used entries are evicted
+    for f in files:
+        db.put(f, info)
+    assert len(db) == 2 and db.get(files[-1]) == info
+
+    db.invalidate(files[-1])
+    assert db.get(files[-1]) is None
+    db.invalidate(os.path.dirname(files[0]))
+    assert len(db) == 0
+
+
+def test_probe_cache_atime(tmp_path, files):
+    filename = str(tmp_path / "probe.sqlite")
+    db = cache.ProbeCache(filename, max_entries=3)
+    info = [{"width": 720, "height": 480}]
+    for f in files[:3]:
+        db.put(f, info)
+
+    # hits are written on close
+    assert db.get(files[0]) == info
+    db.close()
+    db = cache.ProbeCache(filename, max_entries=3)
+    atimes = dict(db._connect().execute("SELECT path, atime FROM probe"))
+    assert atimes[files[0]] > atimes[files[2]]
+
+    # pending hits are written before eviction
+    assert db.get(files[1]) == info
+    db.put(files[3], info)
+    assert db.get(files[2]) is None and db.get(files[1]) == info
+    db.close()
+
+
+def test_video_streams_basic(tmp_path, files):
+    info = [{"codec_name": "h264", "width": 1920, "height": 1080}]
+    db = cache.enable_probe_cache(str(tmp_path / "probe.sqlite"))
+    try:
+        db.put(files[0], info)
+        assert cache.video_streams_basic(files[0]) == info
+    finally:
+        cache.disable_probe_cache()
+    assert cache.get_probe_cache() is None
@@ -0,0 +1,71 @@
+from fractions import Fraction
+import json
+
+import pytest
+
+from fluorofix import batch, cache, cli, metrics
+
+INFO = [
+    {
+        "codec_name": "h264",
+        "width": 720,
+        "height": 480,
+        "frame_rate": Fraction(30),
+        "duration": 60.0,
+    }
+]
+
+
+@pytest.fixture()
+def inputs(tmp_path):
+    db = cache.ProbeCache(str(tmp_path / "probe.sqlite"))
+    for i in range(2):
+        f = tmp_path / "in" / f"{i}" / "video.mp4"
+        f.parent.mkdir(parents=True)
+        f.write_bytes(b"0")
+        db.put(str(f), INFO)
+    db.close()
+    return tmp_path
+
+
+@pytest.mark.parametrize(
+    "secs, expected", [(None, "?"), (59.6, "1:00"), (3725, "1:02:05")]
+)
+def test_format_seconds(secs, expected):
+    assert cli.format_seconds(secs) == expected
+
+
+def test_dry_run(inputs, capsys):
+    args = ["--probe-cache", str(inputs / "probe.sqlite"), str(inputs / "in")]
+    assert cli.main(["-n", *args]) == 0
+    out = capsys.readouterr().out
+    assert "Siemens Axiom (480p)" in out and "720x480 -> " in out
+    assert "2 file(s), 2:00 of video" in out
+    assert not (inputs / "in" / "0" / "video_fixed.mp4").exists()
+
+    # both videos would be written to the same file in the output folder
+    args = ["-o", str(inputs / "out"), *args]
+    assert cli.main(["-n", *args]) == 1
+    assert capsys.readouterr().out.count("COLLISION") == 2
+    assert cli.main(args) == 2
+
+
+def test_metrics_jsonl(inputs, monkeypatch):
+    def run_job(ctx, src, data, threads=None):
+        return {"dst": data["dst"], "error": None, "elapsed": 1.0, "skipped": False}
+
+    monkeypatch.setattr(batch, "run_job", run_job)
+    log = inputs / "metrics" / "fluorofix.jsonl"
+    prom = inputs / "fluorofix.prom"
+    args = ["--probe-cache", str(inputs / "probe.sqlite"), str(inputs / "in")]
+    assert (
+        cli.main(["--metrics-jsonl", str(log), "--prometheus", str(prom), *args]) == 0
+    )
+    assert not metrics.enabled()
+
+    records = [json.loads(line) for line in log.read_text().splitlines()]
+    assert [r["cached"] for r in records if r["event"] == "probe"] == [True, True]
+    batches = [r for r in records if r["event"] == "batch"]
+    assert [r["files_done"] for r in batches] == [1, 2]
+    assert batches[-1]["files_total"] == 2
+    assert "fluorofix_batch_files_done 2" in prom.read_text()
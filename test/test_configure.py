@@ -0,0 +1,63 @@
+import json
+from os import environ, path
+import subprocess
+import sys
+
+import pytest
+
+from fluorofix import configure
+
+
+@pytest.fixture()
+def validated(tmp_path, monkeypatch):
+    monkeypatch.setenv("FLUOROFIX_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(configure, "_validated", None)
+    return tmp_path / configure.VALIDATED_FILE
+
+
+def test_validate_options(validated, monkeypatch):
+    ctx = configure.defaultOption()
+    configure.validateOptions(ctx)
+    assert json.loads(validated.read_text()) == [configure.options_hash(ctx)]
+
+    # memoized options skip the schema validator, even in a new process
+    monkeypatch.setattr(configure, "_validated", None)
+    monkeypatch.setattr(configure, "_get_validator", None)
+    configure.validateOptions(configure.defaultOption())
+
+
+def test_validate_options_invalid(validated):
+    ctx = configure.defaultOption()
+    ctx["Scaling"] = "sideways"
+    with pytest.raises(ValueError):
+        configure.validateOptions(ctx)
+    with pytest.raises(ValueError):
+        configure.validateOptions(ctx)
+    assert not validated.exists()
+
+
+@pytest.mark.parametrize(
+    "ratio, sar",
+    [(0.89, [8, 9]), (0.9, [9, 10]), (0.68, [2, 3]), (1.12, [9, 8]), (1.45, [3, 2])],
+)
+def test_nearest_sar(ratio, sar):
+    assert configure.nearest_sar(ratio) == sar
+
+
+def test_lazy_imports():
+    # heavy dependencies must not be loaded by importing the package modules
+    code = (
+        "import sys;"
+        "import fluorofix.batch, fluorofix.configure, fluorofix.probe;"
+        "print(' '.join(m for m in ('numpy', 'ffmpegio', 'cerberus')"
+        " if m in sys.modules))"
+    )
+    src = path.join(path.dirname(__file__), "..", "src")
+    ret = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        env={**environ, "PYTHONPATH": src},
+    )
+    assert ret.returncode == 0, ret.stderr
+    assert ret.stdout.strip() == ""
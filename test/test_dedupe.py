@@ -0,0 +1,93 @@
+import os
+from fluorofix import batch, configure, dedupe, probe
+import pytest
+
+
+@pytest.fixture()
+def files(tmp_path):
+    data = os.urandom(4 * 2**20)
+    # same size, differ at a byte which quick_hash does not sample
+    altered = bytearray(data)
+    altered[100000] ^= 0xFF
+
+    files = {}
+    for name, content in (
+        ("a/study.mp4", data),
+        ("b/study_copy.mp4", data),
+        ("c/study.mp4", data),
+        ("altered.mp4", altered),
+        ("short.mp4", data[:1000]),
+        ("short_copy.mp4", data[:1000]),
+    ):
+        f = tmp_path / name
+        f.parent.mkdir(exist_ok=True)
+        f.write_bytes(content)
+        files[name] = str(f)
+    return files
+
+
+def test_hash(files):
+    assert dedupe.quick_hash(files["a/study.mp4"]) == dedupe.quick_hash(
+        files["altered.mp4"]
+    )
+    assert dedupe.full_hash(files["a/study.mp4"]) != dedupe.full_hash(
+        files["altered.mp4"]
+    )
+    assert dedupe.quick_hash(files["short.mp4"]) != dedupe.quick_hash(
+        files["a/study.mp4"]
+    )
+
+
+def test_find_duplicates(files):
+    dups = dedupe.find_duplicates(files.values(), max_workers=2)
+    assert dups == {
+        files["b/study_copy.mp4"]: files["a/study.mp4"],
+        files["c/study.mp4"]: files["a/study.mp4"],
+        files["short_copy.mp4"]: files["short.mp4"],
+    }
+
+
+def test_analyze_files_dedupe(tmp_path, monkeypatch, files):
+    monkeypatch.setattr(
+        probe, "check_file", lambda ctx, f: {"prof": "480p", "dst": f + ".out"}
+    )
+    res, _ = probe.analyze_files({}, [str(tmp_path)], dedupe=True)
+    assert len(res) == len(files)
+    assert res[files["c/study.mp4"]]["dup_of"] == files["a/study.mp4"]
+    assert "dup_of" not in res[files["altered.mp4"]]
+
+
+@pytest.mark.parametrize("mode", ["hardlink", "copy", "record"])
+def test_run_batch_duplicates(tmp_path, monkeypatch, files, mode):
+    ran = []
+
+    def run_job(ctx, src, data, threads=None):
+        ran.append(src)
+        os.makedirs(os.path.dirname(data["dst"]), exist_ok=True)
+        with open(data["dst"], "wb") as f:
+            f.write(b"encoded")
+        return {"dst": data["dst"], "error": None, "elapsed": 0.0, "skipped": False}
+
+    monkeypatch.setattr(batch, "run_job", run_job)
+
+    ctx = configure.defaultOption()
+    ctx["Duplicates"] = mode
+    configure.validateOptions(ctx)
+
+    orig, dup = files["a/study.mp4"], files["b/study_copy.mp4"]
+    jobs = {
+        src: {"prof": "Siemens Axiom (480p)", "dst": str(tmp_path / "out" / f"{i}.mp4")}
+        for i, src in enumerate((orig, dup))
+    }
+    jobs[dup]["dup_of"] = orig
+
+    res = batch.run_batch(ctx, jobs, max_workers=1)
+    assert ran == [orig]
+    assert res[dup]["error"] is None and res[dup]["dup_of"] == orig
+    if mode == "record":
+        assert res[dup]["dst"] == res[orig]["dst"]
+    else:
+        assert open(res[dup]["dst"], "rb").read() == b"encoded"
+        assert os.path.samefile(res[dup]["dst"], res[orig]["dst"]) == (
+            mode == "hardlink"
+        )
@@ -0,0 +1,105 @@
+from fractions import Fraction
+import subprocess
+
+from fluorofix import fov
+import numpy as np
+import pytest
+
+
+def make_frames(shape, nframes=40, seed=0):
+    # noisy field of view on a constant frame with burned-in "text"
+    h, w = 120, 180
+    rng = np.random.default_rng(seed)
+    Y, X = np.mgrid[:h, :w]
+    if shape == "circ":
+        inside = ((X - 90.5) / 70) ** 2 + ((Y - 62.5) / 62) ** 2 <= 1
+    else:
+        inside = (X >= 30) & (X < 150) & (Y >= 10) & (Y < 110)
+    frames = np.full((nframes, h, w), 16, np.uint8)
+    noise = rng.integers(60, 200, (nframes, h, w), np.uint8)
+    frames[:, inside] = noise[:, inside]
+    frames[:, 2:8, 2:30] = 255
+    return frames
+
+
+def test_temporal_stats():
+    frames = make_frames("rect")
+    mx, var = fov.temporal_stats(frames, chunk=7)
+    assert np.array_equal(mx, frames.max(axis=0))
+    assert np.allclose(var, frames.astype(float).var(axis=0))
+
+
+def test_active_region():
+    frames = make_frames("rect")
+    mask = fov.active_region(fov.temporal_stats(frames)[1])
+    assert mask[10:110, 30:150].all()
+    assert not mask[:, :30].any() and not mask[110:].any()
+
+
+@pytest.mark.parametrize(
+    "shape, expected",
+    [("circ", (21.0, 1.0, 140.0, 124.0)), ("rect", (30.0, 10.0, 120.0, 100.0))],
+)
+def test_fit_fov(shape, expected):
+    mask = fov.active_region(fov.temporal_stats(make_frames(shape))[1])
+    fit = fov.fit_fov(mask)
+    assert fit["shape"] == shape and fit["score"] > 0.95
+    assert [fit[k] for k in ("x0", "y0", "w", "h")] == pytest.approx(expected, abs=1.5)
+
+
+@pytest.mark.parametrize(
+    "fit, sar, spec",
+    [
+        (("circ", 45, 8, 530, 530, None), 1, {"circ": [45, 8, 530]}),
+        (
+            ("circ", 396, 82, 1144, 1017, [8, 9]),
+            1,
+            {"sar": [8, 9], "circ": [396, 92, 1144]},
+        ),
+        (("rect", 100, 40, 520, 400, None), 1, {"rect": [100, 40, 520, 400]}),
+        (
+            ("rect", 100, 36, 520, 356, None),
+            Fraction(8, 9),
+            {"rect": [100, 40, 520, 400]},
+        ),
+    ],
+)
+def test_fov_profile(fit, sar, spec):
+    shape, x0, y0, w, h, fitsar = fit
+    info = {"width": 720, "height": 480, "sample_aspect_ratio": sar}
+    detected = dict(shape=shape, x0=x0, y0=y0, w=w, h=h, sar=fitsar, score=1.0)
+    assert fov.fov_profile(detected, info) == [{"width": 720, "height": 480}, spec]
+
+
+def test_detect_fov(tmp_path):
+    import ffmpegio
+
+    # SAR 8:9 video of a round field of view, cut off at the bottom
+    src = str(tmp_path / "fov.mp4")
+    expr = "if(lte(pow((X-360)/258.75\\,2)+pow((Y-270)/230\\,2)\\,1)\\,lum(X\\,Y)\\,16)"
+    subprocess.run(
+        [
+            ffmpegio.get_path(),
+            *("-v", "error", "-f", "lavfi", "-i"),
+            "color=c=gray:s=720x480:r=30:d=2,format=yuv420p,noise=alls=40:allf=t,"
+            f"geq=lum='{expr}':cb=128:cr=128",
+            *("-c:v", "libx264", "-preset", "ultrafast", src),
+        ],
+        check=True,
+    )
+    info = {
+        "width": 720,
+        "height": 480,
+        "duration": 2.0,
+        "frame_rate": Fraction(30),
+        "sample_aspect_ratio": Fraction(1),
+    }
+    detected = fov.detect_fov(src, info)
+    assert detected["shape"] == "circ" and detected["sar"] == [8, 9]
+    assert [detected[k] for k in ("x0", "y0", "w")] == pytest.approx(
+        [101.25, 40, 517.5], abs=3
+    )
+
+    ctx = {"Profiles": {}}
+    assert fov.auto_profile(ctx, src, info) == "auto 720x480"
+    assert ctx["Profiles"]["auto 720x480"][1]["sar"] == [8, 9]
@@ -0,0 +1,197 @@
+from threading import Thread
+from time import sleep
+
+import pytest
+
+from fluorofix import configure, jobqueue
+
+
+def _redis_queue(**kwargs):
+    redis = pytest.importorskip("redis")
+    queue = jobqueue.RedisQueue(name="fluorofix-test", **kwargs)
+    try:
+        queue._client.ping()
+    except redis.ConnectionError:
+        pytest.skip("no Redis server")
+    queue._client.delete(*queue._keys, "fluorofix-test:context")
+    return queue
+
+
+def _fakeredis_queue(monkeypatch, **kwargs):
+    # in-process Redis server running the Lua scripts with lupa
+    redis = pytest.importorskip("redis")
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.Redis,
+        "from_url",
+        classmethod(lambda cls, url, **kw: fakeredis.FakeRedis(server=server)),
+    )
+    return jobqueue.RedisQueue(name="fluorofix-test", **kwargs)
+
+
+@pytest.fixture(params=["sqlite", "redis", "fakeredis"])
+def queue(request, tmp_path, monkeypatch):
+    kwargs = {"max_attempts": 2, "backoff": 10.0}
+    if request.param == "sqlite":
+        q = jobqueue.SQLiteQueue(str(tmp_path / "queue.sqlite"), **kwargs)
+    elif request.param == "redis":
+        q = _redis_queue(**kwargs)
+    else:
+        q = _fakeredis_queue(monkeypatch, **kwargs)
+    yield q
+    q.close()
+
+
+def test_enqueue(queue):
+    jobs = [("/in/a.mp4", {"prof": "p", "dst": "/out/a.mp4"})]
+    assert queue.enqueue(jobs) == 1
+    assert queue.enqueue(jobs) == 0
+    job = queue.lease("node1", 60.0, now=100.0)
+    assert job["src"] == "/in/a.mp4" and job["data"] == jobs[0][1]
+    assert queue.complete(job, now=110.0)
+    assert queue.enqueue(jobs) == 0  # done
+    assert queue.enqueue([("/in/a.mp4", {"prof": "p", "dst": "/out/b.mp4"})]) == 1
+    assert queue.pending() == 1
+
+
+def test_retry(queue):
+    queue.enqueue([("/in/a.mp4", {"prof": "p", "dst": "/out/a.mp4"})])
+    job = queue.lease("node1", 60.0, now=100.0)
+    assert queue.complete(job, "failed", now=101.0)
+    assert queue.lease("node1", 60.0, now=105.0) is None  # backing off
+    job = queue.lease("node2", 60.0, now=112.0)
+    assert job["attempts"] == 2 and job["node"] == "node2"
+    assert queue.complete(job, "failed again", now=113.0)
+    assert queue.lease("node1", 60.0, now=1000.0) is None
+    (job,) = queue.jobs()
+    assert job["status"] == "failed" and job["error"] == "failed again"
+    assert queue.pending() == 0
+
+
+def test_lease_expiry(queue):
+    queue.enqueue([("/in/a.mp4", {"prof": "p", "dst": "/out/a.mp4"})])
+    job = queue.lease("node1", 30.0, now=100.0)
+    assert queue.heartbeat(job, 30.0, now=120.0)
+    assert queue.lease("node2", 30.0, now=140.0) is None  # renewed until 150
+    queue.requeue_expired(now=151.0)
+    assert queue.jobs()[0]["error"] == "lease expired"
+    retried = queue.lease("node2", 30.0, now=162.0)
+    assert retried["attempts"] == 2
+    assert not queue.heartbeat(job, 30.0, now=163.0)
+    assert not queue.complete(job, now=164.0)
+    assert queue.complete(retried, elapsed=3.0, now=165.0)
+    assert jobqueue.queue_counts(queue.jobs())["done"] == 1
+
+
+def test_node_stats():
+    def job(node, status, started=None, finished=None, elapsed=None):
+        return dict(
+            node=node,
+            status=status,
+            size=10**6,
+            started=started,
+            finished=finished,
+            elapsed=elapsed,
+        )
+
+    jobs = [
+        job("a", "done", 0.0, 40.0, 40.0),
+        job("a", "done", 30.0, 80.0, 50.0),
+        job("b", "leased", 0.0),
+        job(None, "queued"),
+    ]
+    stats = jobqueue.node_stats(jobs)
+    assert stats["a"]["done"] == 2 and stats["a"]["busy"] == 90.0
+    assert stats["a"]["jobs_per_hour"] == 90.0
+    assert stats["a"]["bytes_per_sec"] == 25000.0
+    assert stats["b"]["active"] == 1 and stats["b"]["jobs_per_hour"] is None
+
+
+def test_worker(tmp_path, monkeypatch):
+    ran = []
+
+    def run_job(ctx, src, data, threads=None, progress=None, tmpfile=None):
+        ran.append(src)
+        error = "broken" if src.endswith("bad.mp4") else None
+        return {"dst": data["dst"], "error": error, "elapsed": 0.1, "skipped": False}
+
+    monkeypatch.setattr(jobqueue, "run_job", run_job)
+
+    files = {
+        str(tmp_path / f"{name}.mp4"): {
+            "prof": "Toshiba Kalare (1080p)",
+            "dst": str(tmp_path / f"{name}_fixed.mp4"),
+        }
+        for name in ("a", "b", "bad")
+    }
+    dup = str(tmp_path / "c.mp4")
+    files[dup] = {
+        **files[str(tmp_path / "a.mp4")],
+        "dst": str(tmp_path / "c_fixed.mp4"),
+    }
+    files[dup]["dup_of"] = str(tmp_path / "a.mp4")
+    (tmp_path / "a_fixed.mp4").write_bytes(b"fixed")
+    queue = jobqueue.SQLiteQueue(
+        str(tmp_path / "queue.sqlite"), max_attempts=2, backoff=0.1
+    )
+    reports = []
+    coordinator = Thread(
+        target=lambda: reports.append(
+            jobqueue.coordinate(queue, configure.defaultOption(), files, interval=0.05)
+        )
+    )
+    coordinator.start()
+    try:
+        while not queue.pending():
+            sleep(0.01)
+        workers = [
+            jobqueue.QueueWorker(queue, node, max_workers=1, lease=5.0, poll=0.05)
+            for node in ("node1", "node2")
+        ]
+        threads = [Thread(target=worker.run) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        coordinator.join()
+        queue.close()
+
+    srcs = [src for src in files if src != dup]
+    assert sorted(ran) == sorted([*srcs, str(tmp_path / "bad.mp4")])
+    assert (tmp_path / "c_fixed.mp4").read_bytes() == b"fixed"
+    assert sum(worker.processed for worker in workers) == 4
+    nqueued, counts, nodes = reports[0]
+    assert nqueued == 3
+    assert counts == {"queued": 0, "leased": 0, "done": 2, "failed": 1}
+    assert sum(s["done"] + s["failed"] for s in nodes.values()) == 3
+
+
+def test_worker_lease_lost(tmp_path, monkeypatch):
+    aborted = []
+
+    def run_job(ctx, src, data, threads=None, progress=None, tmpfile=None):
+        for _ in range(100):
+            if progress({}, False):  # FFmpeg would be stopped
+                aborted.append(tmpfile)
+                return {"dst": data["dst"], "error": "canceled", "elapsed": 0.1}
+            sleep(0.01)
+        return {"dst": data["dst"], "error": None, "elapsed": 1.0}
+
+    monkeypatch.setattr(jobqueue, "run_job", run_job)
+
+    class LosingQueue(jobqueue.SQLiteQueue):
+        def heartbeat(self, job, duration, now=None):
+            return False
+
+    queue = LosingQueue(str(tmp_path / "queue.sqlite"), max_attempts=1)
+    queue.set_context(configure.defaultOption())
+    queue.enqueue([("/in/a.mp4", {"prof": "p", "dst": "/out/a.mp4"})])
+    worker = jobqueue.QueueWorker(queue, "node1", max_workers=1, lease=0.15, poll=0.01)
+    worker.run()
+    queue.close()
+
+    (tmpfile,) = aborted
+    assert tmpfile.startswith("/out/a.part-") and tmpfile.endswith(".mp4")
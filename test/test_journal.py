@@ -0,0 +1,95 @@
+import os
+from fluorofix import batch, configure, journal
+import pytest
+
+
+@pytest.fixture()
+def ctx():
+    return configure.defaultOption()
+
+
+@pytest.fixture()
+def files(tmp_path):
+    files = {}
+    for i in range(3):
+        src = tmp_path / "src" / f"video{i}.mp4"
+        src.parent.mkdir(exist_ok=True)
+        src.write_bytes(b"0" * (i + 1))
+        files[str(src)] = {
+            "prof": "Siemens Axiom (480p)",
+            "dst": str(tmp_path / "out" / f"video{i}_fixed.mp4"),
+        }
+    return files
+
+
+def test_config_hash(ctx):
+    prof = "Siemens Axiom (480p)"
+    h = journal.config_hash(ctx, prof)
+    assert h == journal.config_hash(configure.defaultOption(), prof)
+    assert h != journal.config_hash(ctx, "Toshiba Kalare (1080p)")
+    ctx["OutputOptions"]["crf"] = 23
+    assert h != journal.config_hash(ctx, prof)
+    ctx = configure.defaultOption()
+    ctx["Decimate"] = True
+    assert h != journal.config_hash(ctx, prof)
+
+
+def test_journal(tmp_path, files):
+    db = journal.Journal.for_folder(str(tmp_path / "out"))
+    src, data = next(iter(files.items()))
+    dst = data["dst"]
+
+    assert not db.is_done(src, dst, "cfg")
+    db.start(src, dst, "cfg")
+    assert db.get(src)["status"] == "running"
+
+    # output must exist
+    db.finish(src)
+    assert not db.is_done(src, dst, "cfg")
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    open(dst, "wb").close()
+    assert db.is_done(src, dst, "cfg")
+
+    # config or source changes
+    assert not db.is_done(src, dst, "new cfg")
+    st = os.stat(src)
+    os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    assert not db.is_done(src, dst, "cfg")
+
+    db.start(src, dst, "cfg")
+    db.finish(src, "failed")
+    assert db.get(src)["error"] == "failed" and not db.is_done(src, dst, "cfg")
+
+
+def test_run_batch_resume(tmp_path, monkeypatch, ctx, files):
+    ran = []
+
+    def run_job(ctx, src, data, threads=None):
+        ran.append(src)
+        os.makedirs(os.path.dirname(data["dst"]), exist_ok=True)
+        open(data["dst"], "wb").close()
+        return {"dst": data["dst"], "error": None, "elapsed": 0.0, "skipped": False}
+
+    monkeypatch.setattr(batch, "run_job", run_job)
+    db = str(tmp_path / "out" / journal.JOURNAL_FILE)
+
+    batch.run_batch(ctx, files, max_workers=1, journal=db)
+    assert len(ran) == 3
+
+    # only the modified source and the jobs of the changed profile are redone
+    src = next(iter(files))
+    with open(src, "ab") as f:
+        f.write(b"1")
+    ran.clear()
+    res = batch.run_batch(ctx, files, max_workers=1, journal=db)
+    assert ran == [src]
+    assert sum(r["skipped"] for r in res.values()) == 2
+
+    ctx["Profiles"]["Siemens Axiom (480p)"][1]["circ"] = [40, 8, 530]
+    ran.clear()
+    batch.run_batch(ctx, files, max_workers=1, journal=db)
+    assert len(ran) == 3
+
+
+def test_partial_name():
+    assert batch.partial_name("out/video.mp4") == "out/video.part.mp4"
@@ -0,0 +1,103 @@
+import json
+from fluorofix import cache, metrics
+import pytest
+
+
+@pytest.fixture()
+def records():
+    records = []
+    metrics.add_sink(records.append)
+    yield records
+    metrics.remove_sink(records.append)
+
+
+@pytest.mark.parametrize(
+    "log, res",
+    [
+        ("", {}),
+        (
+            "bench: utime=0.010s stime=0.014s rtime=0.025s\nbench: maxrss=27620KiB\n",
+            {"utime": 0.01, "stime": 0.014, "rtime": 0.025, "maxrss": 27620 * 1024},
+        ),
+        ("bench: maxrss=100kB", {"maxrss": 102400}),
+    ],
+)
+def test_parse_benchmark_log(log, res):
+    assert metrics.parse_benchmark_log(log) == res
+
+
+def test_progress_recorder(tmp_path):
+    updates = []
+    recorder = metrics.ProgressRecorder(lambda *args: updates.append(args))
+    recorder({"frame": 30, "fps": 60.0, "out_time_us": 1000000}, False)
+    recorder({"speed": "2.01x"}, True)
+    assert len(updates) == 2
+
+    dst = tmp_path / "out.mp4"
+    dst.write_bytes(b"0" * 1000)
+    rec = recorder.record("transcode", "in.mp4", str(dst), 0.0)
+    assert rec["frame"] == 30 and rec["speed"] == 2.01 and rec["out_time"] == 1.0
+    assert rec["bytes_in"] is None and rec["bytes_out"] == 1000
+    assert rec["bitrate"] == 8000
+
+
+def test_sinks(tmp_path):
+    jsonl = metrics.add_sink(metrics.JSONLinesSink(str(tmp_path / "log.jsonl")))
+    prom = metrics.add_sink(metrics.PrometheusSink(str(tmp_path / "fluorofix.prom")))
+    try:
+        metrics.emit({"event": "transcode", "wall_time": 2.0, "maxrss": 1024})
+        metrics.emit({"event": "transcode", "error": "failed", "maxrss": 512})
+        metrics.emit({"event": "probe", "wall_time": 0.5, "cached": True})
+        prom.flush()
+    finally:
+        metrics.remove_sink(jsonl)
+        metrics.remove_sink(prom)
+
+    lines = (tmp_path / "log.jsonl").read_text().splitlines()
+    assert [json.loads(line)["event"] for line in lines] == [
+        "transcode",
+        "transcode",
+        "probe",
+    ]
+
+    prom = (tmp_path / "fluorofix.prom").read_text()
+    assert 'fluorofix_transcode_jobs_total{status="ok"} 1' in prom
+    assert 'fluorofix_transcode_jobs_total{status="failed"} 1' in prom
+    assert "fluorofix_transcode_peak_rss_bytes 1024" in prom
+    assert 'fluorofix_probe_total{cached="true"} 1' in prom
+
+
+def test_batch_progress(records):
+    progress = metrics.BatchProgress(4)
+    progress("a.mp4", {"error": None})
+    progress("b.mp4", {"error": "failed"})
+    assert [r["files_done"] for r in records] == [1, 2]
+    assert records[-1]["files_failed"] == 1
+    assert progress.eta is not None and progress.eta >= 0
+
+
+def test_batch_progress_skipped(records):
+    progress = metrics.BatchProgress(10, duplicates=2)
+    progress("a.mp4", {"error": None, "skipped": True})
+    progress("b.mp4", {"error": None, "skipped": False, "dup_of": "c.mp4"})
+    assert progress.eta is None  # nothing encoded yet
+    assert records[-1]["files_skipped"] == 2
+    assert records[-1]["files_per_second"] == 0
+
+    progress.start -= 10.0
+    progress("c.mp4", {"error": None, "skipped": False})
+    # 10 s per encoded file, 6 files left to encode (1 more duplicate)
+    assert progress.eta == pytest.approx(60.0, abs=0.5)
+
+
+def test_probe_metrics(tmp_path, records):
+    f = tmp_path / "video.mp4"
+    f.write_bytes(b"0")
+    info = [{"codec_name": "h264", "width": 1920, "height": 1080}]
+    db = cache.enable_probe_cache(str(tmp_path / "probe.sqlite"))
+    try:
+        db.put(str(f), info)
+        cache.video_streams_basic(str(f))
+    finally:
+        cache.disable_probe_cache()
+    assert records[-1]["event"] == "probe" and records[-1]["cached"]
@@ -0,0 +1,63 @@
+from fractions import Fraction
+import json
+import pickle
+
+from fluorofix import batch, configure
+from fluorofix.plan import TranscodePlan
+from fluorofix.transcode import form_transcode_args
+import pytest
+
+PROF = "Toshiba Kalare (1080p)"
+
+
+@pytest.fixture
+def ctx():
+    return {**configure.defaultOption(), "ApplyMask": False}
+
+
+def info(**kwargs):
+    return {
+        "width": 1920,
+        "height": 1080,
+        "sample_aspect_ratio": Fraction(1, 1),
+        "pix_fmt": "yuv420p",
+        "frame_rate": Fraction(30, 1),
+        **kwargs,
+    }
+
+
+def test_get_plan(ctx):
+    plan = batch.get_plan(ctx, PROF, info())
+    assert batch.get_plan(ctx, PROF, info(frame_rate=Fraction(25, 1))) is plan
+    assert batch.get_plan(ctx, PROF, info(height=1088)) is not plan
+    assert batch.get_plan({**ctx, "CropVideo": False}, PROF, info()) is not plan
+
+
+def test_bind(ctx):
+    plan = batch.get_plan(ctx, PROF, info())
+    args = plan.bind("in.mp4", "out.mp4", threads=2)
+    assert args["inputs"][0][0] == "in.mp4"
+    assert args["outputs"][0][0] == "out.mp4"
+    assert args["outputs"][0][1]["threads"] == 2
+    assert "threads" not in plan.args["outputs"][0][1]
+    assert args["global_options"] == plan.args["global_options"]
+    with pytest.raises(ValueError):
+        plan.bind(0, "out.mp4")
+
+
+def test_serialize(ctx):
+    plan = batch.get_plan(ctx, PROF, info())
+    data = json.loads(json.dumps(plan.to_dict()))
+    restored = TranscodePlan.from_dict(data)
+    assert restored.kwargs == plan.kwargs
+    assert restored.bind("a.mp4", "b.mp4") == plan.bind("a.mp4", "b.mp4")
+
+    restored = pickle.loads(pickle.dumps(plan))
+    assert restored.bind("a.mp4", "b.mp4") == plan.bind("a.mp4", "b.mp4")
+
+
+def test_form_transcode_args_sar():
+    # without an explicit SAR, pixels are squared with the source SAR
+    src_info = {"width": 720, "height": 480, "sample_aspect_ratio": Fraction(8, 9)}
+    args = form_transcode_args("in.mp4", "out.mp4", src_info, square="upscale")
+    assert args["outputs"][0][1]["vf"].startswith("scale=h=540,")
@@ -1,4 +1,4 @@
-from fluorofix import probe, configure
+from fluorofix import cache, probe, configure
 from os import path
 
 
@@ -23,5 +23,33 @@ def test_is_video():
         print(file, tf, prof, actual_prof)
         assert tf == valid and prof == actual_prof
 
+
+def test_scan_files(tmp_path):
+    ctx = configure.defaultOption()
+    ctx["OutputFolder"] = str(tmp_path / "out")
+    info = {
+        480: [{"codec_name": "h264", "width": 720, "height": 480}],
+        720: [{"codec_name": "h264", "width": 1280, "height": 720}],
+    }
+
+    db = cache.enable_probe_cache(str(tmp_path / "probe.sqlite"))
+    try:
+        for i in range(10):
+            f = tmp_path / "in" / f"{i}" / "video.mp4"
+            f.parent.mkdir(parents=True)
+            f.write_bytes(b"0")
+            db.put(str(f), info[480 if i % 2 else 720])
+        (tmp_path / "in" / "opts.json").write_text("{}")
+
+        res = dict(probe.scan_files(ctx, [str(tmp_path / "in")], max_workers=2))
+        assert len(res) == 5
+        assert all(d["prof"] == "Siemens Axiom (480p)" for d in res.values())
+
+        vids, opts = probe.analyze_files(ctx, [str(tmp_path / "in")], max_workers=2)
+        assert vids == res and len(opts) == 1
+    finally:
+        cache.disable_probe_cache()
+
+
 if __name__ == "__main__":
     test_is_video()
@@ -0,0 +1,78 @@
+from fractions import Fraction
+import logging
+
+import pytest
+
+from fluorofix import configure, probe, profiles
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (1080, 1080),
+        (1080.0, 1080),
+        ("1080", 1080),
+        ("29.97", Fraction(2997, 100)),
+        ("30000/1001", Fraction(30000, 1001)),
+        ("8:9", Fraction(8, 9)),
+        ([8, 9], Fraction(8, 9)),
+        ("h264", "h264"),
+        (None, None),
+    ],
+)
+def test_normalize_value(value, expected):
+    v = profiles.normalize_value(value)
+    assert v == expected and type(v) == type(expected) or isinstance(v, Fraction)
+
+
+PROFILES = {
+    "any": [{}, {}],
+    "1080p": [{"height": 1080}, {}],
+    "1080p h264": [{"height": "1080", "codec_name": "h264"}, {}],
+    "1080p ntsc": [{"height": 1080, "frame_rate": "30000/1001"}, {}],
+    "hd": [{"height": {"min": 720, "max": 1080}}, {}],
+    "sd": [{"height": {"max": 576}, "sample_aspect_ratio": "*"}, {}],
+}
+
+
+@pytest.mark.parametrize(
+    "info, expected",
+    [
+        ({"height": 1080, "codec_name": "h264"}, "1080p h264"),
+        ({"height": 1080, "codec_name": "hevc"}, "1080p"),
+        ({"height": 1080, "frame_rate": Fraction(30000, 1001)}, "1080p ntsc"),
+        ({"height": 720}, "hd"),
+        ({"height": 480, "sample_aspect_ratio": Fraction(8, 9)}, "sd"),
+        ({"height": 480}, "any"),
+    ],
+)
+def test_match(info, expected):
+    assert profiles.ProfileMatcher(PROFILES).match(info) == expected
+
+
+def test_ambiguities(caplog):
+    profs = {
+        "a": [{"height": 1080}, {}],
+        "b": [{"width": 1920}, {}],
+        "c": [{"height": {"min": 720}}, {}],
+        "d": [{"height": {"max": 480}}, {}],
+        "e": [{"height": 480}, {}],
+    }
+    with caplog.at_level(logging.WARNING):
+        matcher = profiles.ProfileMatcher(profs)
+    assert matcher.ambiguities == [("a", "b"), ("b", "e")]
+    assert '"a" and "b"' in caplog.text
+    assert matcher.match({"height": 1080, "width": 1920}) == "a"
+
+
+def test_find_profile():
+    profs = configure.defaultOption()["Profiles"]
+    assert probe.find_profile({"height": 480}, profs) == "Siemens Axiom (480p)"
+    assert profiles.get_matcher(profs) is profiles.get_matcher(profs)
+    with pytest.raises(ValueError):
+        probe.find_profile({"height": 720}, profs)
+
+    # modified profiles are recompiled
+    profs["HD"] = [{"height": 720}, {}]
+    profiles.compile_matcher(profs)
+    assert probe.find_profile({"height": 720}, profs) == "HD"
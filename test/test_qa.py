@@ -0,0 +1,101 @@
+from fractions import Fraction
+from os import path
+
+from fluorofix import qa
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize(
+    "duration, nframes, times",
+    [
+        (None, 6, [0.0]),
+        (0.0, 6, [0.0]),
+        (60.0, 3, [10.0, 30.0, 50.0]),
+        (10.0, 4, [1.25, 3.75, 6.25, 8.75]),
+    ],
+)
+def test_frame_times(duration, nframes, times):
+    assert qa.frame_times(duration, nframes) == times
+
+
+def test_render_outline():
+    shape = dict(x0=10, y0=10, w=20, h=20, fill_in=True, is_rect=True)
+    outline = qa.render_outline(40, 40, [shape])
+    assert outline[9:11, 10:30].all() and outline[29:31, 10:30].all()
+    assert not outline[12:28, 12:28].any() and not outline[:8].any()
+
+    # masked up to the frame edges: no outline along them
+    shape = dict(x0=0, y0=0, w=40, h=40)
+    outline = qa.render_outline(40, 40, [shape])
+    assert outline.any() and not outline[0, 20] and not outline[20, 0]
+
+
+@pytest.fixture()
+def plan():
+    info = {"width": 720, "height": 480, "pix_fmt": "yuv420p", "duration": 1.0}
+    kwargs = {
+        "mask_shapes": [dict(x0=45, y0=8, w=530, h=530)],
+        "sar": Fraction(8, 9),
+        "square": "upscale",
+        "crop": (45, 8, 530, 472),
+    }
+    src = path.join(path.dirname(__file__), "assets", "colorchart_720x480.mp4")
+    return qa.plan_sheet(src, info, kwargs, nframes=4, height=120, cols=3)
+
+
+def test_plan_sheet(plan):
+    assert plan["times"] == [0.125, 0.375, 0.625, 0.875]
+    # 720x480 at 8:9 is 4:3; 530x532 squared output
+    assert plan["panels"] == (160, 120)
+    assert plan["cell"] == (288, 128) and plan["size"] == (864, 256)
+
+
+def test_form_sheet_args(plan, tmp_path, monkeypatch):
+    monkeypatch.setenv("FLUOROFIX_CACHE_DIR", str(tmp_path))
+    args = qa.form_sheet_args(
+        [plan, plan], ["a.png", "b.png"], str(tmp_path), page="page.png"
+    )
+
+    # keyframe-only seeks, one input per sampled frame
+    seeks = [opts for url, opts in args["inputs"] if url == plan["src"]]
+    assert len(seeks) == 8
+    assert all(opts["skip_frame"] == "nokey" for opts in seeks)
+    assert [opts["ss"] for opts in seeks[:4]] == plan["times"]
+
+    assert [url for url, _ in args["outputs"]] == ["a.png", "b.png", "page.png"]
+    fg = args["global_options"]["filter_complex"]
+    assert fg.count("hstack") == 8 and fg.count("xstack") == 3
+    assert path.exists(tmp_path / "outline_0_src.png")
+
+
+def test_render_sheets(plan, tmp_path):
+    dsts = [str(tmp_path / "sheet.png")]
+    qa.render_sheets([plan], dsts, str(tmp_path / "page.png"))
+    assert path.getsize(dsts[0]) and path.getsize(tmp_path / "page.png")
+
+
+def test_contact_sheets(plan, tmp_path, monkeypatch):
+    from fluorofix import cache, configure
+
+    monkeypatch.setenv("FLUOROFIX_CACHE_DIR", str(tmp_path))
+    info = {"codec_name": "h264", "width": 720, "height": 480, "pix_fmt": "yuv420p"}
+    info["duration"] = 1.0
+    src = plan["src"]
+    bad = path.join(path.dirname(src), "colorchart_1280x720.mp4")
+    db = cache.enable_probe_cache(str(tmp_path / "probe.sqlite"))
+    try:
+        db.put(src, [info])
+        db.put(bad, [{**info, "width": 1280, "height": 720}])
+        files = {
+            src: {"prof": "Siemens Axiom (480p)", "dst": "a.mp4"},
+            bad: {"prof": "unknown", "dst": "b.mp4"},
+        }
+        # an unknown profile fails its sheet only
+        sheets, pages = qa.contact_sheets(
+            configure.defaultOption(), files, str(tmp_path / "qa"), nframes=2
+        )
+    finally:
+        cache.disable_probe_cache()
+    assert sheets[src] and path.exists(sheets[src]) and len(pages) == 1
+    assert sheets[bad] is None
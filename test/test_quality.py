@@ -0,0 +1,110 @@
+from fluorofix import quality
+import pytest
+
+
+@pytest.mark.parametrize(
+    "duration, nsamples, length, samples",
+    [
+        (None, 3, 4.0, [(None, None)]),
+        (10.0, 3, 4.0, [(None, None)]),
+        (30.0, 3, 4.0, [(3.0, 7.0), (13.0, 17.0), (23.0, 27.0)]),
+        (60.0, 2, 2.0, [(14.0, 16.0), (44.0, 46.0)]),
+    ],
+)
+def test_sample_times(duration, nsamples, length, samples):
+    assert quality.sample_times(duration, nsamples, length) == samples
+
+
+@pytest.mark.parametrize(
+    "width, height, mask_shapes, crop, window",
+    [
+        (720, 480, [], None, None),
+        (
+            720,
+            480,
+            [dict(x0=45, y0=8, w=530, h=530)],
+            (45, 8, 530, 472),
+            (78, 78, 374, 374),
+        ),
+        (720, 480, [dict(x0=45, y0=8, w=530, h=530)], False, (122, 86, 374, 374)),
+        (
+            1280,
+            720,
+            [
+                dict(x0=1000, y0=600, w=120, h=40, is_rect=True, fill_in=True),
+                dict(x0=160, y0=40, w=960, h=640, is_rect=True),
+            ],
+            (160, 40, 960, 640),
+            (0, 0, 960, 640),
+        ),
+    ],
+)
+def test_fov_window(width, height, mask_shapes, crop, window):
+    assert quality.fov_window(width, height, mask_shapes, 1, None, crop) == window
+
+
+@pytest.mark.parametrize("boundary", [0, 1, 17, 50, 51, None])
+def test_bisect_crf(boundary):
+    tested = []
+
+    def test(crf):
+        tested.append(crf)
+        return boundary is not None and crf >= boundary
+
+    assert quality.bisect_crf(test, 0, 51) == boundary
+    assert len(tested) <= 7
+
+
+def test_select_output_options(tmp_path, monkeypatch):
+    from fractions import Fraction
+    import subprocess
+
+    import ffmpegio
+
+    from fluorofix import configure
+
+    monkeypatch.setenv("FLUOROFIX_CACHE_DIR", str(tmp_path))
+    src = str(tmp_path / "clip.mp4")
+    subprocess.run(
+        [
+            ffmpegio.get_path(),
+            *("-v", "error", "-f", "lavfi", "-i", "testsrc2=s=320x240:r=15:d=2"),
+            *("-c:v", "libx264", "-qp", "0", "-pix_fmt", "yuv420p", src),
+        ],
+        check=True,
+    )
+    src_info = {
+        "codec_name": "h264",
+        "width": 320,
+        "height": 240,
+        "pix_fmt": "yuv420p",
+        "duration": 2.0,
+        "frame_rate": Fraction(15),
+        "sample_aspect_ratio": Fraction(1),
+    }
+    ctx = configure.defaultOption()
+    ctx["Profiles"] = {"test": [{"height": 240}, {"rect": [20, 10, 280, 220]}]}
+
+    res = quality.select_output_options(
+        ctx, "test", src, src_info, ssim=0.95, nsamples=1, length=1.0
+    )
+    assert res["codec"] == "libx264" and res["ssim"] >= 0.95
+    assert res["OutputOptions"]["crf"] == res["crf"]
+    assert "an" not in res["OutputOptions"]
+
+    # both quality targets must be met
+    both = quality.select_output_options(
+        ctx, "test", src, src_info, ssim=0.95, psnr=40.0, nsamples=1, length=1.0
+    )
+    assert both["ssim"] >= 0.95 and both["psnr"] >= 40.0
+    assert both["crf"] < res["crf"]  # the PSNR target is the stricter one
+    with pytest.raises(ValueError):
+        quality.select_output_options(ctx, "test", src, ssim=0.95, bitrate=1e6)
+
+    # cached selection
+    assert (
+        quality.select_output_options(
+            ctx, "test", "missing.mp4", ssim=0.95, nsamples=1, length=1.0
+        )
+        == res
+    )
@@ -1,3 +1,6 @@
+from fractions import Fraction
+import io
+from os import path
 from fluorofix import transcode
 import pytest
 import ffmpegio
@@ -40,6 +43,34 @@ def test_create_mask_n_crop(mask_shapes):
         assert np.array_equal(crop, crop0)
 
 
+def test_render_mask_alpha(mask_shapes):
+    vidw = 16
+    vidh = 8
+
+    for i in range(1, 3):
+        alpha = transcode.render_mask_alpha(vidw, vidh, mask_shapes[:i])
+        assert alpha.shape == (vidh, vidw) and alpha.dtype == bool
+        Ix = np.where(np.logical_not(np.all(alpha, axis=0)))[0]
+        Iy = np.where(np.logical_not(np.all(alpha, axis=1)))[0]
+        crop0 = (Ix[0], Iy[0], Ix[-1] + 1 - Ix[0], Iy[-1] + 1 - Iy[0])
+        crop = transcode.masks_to_crop(vidw, vidh, mask_shapes[:i])
+        assert np.array_equal(crop, crop0)
+    assert alpha[4, 4]  # fill_in shape
+
+
+def test_create_mask_image(tmp_path, mask_shapes):
+    file = transcode.create_mask_image(16, 8, mask_shapes, "#ff8000", str(tmp_path))
+    assert file.startswith(str(tmp_path)) and tmp_path.joinpath(file).exists()
+    assert (
+        transcode.create_mask_image(16, 8, mask_shapes, "#ff8000", str(tmp_path))
+        == file
+    )
+    assert (
+        transcode.create_mask_image(16, 8, mask_shapes[:1], "#ff8000", str(tmp_path))
+        != file
+    )
+
+
 @pytest.mark.parametrize(
     "sar, square, crop, outsize",
     [
@@ -80,6 +111,288 @@ def test_adjust_masks(sar, square, crop):
     transcode.adjust_masks(win, hin, mask_shapes, sar, square, crop)
 
 
+@pytest.mark.parametrize(
+    "shape, crop, nboxes, nshapes",
+    [
+        (dict(x0=10, y0=10, w=50, h=40, is_rect=True), (10, 10, 50, 40), 0, 0),
+        (dict(x0=10, y0=10, w=50, h=40, is_rect=True), None, 4, 0),
+        (dict(x0=10, y0=10, w=5, h=5, is_rect=True, fill_in=True), None, 1, 0),
+        (
+            dict(x0=80, y0=10, w=5, h=5, is_rect=True, fill_in=True),
+            (0, 0, 50, 50),
+            0,
+            0,
+        ),
+        (dict(x0=80, y0=10, w=5, h=5, fill_in=True), (0, 0, 50, 50), 0, 0),
+        (dict(x0=10, y0=10, w=5, h=5, fill_in=True), (0, 0, 50, 50), 0, 1),
+        (dict(x0=0, y0=0, w=100, h=100), (40, 40, 20, 20), 0, 0),
+        (dict(x0=0, y0=0, w=100, h=100), (0, 0, 100, 100), 0, 1),
+    ],
+)
+def test_plan_masks(shape, crop, nboxes, nshapes):
+    vidw = vidh = 100
+    boxes, shapes = transcode.plan_masks(vidw, vidh, [shape], crop)
+    assert len(boxes) == nboxes and len(shapes) == nshapes
+
+    # planned masks must cover the same pixels
+    x0, y0, w, h = crop or (0, 0, vidw, vidh)
+    alpha0 = transcode.render_mask_alpha(vidw, vidh, [shape])[y0 : y0 + h, x0 : x0 + w]
+    alpha = np.zeros((h, w), bool)
+    for x, y, bw, bh in boxes:
+        alpha[y : y + bh, x : x + bw] = True
+    if shapes:
+        shapes = transcode.adjust_masks(vidw, vidh, shapes, crop=crop)
+        alpha |= transcode.render_mask_alpha(w, h, shapes)
+    assert np.array_equal(alpha, alpha0)
+
+
+@pytest.mark.parametrize(
+    "pix_fmt, format",
+    [
+        ("yuv420p", "yuv420"),
+        ("yuvj422p", "yuv422"),
+        ("yuv420p10le", "yuv420p10"),
+        ("rgb24", "auto"),
+    ],
+)
+def test_overlay_format(pix_fmt, format):
+    assert transcode.overlay_format(pix_fmt) == format
+
+
+def test_form_filtergraph(tmp_path, monkeypatch):
+    monkeypatch.setenv("FLUOROFIX_CACHE_DIR", str(tmp_path))
+    shapes = [dict(x0=396, y0=82, w=1144, h=1017)]
+    crop = transcode.masks_to_crop(1920, 1080, shapes)
+
+    # upscaling: mask the cropped frame then scale
+    mask, fg = transcode.form_filtergraph(
+        1920, 1080, shapes, Fraction(8, 9), "upscale", crop, "#000000", "yuv420p"
+    )
+    assert mask is not None
+    assert fg.index("overlay=format=yuv420") < fg.index("scale=h=1122")
+
+    # downscaling: scale then mask
+    mask, fg = transcode.form_filtergraph(
+        1920, 1080, shapes, Fraction(8, 9), "downscale", crop, "#000000", "yuv420p"
+    )
+    assert fg.index("overlay") > fg.index("scale=w=1016")
+
+    # rectangle: no overlay
+    shapes = [dict(x0=10, y0=10, w=1000, h=1000, fill_in=True, is_rect=True)]
+    mask, fg = transcode.form_filtergraph(1920, 1080, shapes, 1, None, None, "#000000")
+    assert mask is None and fg.startswith("drawbox=")
+
+
+def test_form_vf_setsar():
+    assert transcode.form_vf(720, 480, Fraction(8, 9)) == "setsar=8/9"
+    assert transcode.form_vf(720, 480, Fraction(8, 9), square="upscale") == (
+        "scale=h=540,setsar=1:1"
+    )
+
+
+def test_form_multi_transcode_args(tmp_path, monkeypatch):
+    monkeypatch.setenv("FLUOROFIX_CACHE_DIR", str(tmp_path))
+    info = {"width": 720, "height": 480, "pix_fmt": "yuv420p"}
+    shapes = [dict(x0=45, y0=8, w=530, h=530)]
+    outputs = [
+        {"dst": "swallow1.mp4", "tstart": 2.0, "tend": 4.0, "square": "upscale"},
+        {"dst": "swallow2.mp4", "tstart": 5.0, "tend": 6.5},
+        {"dst": "proxy.mp4", "height": 240, "enc_config": {"an": None}},
+    ]
+    args = transcode.form_multi_transcode_args(
+        "src.mp4", outputs, info, shapes, Fraction(8, 9)
+    )
+
+    # decoded and masked once, then split into the outputs
+    fg = args["global_options"]["filter_complex"]
+    assert len(args["inputs"]) == 2 and args["inputs"][0] == ("src.mp4", {})
+    assert fg.count("overlay") == 1 and "split=3[s0][s1][s2]" in fg
+    assert "[s0]trim=start=2.0:end=4.0,scale=h=532,setsar=1:1[v0]" in fg
+    assert "[s1]trim=start=5.0:end=6.5,setsar=8/9[v1]" in fg
+    assert "[s2]setsar=8/9,scale=-2:240[v2]" in fg
+
+    assert [url for url, _ in args["outputs"]] == [o["dst"] for o in outputs]
+    opts = [opts for _, opts in args["outputs"]]
+    assert opts[0]["map"] == ["[v0]", "0:a?"]
+    assert opts[1]["ss"] == 5.0 and opts[1]["to"] == 6.5
+    assert opts[2]["map"] == "[v2]"
+
+    # all clips: seek the input to the first clip
+    args = transcode.form_multi_transcode_args("src.mp4", outputs[:2], info)
+    assert args["inputs"] == [("src.mp4", {"ss": 2.0, "to": 6.5})]
+    fg = args["global_options"]["filter_complex"]
+    assert fg.startswith("[0:v]split=2") and "trim=start=0.0:end=2.0" in fg
+    assert args["outputs"][1][1]["ss"] == 3.0
+
+    with pytest.raises(ValueError):
+        transcode.form_multi_transcode_args("src.mp4", [], info)
+
+
+def test_transcode_multi(tmp_path):
+    src = path.join(path.dirname(__file__), "assets", "colorchart_720x480.mp4")
+    info = ffmpegio.probe.video_streams_basic(src)[0]
+    outputs = [
+        {"dst": str(tmp_path / "clip.mp4"), "tstart": 1.0, "tend": 2.0},
+        {"dst": str(tmp_path / "square.mp4"), "square": "upscale"},
+    ]
+    transcode.transcode_multi(
+        src,
+        [{**o, "enc_config": {"preset": "ultrafast"}} for o in outputs],
+        src_info=info,
+        mask_shapes=[dict(x0=45, y0=8, w=530, h=530)],
+        sar=Fraction(8, 9),
+    )
+    clip, square = (ffmpegio.probe.video_streams_basic(o["dst"])[0] for o in outputs)
+    assert clip["width"] == 530 and clip["duration"] == pytest.approx(1.0, abs=0.1)
+    assert square["sample_aspect_ratio"] == 1
+
+
+def test_is_stream(tmp_path):
+    assert not transcode.is_stream("video.mp4")
+    assert not transcode.is_stream(tmp_path / "video.mp4")
+    assert transcode.is_stream(0)
+    assert transcode.is_stream(io.BytesIO())
+
+
+def test_transcode_pipe():
+    src = path.join(path.dirname(__file__), "assets", "colorchart_720x480.mp4")
+    info = ffmpegio.probe.video_streams_basic(src)[0]
+    dst = io.BytesIO()
+    with open(src, "rb") as f:
+        transcode.transcode(
+            f,
+            dst,
+            mask_shapes=[dict(x0=45, y0=8, w=530, h=530)],
+            src_info=info,
+            sar=1,
+            enc_config={"preset": "ultrafast"},
+        )
+    assert ffmpegio.probe.video_streams_basic(dst.getvalue())[0]["width"] == 530
+
+
+@pytest.mark.parametrize(
+    "nsegments, tstart, tend, segments",
+    [
+        (1, None, None, [(None, None)]),
+        (3, None, None, [(None, 3), (3, 6), (6, None)]),
+        (4, None, None, [(None, 2), (2, 4), (4, 7), (7, None)]),
+        (20, None, None, [(None, 1), *((t, t + 1) for t in range(1, 8)), (8, None)]),
+        (2, 2.5, 8.5, [(2.5, 5), (5, 8.5)]),
+        (3, 8.5, None, [(8.5, None)]),
+    ],
+)
+def test_split_at_keyframes(nsegments, tstart, tend, segments):
+    keyframes = list(range(10))
+    assert transcode.split_at_keyframes(keyframes, nsegments, tstart, tend) == segments
+
+
+def test_keyframe_times():
+    src = path.join(path.dirname(__file__), "assets", "colorchart_720x480.mp4")
+    times = transcode.keyframe_times(src)
+    assert times[0] == 0 and times == sorted(times)
+
+
+@pytest.mark.parametrize(
+    "decimate, expr",
+    [
+        (True, "mpdecimate"),
+        ({"hi": 768, "lo": 320, "frac": 0.5}, "mpdecimate=hi=768:lo=320:frac=0.5"),
+    ],
+)
+def test_form_decimate(decimate, expr):
+    assert transcode.form_decimate(decimate) == expr
+
+
+def test_frame_map_file():
+    assert transcode.frame_map_file("out/video.mp4") == "out/video_frames.csv"
+
+
+@pytest.mark.parametrize(
+    "fg, mask_png, enc_config, kwargs, ok",
+    [
+        ("setsar=8:9", None, {"preset": "slow"}, {}, True),
+        ("setsar=8:9", None, {"preset": "slow", "crf": 18}, {}, True),
+        ("setsar=8:9", None, {"b:v": "2M"}, {}, True),
+        ("setsar=8:9", None, {"c:v": "libx265"}, {}, False),
+        ("setsar=8:9", None, {"c:v": "h264"}, {}, True),
+        ("setsar=8:9", None, {"c:v": "h264", "crf": 18}, {}, False),
+        ("setsar=8:9", None, {"c": "copy", "crf": 18}, {}, True),
+        ("setsar=8:9", None, {"c": "copy"}, {}, True),
+        ("", None, {"pix_fmt": "yuv420p"}, {}, True),
+        ("setsar=8:9", None, {"pix_fmt": "yuv444p"}, {}, False),
+        ("crop=530:472:45:8,setsar=1:1", None, {}, {}, False),
+        ("[0:v][1:v]overlay[vout]", "mask.png", {}, {}, False),
+        ("setsar=8:9", None, {"vf": "hflip"}, {}, False),
+        ("setsar=8:9", None, {}, {"tstart": 1.0}, False),
+        ("setsar=8:9", None, {}, {"decimate": True}, False),
+    ],
+)
+def test_can_remux(fg, mask_png, enc_config, kwargs, ok):
+    info = {"codec_name": "h264", "pix_fmt": "yuv420p"}
+    assert transcode.can_remux(info, fg, mask_png, enc_config, **kwargs) == ok
+
+
+@pytest.mark.parametrize(
+    "codec, bsf",
+    [
+        ("h264", "h264_metadata=sample_aspect_ratio=8/9"),
+        ("hevc", "hevc_metadata=sample_aspect_ratio=8/9"),
+        ("mpeg2video", "mpeg2_metadata=display_aspect_ratio=4/3"),
+        ("mpeg4", None),
+    ],
+)
+def test_remux_options(codec, bsf):
+    opts = transcode.remux_options(720, 480, Fraction(8, 9), codec)
+    assert opts["c"] == "copy" and opts["map_metadata"] == -1
+    assert opts.get("bsf:v", None) == bsf and opts["aspect"] == "4:3"
+
+
+def test_transcode_remux_default(tmp_path, monkeypatch):
+    import subprocess
+
+    from fluorofix import batch, configure
+
+    src = str(tmp_path / "in.mp4")
+    subprocess.run(
+        [
+            ffmpegio.get_path(),
+            *("-v", "error", "-f", "lavfi", "-i", "testsrc2=s=320x240:r=15:d=1"),
+            *("-c:v", "libx264", "-pix_fmt", "yuv420p", src),
+        ],
+        check=True,
+    )
+    info = {
+        "codec_name": "h264",
+        "width": 320,
+        "height": 240,
+        "pix_fmt": "yuv420p",
+        "frame_rate": Fraction(15),
+        "sample_aspect_ratio": Fraction(1),
+    }
+
+    # SAR-only profile with the default output options (crf included)
+    ctx = {**configure.defaultOption(), "SquarePixel": False}
+    ctx["Profiles"] = {"sar only": [{"height": 240}, {"sar": [8, 9]}]}
+    kwargs = batch.job_options(ctx, "sar only", info)
+
+    remuxed = []
+    check = transcode.can_remux
+
+    def can_remux(*args):
+        remuxed.append(check(*args))
+        return remuxed[-1]
+
+    monkeypatch.setattr(transcode, "can_remux", can_remux)
+    dst = str(tmp_path / "out.mp4")
+    transcode.transcode(src, dst, src_info=info, **kwargs)
+    assert remuxed == [True]
+
+    log = subprocess.run(
+        [ffmpegio.get_path(), "-i", dst], capture_output=True, text=True
+    ).stderr
+    assert "SAR 8:9" in log
+
+
 if __name__ == "__main__":
 
     from matplotlib import pyplot as plt
@@ -0,0 +1,100 @@
+import sys
+from threading import Event, Thread
+from time import sleep, time
+
+import pytest
+
+from fluorofix import configure, probe, watch
+
+
+def test_stability_tracker(tmp_path):
+    f = tmp_path / "video.mp4"
+    f.write_bytes(b"0")
+    tracker = watch.StabilityTracker(settle=5.0)
+    tracker.add(str(f), now=100.0)
+    assert tracker.ready(now=100.0) == {}
+    f.write_bytes(b"00")  # still being written
+    assert tracker.ready(now=104.0) == {}
+    assert tracker.ready(now=108.0) == {}
+    assert tracker.ready(now=109.0) == {str(f): 100.0}
+    assert len(tracker) == 0
+
+
+@pytest.mark.parametrize(
+    "polling",
+    [
+        True,
+        pytest.param(
+            False,
+            marks=pytest.mark.skipif(
+                not sys.platform.startswith("linux"), reason="needs inotify"
+            ),
+        ),
+    ],
+)
+def test_watcher(tmp_path, polling):
+    (tmp_path / "old.mp4").write_bytes(b"0")
+    watcher = watch.make_watcher([str(tmp_path)], polling, interval=0.1)
+    try:
+        assert isinstance(watcher, watch.PollingWatcher) == polling
+        assert watcher.existing() == [str(tmp_path / "old.mp4")]
+        (tmp_path / "sub").mkdir()
+        sleep(0.05)
+        (tmp_path / "sub" / "new.mp4").write_bytes(b"0")
+        changed = set()
+        for _ in range(20):
+            changed |= watcher.poll(0.1)
+            if str(tmp_path / "sub" / "new.mp4") in changed:
+                break
+        assert str(tmp_path / "sub" / "new.mp4") in changed
+    finally:
+        watcher.close()
+
+
+def test_watch_daemon(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        probe,
+        "check_file",
+        lambda ctx, f: {
+            "prof": "480p" if f.endswith(".mp4") else None,
+            "dst": f + ".out",
+        },
+    )
+    ran = []
+
+    def run_job(ctx, src, data, threads=None):
+        ran.append(src)
+        open(data["dst"], "wb").close()
+        return {"dst": data["dst"], "error": None, "elapsed": 0.0, "skipped": False}
+
+    monkeypatch.setattr(watch, "run_job", run_job)
+
+    ctx = configure.defaultOption()
+    daemon = watch.WatchDaemon(ctx, [str(tmp_path)], max_workers=1, settle=0.2)
+    stop = Event()
+    thread = Thread(target=daemon.run, args=(stop, 0.05))
+    thread.start()
+    try:
+        (tmp_path / "video.mp4").write_bytes(b"0")
+        (tmp_path / "notes.txt").write_bytes(b"0")
+        for _ in range(100):
+            if daemon.stats()["processed"]:
+                break
+            sleep(0.05)
+        sleep(0.5)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert ran == [str(tmp_path / "video.mp4")]
+    stats = daemon.stats()
+    assert stats["processed"] == 1 and stats["failed"] == 0
+    assert stats["latency"] >= 0.2
+
+    # outputs are ignored until their TTL expires, unlike other ".part." files
+    output = str(tmp_path / "video.mp4.out")
+    assert daemon._ignore(output)
+    assert daemon._ignore(str(tmp_path / "video.mp4.part.out"))
+    assert not daemon._ignore(str(tmp_path / "case12.part.2.mp4"))
+    daemon._prune(time() + 61.0)
+    assert not daemon._outputs and not daemon._ignore(output)